@@ -0,0 +1,519 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks for 'twitter.py' with synthetic twitter data
+
+Copyright (c) 2020 Aaron Dettmann
+License: MIT
+
+Tweets are generated with a fixed seed, so that results of different
+commits can be compared. Downloads use a fake 'twitter_scraper' module
+with a configurable latency per page, no network access is needed.
+
+Examples:
+
+    python benchmark.py --sizes 1k 10k 100k -o before.json
+    python benchmark.py --sizes 1k 10k 100k -o after.json --compare before.json
+"""
+
+from collections import OrderedDict
+from math import ceil
+import argparse
+import datetime
+import gc
+import json
+import logging
+import os
+import platform
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s | %(levelname)s | %(message)s',
+    datefmt='%F %H:%M:%S',
+)
+logger = logging.getLogger('benchmark')
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+
+BENCHMARKS = (
+    'startup',
+    'load_twitter_data',
+    'read_column_table',
+    '_sort_tweets_by_date',
+    'filter_tweets',
+    'get_tweets_per_day',
+    'summarize',
+    'convert_to_excel',
+    'convert_to_csv',
+    'download_history',
+    'download_sharded',
+)
+
+TWEETS_PER_PAGE = 20
+STARTUP_TWEETS = 20  # Size of the data file converted in the start-up benchmark
+REGRESSION_THRESHOLD = 1.1  # Ratio of times which is reported as regression
+
+# ----- Synthetic data -----
+WORDS = (
+    'the', 'to', 'and', 'of', 'a', 'in', 'is', 'for', 'on', 'that', 'with', 'we', 'this', 'it', 'be',
+    'rocket', 'launch', 'car', 'battery', 'factory', 'production', 'software', 'update', 'team',
+    'great', 'progress', 'today', 'tomorrow', 'next', 'week', 'year', 'people', 'thanks', 'new',
+    'space', 'mars', 'moon', 'engine', 'test', 'flight', 'solar', 'energy', 'data', 'crew',
+)
+NUM_HASHTAGS = 500  # Hashtag popularity follows a Zipf distribution
+PROB_RETWEET = 0.3
+PROB_SAME_SECOND = 0.05  # Probability that a tweet has the same timestamp as the previous one
+MEAN_SECONDS_BETWEEN_TWEETS = 3*3600
+
+
+def parse_size(string):
+    """
+    Parse a number of tweets ('1000', '10k', '1M')
+
+    Args:
+        :string: (str) number with optional suffix 'k' or 'M'
+
+    Returns:
+        :size: (int) number of tweets
+    """
+
+    factors = {'k': 10**3, 'K': 10**3, 'm': 10**6, 'M': 10**6}
+    if string and string[-1] in factors:
+        return int(float(string[:-1])*factors[string[-1]])
+    return int(string)
+
+
+def generate_profile(username='synthetic'):
+    """Return profile data (same keys as 'twitter_scraper.Profile.to_dict()')"""
+
+    return OrderedDict((
+        ('name', 'Synthetic Account'),
+        ('username', username),
+        ('birthday', None),
+        ('biography', 'Generated for benchmarks'),
+        ('website', ''),
+        ('profile_photo', 'https://pbs.twimg.com/profile_images/0/synthetic_400x400.jpg'),
+        ('likes_count', 1000),
+        ('tweets_count', 10000),
+        ('followers_count', 1000000),
+        ('following_count', 100),
+    ))
+
+
+def generate_history(num_tweets, seed=0, start=datetime.datetime(2020, 5, 1)):
+    """
+    Yield synthetic tweets, newest first (as delivered by 'twitter_scraper')
+
+    * Retweets make up about 30 % of all tweets
+    * About 5 % of all tweets have the same timestamp as the tweet before
+    * Hashtags are drawn from a Zipf distribution (few very common hashtags)
+    * Likes, retweets and replies follow a heavy-tailed distribution
+
+    Args:
+        :num_tweets: (int) number of tweets
+        :seed: (int) seed of the random number generator
+        :start: (obj) 'datetime' of the newest tweet
+
+    Yields:
+        :tweet: (dict) tweet with the keys of 'data.json' ('time' in iso-format)
+    """
+
+    rng = random.Random(seed)
+    hashtags = [f'#Tag{i}' for i in range(NUM_HASHTAGS)]
+    hashtag_weights = [1/(i + 1) for i in range(NUM_HASHTAGS)]
+    time = start
+    tweet_id = 1260000000000000000
+
+    for _ in range(num_tweets):
+        if rng.random() > PROB_SAME_SECOND:
+            time -= datetime.timedelta(seconds=int(rng.expovariate(1/MEAN_SECONDS_BETWEEN_TWEETS)) + 1)
+        tweet_id -= rng.randint(1, 10**12)
+
+        tweet_hashtags = rng.choices(hashtags, hashtag_weights, k=rng.choice((0, 0, 0, 1, 1, 2, 3)))
+        words = rng.choices(WORDS, k=rng.randint(3, 40))
+        urls = [f'https://example.com/{tweet_id}'] if rng.random() < 0.2 else []
+        likes = int(rng.paretovariate(1.2)*50)
+
+        yield OrderedDict((
+            ('tweetId', str(tweet_id)),
+            ('isRetweet', rng.random() < PROB_RETWEET),
+            ('time', time.isoformat()),
+            ('text', ' '.join(words + tweet_hashtags + urls)),
+            ('replies', likes//20),
+            ('retweets', int(likes*rng.uniform(0.05, 0.3))),
+            ('likes', likes),
+            ('entries', OrderedDict((
+                ('hashtags', tweet_hashtags),
+                ('urls', urls),
+                ('photos', [f'https://pbs.twimg.com/media/{tweet_id}.jpg'] if rng.random() < 0.25 else []),
+                ('videos', [{'id': str(tweet_id)}] if rng.random() < 0.05 else []),
+            ))),
+        ))
+
+
+def make_fake_twitter_scraper(latency=0.0, seed=0):
+    """
+    Return a module which replaces 'twitter_scraper'
+
+    'get_tweets()' yields synthetic tweets (20 per page) and waits 'latency'
+    seconds before each page. The number of tweets is set with the attribute
+    'num_tweets' of the module. Search queries of 'Fetcher.search_tweets()'
+    with 'since:' and 'until:' only yield the tweets of that date window.
+
+    Args:
+        :latency: (float) seconds per request
+        :seed: (int) seed for 'generate_history()'
+
+    Returns:
+        :module: (obj) fake module
+    """
+
+    module = types.ModuleType('twitter_scraper')
+    module.num_tweets = 0
+    module.latency = latency
+
+    class Profile:
+        def __init__(self, username):
+            time.sleep(module.latency)
+            self._data = generate_profile(username)
+            self.name = self._data['name']
+            self.followers_count = self._data['followers_count']
+
+        def to_dict(self):
+            return dict(self._data)
+
+    def iter_window(tweets, since, until):
+        for tweet in tweets:
+            day = tweet['time'][:10]
+            if day < since:
+                return
+            if day < until:
+                yield tweet
+
+    def get_tweets(query, pages=25):
+        tweets = generate_history(module.num_tweets, seed=seed)
+        match = re.search(r'since:(\S+) until:(\S+)', query)
+        if match:
+            tweets = iter_window(tweets, *match.groups())
+        for page in range(pages):
+            time.sleep(module.latency)
+            num_yielded = 0
+            for tweet in tweets:
+                tweet = dict(tweet, time=datetime.datetime.fromisoformat(tweet['time']))
+                yield tweet
+                num_yielded += 1
+                if num_yielded == TWEETS_PER_PAGE:
+                    break
+            if num_yielded < TWEETS_PER_PAGE:
+                return
+
+    module.Profile = Profile
+    module.get_tweets = get_tweets
+    return module
+
+
+# ----- Measurement -----
+def measure(func, *args, repeat=3, memory=True, **kwargs):
+    """
+    Measure run time and peak memory of a function call
+
+    Time and memory are measured in separate runs, since 'tracemalloc' slows
+    down the program considerably.
+
+    Args:
+        :func: (obj) function to call
+        :args: (tuple) positional arguments for 'func'
+        :repeat: (int) number of timed runs (the fastest run is reported)
+        :memory: (bool) if True, measure the peak memory in an additional run
+        :kwargs: (dict) keyword arguments for 'func'
+
+    Returns:
+        :result: (dict) 'seconds', 'peak_mb' and 'runs'
+    """
+
+    times = []
+    for _ in range(max(1, repeat)):
+        gc.collect()
+        start = time.perf_counter()
+        func(*args, **kwargs)
+        times.append(time.perf_counter() - start)
+
+    peak_mb = None
+    if memory:
+        gc.collect()
+        tracemalloc.start()
+        try:
+            func(*args, **kwargs)
+            peak_mb = tracemalloc.get_traced_memory()[1]/2**20
+        finally:
+            tracemalloc.stop()
+
+    return OrderedDict((
+        ('seconds', round(min(times), 6)),
+        ('peak_mb', round(peak_mb, 3) if peak_mb is not None else None),
+        ('runs', len(times)),
+    ))
+
+
+def run_command(command, cwd):
+    """
+    Run a command in a new Python process (real modules, no fake scraper)
+
+    Args:
+        :command: (list) arguments for the Python interpreter
+        :cwd: (str) working directory
+    """
+
+    subprocess.run([sys.executable, *command], cwd=cwd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def get_metadata(args):
+    """Return information about the environment of a benchmark run"""
+
+    def version(module_name):
+        try:
+            return __import__(module_name).__version__
+        except (ImportError, AttributeError):
+            return None
+
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return OrderedDict((
+        ('date', datetime.datetime.now().isoformat(timespec='seconds')),
+        ('commit', commit),
+        ('python', platform.python_version()),
+        ('platform', platform.platform()),
+        ('cpu_count', os.cpu_count()),
+        ('numpy', version('numpy')),
+        ('openpyxl', version('openpyxl')),
+        ('sizes', args.sizes),
+        ('format', args.format),
+        ('latency', args.latency),
+        ('seed', args.seed),
+    ))
+
+
+# ----- Benchmarks -----
+def run_benchmarks(twitter, sizes, *, benchmarks=BENCHMARKS, storage='json', engine='stream', repeat=3, memory=True, seed=0, workdir):
+    """
+    Run the benchmarks for every history size
+
+    Args:
+        :twitter: (obj) module 'twitter'
+        :sizes: (list) numbers of tweets
+        :benchmarks: (list) names of benchmarks to run (see 'BENCHMARKS')
+        :storage: (str) storage format of the generated data files
+        :engine: (str) Excel engine
+        :repeat: (int) number of timed runs per benchmark
+        :memory: (bool) if True, measure peak memory
+        :seed: (int) seed for 'generate_history()'
+        :workdir: (str) directory for generated files
+
+    Returns:
+        :results: (list) one dictionary per benchmark and size
+    """
+
+    results = []
+    script = os.path.join(HERE, 'twitter.py')
+
+    def record(name, size, func, *args, runs=repeat, memory=memory, **kwargs):
+        logger.info(f"Running {name} ({size:,} tweets)...")
+        result = OrderedDict((('name', name), ('size', size)))
+        result.update(measure(func, *args, repeat=runs, memory=memory, **kwargs))
+        logger.info(f"--> {result['seconds']:.3f} s" + (f", {result['peak_mb']:.1f} MB" if memory else ''))
+        results.append(result)
+
+    # Start-up time of the command line tool, i.e. mostly the time to import modules
+    if 'startup' in benchmarks:
+        filename = twitter.get_data_filename(workdir, storage)
+        twitter.write_twitter_data(generate_profile(), generate_history(STARTUP_TWEETS, seed=seed), filename, storage)
+        kwargs = {'cwd': workdir, 'memory': False}
+        record('startup (import)', 0, run_command, ['-c', f'import sys; sys.path.insert(0, {HERE!r}); import twitter'], **kwargs)
+        record('startup (--help)', 0, run_command, [script, '--help'], **kwargs)
+        record('startup (xl)', STARTUP_TWEETS, run_command, [script, 'xl', filename, '--force'], **kwargs)
+        os.remove(filename)
+
+    for size in sizes:
+        filename = twitter.get_data_filename(workdir, storage)
+        logger.info(f"Generating {size:,} tweets...")
+        twitter.write_twitter_data(generate_profile(), generate_history(size, seed=seed), filename, storage)
+
+        if 'load_twitter_data' in benchmarks:
+            record('load_twitter_data', size, twitter.load_twitter_data, filename)
+        if 'read_column_table' in benchmarks:
+            shutil.rmtree(twitter.get_column_cache_dir(filename), ignore_errors=True)
+            record('write_column_cache', size, twitter.write_column_cache, filename)
+            record('read_column_table (cached)', size, twitter.read_column_table, filename)
+
+        twitter_data = twitter.load_twitter_data(filename)
+        tweets = twitter_data['history']
+
+        if '_sort_tweets_by_date' in benchmarks:
+            record('_sort_tweets_by_date', size, twitter._sort_tweets_by_date, tweets)
+        if 'filter_tweets' in benchmarks:
+            record('filter_tweets (hashtag)', size, twitter.filter_tweets, tweets, '#Tag1')
+            record('filter_tweets (keyword)', size, twitter.filter_tweets, tweets, 'rocket')
+            record('filter_tweets (expression)', size, twitter.filter_tweets, tweets, '#Tag2 AND NOT mars')
+            keywords = ['rocket', 'mars', 'battery', 'solar', 'crew', 'launch', 'factory', 'moon', 'engine', 'tesla']
+
+            def match_keywords():
+                twitter.FilterEngine(tweets).match(keywords)
+
+            record('FilterEngine.match (10 keywords)', size, match_keywords)
+        if 'get_tweets_per_day' in benchmarks:
+            record('get_tweets_per_day', size, twitter.get_tweets_per_day, twitter_data)
+        if 'summarize' in benchmarks:
+            def summarize():
+                twitter.TweetSummary().update(tweets, 'synthetic')
+
+            record('TweetSummary.update', size, summarize)
+        if 'convert_to_excel' in benchmarks:
+            excel_file = os.path.join(workdir, 'data.xlsx')
+            record(
+                'convert_to_excel', size, twitter.convert_to_excel, twitter_data, excel_file,
+                filters=['#Tag1', 'rocket', 'mars'], engine=engine, runs=1,
+            )
+        if 'convert_to_csv' in benchmarks:
+            csv_file = os.path.join(workdir, 'data.csv')
+            record('convert_to_csv', size, twitter.convert_to_excel, twitter_data, csv_file, filters=['#Tag1', 'rocket', 'mars'])
+
+        del twitter_data, tweets
+        os.remove(filename)
+
+        if 'download_history' in benchmarks:
+            twitter.tw.num_tweets = size
+            dir_data = os.path.join(workdir, 'data')
+
+            def download():
+                shutil.rmtree(dir_data, ignore_errors=True)
+                twitter.download_history('synthetic', ceil(size/TWEETS_PER_PAGE) + 1, storage=storage)
+
+            twitter.DIR_DATA = dir_data
+            record('download_history', size, download, runs=1)
+            shutil.rmtree(dir_data, ignore_errors=True)
+
+        if 'download_sharded' in benchmarks:
+            twitter.tw.num_tweets = size
+            dir_data = os.path.join(workdir, 'data')
+            for tweet in generate_history(size, seed=seed):
+                pass
+            first_day = datetime.date.fromisoformat(tweet['time'][:10])
+            windows = twitter.get_date_windows(first_day, datetime.date(2020, 5, 2), twitter.SHARD_JOBS)
+
+            def download_sharded():
+                shutil.rmtree(dir_data, ignore_errors=True)
+                twitter.download_history('synthetic', ceil(size/TWEETS_PER_PAGE) + 1, storage=storage, windows=windows)
+
+            twitter.DIR_DATA = dir_data
+            record('download_sharded', size, download_sharded, runs=1)
+            shutil.rmtree(dir_data, ignore_errors=True)
+
+    return results
+
+
+def compare_results(results, old_results):
+    """
+    Log the ratio of run times compared to an earlier benchmark run
+
+    Args:
+        :results: (list) current results
+        :old_results: (list) results of an earlier run
+
+    Returns:
+        :regressions: (list) names and sizes of benchmarks which got slower
+    """
+
+    old = {(result['name'], result['size']): result for result in old_results}
+    regressions = []
+
+    logger.info(f"{'benchmark':<30} {'size':>9} {'old [s]':>10} {'new [s]':>10} {'ratio':>7}")
+    for result in results:
+        key = (result['name'], result['size'])
+        if key not in old:
+            continue
+        ratio = result['seconds']/old[key]['seconds'] if old[key]['seconds'] else float('inf')
+        flag = ''
+        if ratio > REGRESSION_THRESHOLD:
+            flag = ' <-- slower'
+            regressions.append(key)
+        logger.info(f"{key[0]:<30} {key[1]:>9,} {old[key]['seconds']:>10.3f} {result['seconds']:>10.3f} {ratio:>7.2f}{flag}")
+
+    return regressions
+
+
+def cli():
+    """Command line interface"""
+
+    parser = argparse.ArgumentParser(prog='benchmark', description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--sizes', '-s', metavar='N', nargs='+', type=parse_size, default=[1000, 10000, 100000],
+                        help='numbers of tweets, e.g. 1k 10k 1M (default: 1k 10k 100k)')
+    parser.add_argument('--benchmarks', '-b', metavar='NAME', nargs='+', choices=BENCHMARKS, default=list(BENCHMARKS),
+                        help=f"benchmarks to run ({', '.join(BENCHMARKS)})")
+    parser.add_argument('--format', choices=('json', 'jsonl', 'jsonl.gz'), default='json', help='storage format of the data files')
+    parser.add_argument('--excel-engine', choices=('standard', 'stream'), default='stream', help='excel engine')
+    parser.add_argument('--latency', metavar='SECONDS', type=float, default=0.0, help='latency of the fake scraper per page')
+    parser.add_argument('--repeat', '-r', metavar='N', type=int, default=3, help='number of timed runs (the fastest counts)')
+    parser.add_argument('--no-memory', action='store_true', help='do not measure peak memory (faster)')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the synthetic data')
+    parser.add_argument('--output', '-o', metavar='FILE', default='benchmark.json', help='result file (JSON)')
+    parser.add_argument('--compare', '-c', metavar='FILE', help='earlier result file to compare with')
+    args = parser.parse_args()
+
+    # Downloads never go to the network
+    fake_scraper = make_fake_twitter_scraper(latency=args.latency, seed=args.seed)
+    sys.modules['twitter_scraper'] = fake_scraper
+    sys.path.insert(0, HERE)
+    import twitter
+    twitter.logger.setLevel(logging.WARNING)
+
+    workdir = tempfile.mkdtemp(prefix='benchmark_')
+    try:
+        results = run_benchmarks(
+            twitter,
+            args.sizes,
+            benchmarks=args.benchmarks,
+            storage=args.format,
+            engine=args.excel_engine,
+            repeat=args.repeat,
+            memory=not args.no_memory,
+            seed=args.seed,
+            workdir=workdir,
+        )
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = OrderedDict((('meta', get_metadata(args)), ('results', results)))
+    with open(args.output, 'w') as fp:
+        json.dump(report, fp, indent=4)
+    logger.info(f"Results saved: {args.output}")
+
+    if args.compare:
+        with open(args.compare, 'r') as fp:
+            old_report = json.load(fp)
+        regressions = compare_results(results, old_report['results'])
+        if regressions:
+            logger.warning(f"{len(regressions)} benchmark(s) slower than {args.compare}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    try:
+        cli()
+    except KeyboardInterrupt:
+        logger.error("Exit...")
+        sys.exit(1)
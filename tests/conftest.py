@@ -0,0 +1,40 @@
+"""
+Fixtures for the tests of 'twitter.py'
+
+The fake 'twitter_scraper' of 'benchmark.py' replaces the real module, so
+downloads never go to the network.
+"""
+
+import os
+import sys
+
+import pytest
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import benchmark  # noqa: E402
+
+sys.modules['twitter_scraper'] = benchmark.make_fake_twitter_scraper()
+
+import twitter  # noqa: E402
+
+
+@pytest.fixture
+def fake_scraper(monkeypatch):
+    """Fake 'twitter_scraper' module (set 'num_tweets' before downloading)"""
+
+    scraper = sys.modules['twitter_scraper']
+    monkeypatch.setattr(scraper, 'num_tweets', 0)
+    monkeypatch.setattr(scraper, 'latency', 0.0)
+    return scraper
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    """Empty data directory used by all modes"""
+
+    dirname = str(tmp_path / 'data')
+    monkeypatch.setattr(twitter, 'DIR_DATA', dirname)
+    monkeypatch.setattr(twitter, 'DIR_MEDIA', os.path.join(dirname, 'media'))
+    return dirname
@@ -0,0 +1,36 @@
+import argparse
+import re
+import subprocess
+import sys
+
+import pytest
+
+import twitter
+
+
+def test_every_mode_has_dependencies():
+    usage = subprocess.run([sys.executable, twitter.__file__, '--help'], capture_output=True, text=True, check=True).stdout
+    modes = re.search(r'\{([a-z,]+)\}', usage).group(1).split(',')
+    assert sorted(modes) == sorted(twitter.MODE_DEPENDENCIES)
+
+
+@pytest.mark.parametrize('args, expected', [
+    ({'exec_mode': 'xl', 'output_format': 'xlsx'}, ('numpy', 'openpyxl')),
+    ({'exec_mode': 'xl', 'output_format': 'csv.gz'}, ('numpy',)),
+    ({'exec_mode': 'down', 'output_format': 'xlsx', 'no_excel': True}, ('twitter_scraper', 'numpy')),
+    ({'exec_mode': 'xl', 'output_format': 'tsv', 'media': True}, ('numpy', 'requests')),
+    ({'exec_mode': 'query', 'output': 'query.xlsx'}, ('numpy', 'openpyxl')),
+    ({'exec_mode': 'query', 'output': 'query.csv'}, ('numpy',)),
+    ({'exec_mode': 'diff', 'output': 'diff.tsv.gz'}, ('numpy',)),
+    ({'exec_mode': 'summary', 'output': 'summary.csv'}, ('numpy',)),
+    ({'exec_mode': 'ls'}, ()),
+    ({'exec_mode': 'migrate'}, ()),
+    ({'exec_mode': 'archive'}, ()),
+])
+def test_mode_dependencies(args, expected):
+    assert twitter.get_mode_dependencies(argparse.Namespace(**args)) == expected
+
+
+def test_query_media_needs_no_requests():
+    args = argparse.Namespace(exec_mode='query', output='query.csv', media=True)
+    assert twitter.get_mode_dependencies(args) == ('numpy',)
@@ -0,0 +1,53 @@
+import logging
+import os
+import sys
+
+import benchmark
+import twitter
+from test_download import write_snapshot
+
+
+def test_convert_files_counts_unreadable_files_as_failed(data_dir, tmp_path, caplog):
+    filename = str(tmp_path / 'data.json')
+    twitter.write_twitter_data(benchmark.generate_profile(), benchmark.generate_history(20), filename, 'json')
+    missing = str(tmp_path / 'missing' / 'data.json')
+    options = {'output_format': 'csv'}
+
+    assert twitter.convert_files_to_excel([filename], **options) == {filename: True}
+
+    caplog.clear()
+    with caplog.at_level(logging.INFO, logger='twitter'):
+        results = twitter.convert_files_to_excel([filename, missing], **options)
+
+    assert results == {filename: True, missing: False}
+    assert "0 file(s) with 1 job(s) (1 up to date, 1 unreadable)" in caplog.text
+    assert "0 converted, 1 up to date, 1 failed (1 unreadable)" in caplog.text
+
+
+def test_cli_converts_data_files_outside_snapshot_folders(data_dir, monkeypatch, caplog):
+    snapshot = write_snapshot(data_dir, 'alice', '2020-05-01_1200', benchmark.generate_history(20))
+    os.makedirs(os.path.join(data_dir, 'imported'))
+    imported = os.path.join(data_dir, 'imported', 'data.json')
+    twitter.write_twitter_data(benchmark.generate_profile(), benchmark.generate_history(10), imported, 'json')
+    monkeypatch.setattr(sys, 'argv', ['twitter.py', 'xl', data_dir, '--output-format', 'csv'])
+
+    with caplog.at_level(logging.INFO, logger='twitter'):
+        twitter.cli()
+
+    assert "Found 1 data file(s) which are not in a snapshot folder" in caplog.text
+    for filename in (snapshot, imported):
+        assert os.path.isfile(twitter.get_excel_filename(filename, 'csv'))
+
+
+def test_new_version_converts_again(data_dir, tmp_path, monkeypatch):
+    filename = str(tmp_path / 'data.json')
+    twitter.write_twitter_data(benchmark.generate_profile(), benchmark.generate_history(20), filename, 'json')
+    excel_file = twitter.get_excel_filename(filename, 'csv')
+    cache = twitter.ConversionCache()
+    options = {'output_format': 'csv'}
+
+    twitter.convert_files_to_excel([filename], **options)
+    assert cache.is_up_to_date(filename, excel_file, options)
+
+    monkeypatch.setattr(twitter, 'VERSION', twitter.VERSION + '.1')
+    assert not twitter.ConversionCache().is_up_to_date(filename, excel_file, options)
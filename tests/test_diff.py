@@ -0,0 +1,70 @@
+import csv
+import gzip
+import os
+
+import numpy as np
+import pytest
+
+import benchmark
+import twitter
+from test_download import write_snapshot
+
+
+def make_columns(ids, epochs=None, oldest=0):
+    ids = np.array(sorted(ids), dtype=np.int64)
+    return {'ids': ids, 'epochs': np.array(epochs if epochs is not None else ids, dtype=np.int64), 'oldest': oldest}
+
+
+@pytest.mark.parametrize('old_ids, new_ids', [
+    ([1, 3, 5, 7], [2, 3, 4, 7, 9]),
+    ([], [1, 2]),
+    ([1, 2], []),
+    ([5, 6, 7], [5, 6, 7]),
+    ([10, 20], [1, 2, 30]),
+])
+def test_join_engagement_columns(old_ids, new_ids):
+    old, new = make_columns(old_ids), make_columns(new_ids, oldest=3)
+
+    kept_old, kept_new, added, deleted = twitter.join_engagement_columns(old, new)
+
+    common = sorted(set(old_ids) & set(new_ids))
+    assert old['ids'][kept_old].tolist() == common
+    assert new['ids'][kept_new].tolist() == common
+    assert new['ids'][added].tolist() == sorted(set(new_ids) - set(old_ids))
+    # Only tweets which are not older than the oldest tweet of the new snapshot count as deleted
+    assert old['ids'][deleted].tolist() == sorted(i for i in set(old_ids) - set(new_ids) if i >= 3)
+
+
+def test_join_engagement_columns_matches_binary_search():
+    rng = np.random.default_rng(0)
+    new_ids = rng.choice(10**9, 5000, replace=False)
+    old_ids = np.concatenate((rng.choice(new_ids, 4000, replace=False), rng.choice(10**9, 500)))
+    old, new = make_columns(np.unique(old_ids)), make_columns(new_ids)
+
+    kept_old, kept_new, _, _ = twitter.join_engagement_columns(old, new)
+
+    positions = np.searchsorted(new['ids'], old['ids'])
+    found = new['ids'][np.minimum(positions, len(new['ids']) - 1)] == old['ids']
+    assert kept_old.tolist() == np.nonzero(found)[0].tolist()
+    assert kept_new.tolist() == positions[found].tolist()
+
+
+@pytest.mark.parametrize('suffix', ['.csv', '.tsv', '.csv.gz', '.xlsx'])
+def test_diff_output_formats(data_dir, tmp_path, suffix):
+    history = list(benchmark.generate_history(30))
+    old = write_snapshot(data_dir, 'alice', '2020-05-01_1200', history[5:])
+    new = write_snapshot(data_dir, 'alice', '2020-05-02_1200', history)
+    output = str(tmp_path / f'diff{suffix}')
+
+    twitter.diff_snapshots([old, new], output, column_cache=False)
+
+    assert os.path.isfile(output)
+    if suffix == '.xlsx':
+        assert twitter.import_module('openpyxl').load_workbook(output).sheetnames == ['Diff', 'Summary']
+        return
+    opener = gzip.open if suffix.endswith('.gz') else open
+    with opener(output, 'rt', newline='', encoding='utf-8') as fp:
+        rows = list(csv.reader(fp, dialect='excel-tab' if suffix == '.tsv' else 'excel'))
+    assert len(rows) == 1 + len(history)
+    assert sum('added' in row for row in rows) == 5
+    assert os.path.isfile(tmp_path / f'diff_summary{suffix}')
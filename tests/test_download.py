@@ -0,0 +1,119 @@
+import datetime
+import os
+
+import pytest
+
+import benchmark
+import twitter
+
+
+def read_tweet_ids(filename):
+    return [tweet['tweetId'] for tweet in twitter.read_twitter_data(filename)[1]]
+
+
+def test_download_accounts_concurrently(fake_scraper, data_dir):
+    fake_scraper.num_tweets = 50
+    usernames = ['alice', 'bob', 'carol', 'dave']
+
+    results = twitter.download_accounts(usernames, pages=10, jobs=3, excel=False)
+
+    assert results == {username: True for username in usernames}
+    expected = [tweet['tweetId'] for tweet in benchmark.generate_history(50)]
+    for username in usernames:
+        (filename,) = [entry['path'] for entry in twitter.load_catalog().snapshots(username)]
+        assert read_tweet_ids(filename) == expected
+        assert twitter.read_twitter_data(filename)[0]['username'] == username
+
+
+def test_download_accounts_failure_does_not_stop_others(fake_scraper, data_dir, monkeypatch):
+    fake_scraper.num_tweets = 30
+    get_tweets = fake_scraper.get_tweets
+
+    def failing_get_tweets(query, pages=25):
+        if query == 'bob':
+            raise ConnectionError("offline")
+        return get_tweets(query, pages)
+
+    monkeypatch.setattr(fake_scraper, 'get_tweets', failing_get_tweets)
+    results = twitter.download_accounts(['alice', 'bob', 'carol'], pages=5, jobs=3, excel=False)
+
+    assert results == {'alice': True, 'bob': False, 'carol': True}
+
+
+@pytest.mark.parametrize('jobs', [1, 4])
+def test_download_accounts_converts_each_account(fake_scraper, data_dir, jobs):
+    fake_scraper.num_tweets = 20
+    results = twitter.download_accounts(
+        ['alice', 'bob'], pages=5, jobs=jobs, excel_options={'output_format': 'csv'},
+    )
+
+    assert all(results.values())
+    for entry in twitter.load_catalog().snapshots():
+        assert os.path.isfile(twitter.get_excel_filename(entry['path'], 'csv'))
+
+
+def write_snapshot(data_dir, username, taken_at, tweets, storage='json'):
+    dirname = os.path.join(data_dir, f"{username}_{taken_at}")
+    os.makedirs(dirname)
+    filename = twitter.get_data_filename(dirname, storage)
+    twitter.write_twitter_data(benchmark.generate_profile(username), tweets, filename, storage)
+    twitter.add_to_catalog(filename)
+    return filename
+
+
+def test_incremental_download_continues_after_pinned_tweet(fake_scraper, data_dir, monkeypatch):
+    history = list(benchmark.generate_history(100))
+    new_tweets, old_tweets = history[:30], history[30:]
+    write_snapshot(data_dir, 'alice', '2020-01-01_0000', old_tweets)
+
+    # The oldest tweet is pinned, so the timeline starts with a known tweet
+    timeline = [old_tweets[-1]] + history
+    fetched = []
+
+    def get_tweets(query, pages=25):
+        for tweet in timeline:
+            fetched.append(tweet['tweetId'])
+            yield tweet
+
+    monkeypatch.setattr(fake_scraper, 'get_tweets', get_tweets)
+    filename = twitter.download_history('alice', pages=10, incremental=True)
+
+    ids = read_tweet_ids(filename)
+    assert set(ids) == {tweet['tweetId'] for tweet in history}
+    assert len(ids) == len(history)
+    # Stopped after a run of known tweets, not at the end of the timeline
+    assert len(fetched) == 1 + len(new_tweets) + twitter.INCREMENTAL_KNOWN_RUN
+
+
+@pytest.mark.parametrize('num_days, num_windows', [(1, 1), (1, 4), (10, 3), (31, 7), (365, 12), (5, 5)])
+def test_date_windows_cover_period(num_days, num_windows):
+    since = datetime.date(2020, 1, 1)
+    until = since + datetime.timedelta(days=num_days)
+
+    windows = twitter.get_date_windows(since, until, num_windows)
+
+    assert len(windows) == min(num_days, num_windows)
+    oldest_first = windows[::-1]
+    assert oldest_first[0][0] == since
+    assert oldest_first[-1][1] == until
+    for (_, end), (start, _) in zip(oldest_first, oldest_first[1:]):
+        assert end == start  # No gaps, no overlaps ('until' is exclusive)
+    assert all((end - start).days >= 1 for start, end in windows)
+
+
+def test_date_windows_empty_period():
+    day = datetime.date(2020, 1, 1)
+    with pytest.raises(ValueError):
+        twitter.get_date_windows(day, day, 3)
+
+
+@pytest.mark.parametrize('num_windows', [1, 4, 40])
+def test_sharded_download_equals_sequential(fake_scraper, data_dir, num_windows):
+    fake_scraper.num_tweets = 300
+    windows = twitter.get_date_windows(datetime.date(2020, 3, 27), datetime.date(2020, 5, 1), num_windows)
+
+    sequential = read_tweet_ids(twitter.download_history('alice', pages=100))
+    sharded = read_tweet_ids(twitter.download_history('bob', pages=100, windows=windows))
+
+    assert len(sequential) == 300
+    assert sharded == sequential
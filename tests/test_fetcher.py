@@ -0,0 +1,152 @@
+import pytest
+import requests
+
+import twitter
+
+
+class FakeSession:
+    """Replaces 'requests.Session', answers with the given status codes (or exceptions) in turn"""
+
+    def __init__(self, answers):
+        self.answers = list(answers)
+        self.requests = []
+        self.hooks = {'response': []}
+
+    def request(self, method, url, **kwargs):
+        self.requests.append((method, url, kwargs))
+        answer = self.answers.pop(0)
+        if isinstance(answer, Exception):
+            raise answer
+        status_code, headers = answer if isinstance(answer, tuple) else (answer, {})
+        response = requests.Response()
+        response.status_code = status_code
+        response.url = url
+        response.headers.update(headers)
+        response._content = b'ok'
+        return response
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """Seconds of all 'time.sleep()' calls, nothing is waited for"""
+
+    sleeps = []
+    monkeypatch.setattr(twitter.time, 'sleep', sleeps.append)
+    return sleeps
+
+
+def make_fetcher(answers, **options):
+    fetcher = twitter.Fetcher(**options)
+    fetcher.session = FakeSession(answers)
+    return fetcher
+
+
+def test_retry_until_success(sleeps):
+    fetcher = make_fetcher([503, 429, 200], retries=5, rate=1000)
+
+    response = fetcher.get('https://twitter.com/page')
+
+    assert response.status_code == 200
+    assert len(fetcher.session.requests) == 3
+    assert fetcher.stats['retries'] == 2
+    assert fetcher.stats['failed'] == 0
+
+
+def test_retries_are_limited(sleeps, monkeypatch):
+    backoffs = []
+    get_backoff = twitter.Fetcher.get_backoff
+
+    def record_backoff(attempt, response=None):
+        backoffs.append((attempt, get_backoff(attempt, response)))
+        return backoffs[-1][1]
+
+    monkeypatch.setattr(twitter.Fetcher, 'get_backoff', staticmethod(record_backoff))
+    fetcher = make_fetcher([503]*10, retries=3, rate=1000)
+
+    with pytest.raises(requests.HTTPError):
+        fetcher.get('https://twitter.com/page')
+
+    assert len(fetcher.session.requests) == 4
+    assert fetcher.stats['failed'] == 1
+    # One backoff delay between two attempts, each within the exponential limit
+    assert [attempt for attempt, _ in backoffs] == [0, 1, 2]
+    assert all(0 <= delay <= twitter.FETCH_BACKOFF*2**attempt for attempt, delay in backoffs)
+    assert all(delay in sleeps for _, delay in backoffs)
+
+
+def test_network_errors_are_retried_and_raised(sleeps):
+    fetcher = make_fetcher([requests.ConnectionError("reset")]*3, retries=2, rate=1000)
+
+    with pytest.raises(requests.ConnectionError):
+        fetcher.get('https://twitter.com/page')
+
+    assert len(fetcher.session.requests) == 3
+    # Network errors are no sign of overload, the rate stays
+    assert fetcher.limiter.rate == 1000
+
+
+def test_client_errors_are_not_retried(sleeps):
+    fetcher = make_fetcher([404], retries=3, rate=1000)
+
+    assert fetcher.get('https://twitter.com/page').status_code == 404
+    assert len(fetcher.session.requests) == 1
+
+
+def test_base_url(sleeps):
+    fetcher = make_fetcher([200], base_url='http://localhost:8000/')
+
+    fetcher.get('https://twitter.com/i/profiles/show/alice')
+
+    assert fetcher.session.requests[0][1] == 'http://localhost:8000/i/profiles/show/alice'
+
+
+@pytest.mark.parametrize('attempt', range(12))
+def test_backoff_limits(attempt):
+    for _ in range(50):
+        delay = twitter.Fetcher.get_backoff(attempt)
+        assert 0 <= delay <= min(twitter.FETCH_MAX_BACKOFF, twitter.FETCH_BACKOFF*2**attempt)
+
+
+def test_backoff_respects_retry_after():
+    response = requests.Response()
+    response.headers['Retry-After'] = '30'
+    assert 30 <= twitter.Fetcher.get_backoff(0, response) <= twitter.FETCH_MAX_BACKOFF
+
+    response.headers['Retry-After'] = '100000'
+    assert twitter.Fetcher.get_backoff(0, response) == twitter.FETCH_MAX_BACKOFF
+
+
+def test_rate_limiter_burst_and_rate(monkeypatch, sleeps):
+    now = [100.0]
+    monkeypatch.setattr(twitter.time, 'monotonic', lambda: now[0])
+    limiter = twitter.RateLimiter(rate=10, burst=3)
+
+    waits = [limiter.acquire() for _ in range(5)]
+
+    # The burst is free, then one request every 1/rate seconds
+    assert waits[:3] == [0.0, 0.0, 0.0]
+    assert waits[3:] == pytest.approx([0.1, 0.2])
+
+    now[0] += 10  # Tokens are refilled, but never beyond the burst
+    assert [limiter.acquire() for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert limiter.acquire() > 0
+
+
+def test_rate_limiter_throttle_and_relax():
+    limiter = twitter.RateLimiter(rate=8, min_rate=1)
+
+    for _ in range(10):
+        limiter.throttle()
+    assert limiter.rate == 1
+
+    for _ in range(100):
+        limiter.relax()
+    assert limiter.rate == 8
+
+
+def test_server_errors_throttle_the_rate(sleeps):
+    fetcher = make_fetcher([503, 503, 200], retries=5, rate=8)
+
+    fetcher.get('https://twitter.com/page')
+
+    assert fetcher.limiter.rate < 8
@@ -0,0 +1,90 @@
+import pytest
+
+import benchmark
+import twitter
+
+
+def make_tweet(text, hashtags=()):
+    return {'text': text, 'entries': {'hashtags': list(hashtags)}}
+
+
+@pytest.mark.parametrize('filter_kw', ['tesla (model 3)', '(tesla)', 'tesla)', 'model (3'])
+def test_keyword_with_parentheses_is_no_expression(filter_kw):
+    assert twitter.parse_filter_expression(filter_kw) == ('term', filter_kw)
+    assert twitter.get_filter_label(filter_kw)[0] == 'KW'
+
+
+def test_keyword_with_parentheses_matches_text():
+    tweets = [make_tweet("New Tesla (Model 3) delivered"), make_tweet("Tesla model 3")]
+    masks = twitter.FilterEngine(tweets).match(['tesla (model 3)'])
+
+    assert masks['tesla (model 3)'].tolist() == [True, False]
+
+
+@pytest.mark.parametrize('filter_kw', ['tesla AND (model 3', 'AND tesla', 'tesla OR', '(tesla OR spacex))'])
+def test_invalid_expression(filter_kw):
+    with pytest.raises(ValueError):
+        twitter.parse_filter_expression(filter_kw)
+
+
+def test_expression():
+    tree = twitter.parse_filter_expression('#tesla AND NOT (spacex OR dragon)')
+    assert tree == ('and', ('term', '#tesla'), ('not', ('or', ('term', 'spacex'), ('term', 'dragon'))))
+
+
+def test_sheet_titles_are_short_and_unique():
+    titles = set()
+    long_titles = [
+        twitter.get_sheet_title('Activity', 'filter EX tesla and not spacex', titles),
+        twitter.get_sheet_title('Activity', 'filter EX tesla and not spacex or dragon', titles),
+        twitter.get_sheet_title('Activity', 'filter KW a:b/c?', titles),
+    ]
+
+    assert all(len(title) <= twitter.XL_MAX_TITLE_LENGTH for title in long_titles)
+    assert len({title.lower() for title in long_titles}) == 3
+    assert not any(char in title for title in long_titles for char in '[]:*?/\\')
+    assert twitter.get_sheet_title('Raw', 'filter HT tesla', titles) == 'Raw (filter HT tesla)'
+
+
+@pytest.mark.filterwarnings('error')
+@pytest.mark.parametrize('engine', ['standard', 'stream'])
+def test_convert_with_long_expression_filters(tmp_path, engine):
+    openpyxl = pytest.importorskip('openpyxl')
+    twitter_data = {'profile': benchmark.generate_profile(), 'history': list(benchmark.generate_history(200))}
+    filters = ['#tag1 AND NOT rocket', '#tag1 AND NOT rocket OR mars', 'rocket']
+    excel_file = str(tmp_path / 'data.xlsx')
+
+    twitter.convert_to_excel(twitter_data, excel_file, filters=filters, engine=engine)
+
+    sheet_names = openpyxl.load_workbook(excel_file, read_only=True).sheetnames
+    assert all(len(name) <= twitter.XL_MAX_TITLE_LENGTH for name in sheet_names)
+    assert len({name.lower() for name in sheet_names}) == len(sheet_names)
+    assert 'Raw (filter KW rocket)' in sheet_names
+
+    legend = list(openpyxl.load_workbook(excel_file, read_only=True)['Filters'].values)
+    assert [row[0] for row in legend[1:]] == filters
+    assert all(row[2] in sheet_names and row[3] in sheet_names for row in legend[1:])
+
+
+def test_convert_to_csv_with_long_expression_filters(tmp_path):
+    twitter_data = {'profile': benchmark.generate_profile(), 'history': list(benchmark.generate_history(200))}
+    filters = ['#tag1 AND NOT rocket', '#tag1 AND NOT rocket OR mars']
+    csv_file = str(tmp_path / 'data.csv')
+
+    twitter.convert_to_excel(twitter_data, csv_file, filters=filters)
+
+    # Profile, 2 activity sheets, legend and 2 sheets per filter, each in its own file
+    assert len(list(tmp_path.glob('*.csv'))) == 8
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 10000])
+def test_keyword_masks_match_substring_search(monkeypatch, chunk_size):
+    monkeypatch.setattr(twitter, 'FILTER_CHUNK_SIZE', chunk_size)
+    tweets = [make_tweet(tweet['text']) for tweet in benchmark.generate_history(100)]
+    tweets += [make_tweet("İstanbul ROCKET launch"), make_tweet(""), make_tweet("mars\nrocket"), make_tweet("marsrocket")]
+    keywords = {'rocket', 'mars', 'rocket launch', 'istanbul', 'marsrocket', 'tag1', 'nothing'}
+
+    masks = twitter.FilterEngine(tweets)._keyword_masks(keywords)
+
+    for kw in keywords:
+        assert masks[kw].tolist() == [kw in tweet['text'].lower() for tweet in tweets], kw
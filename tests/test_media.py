@@ -0,0 +1,222 @@
+import csv
+import hashlib
+import os
+
+import pytest
+
+import benchmark
+import twitter
+from test_download import write_snapshot
+
+
+class FakeResponse:
+    def __init__(self, status_code, content=b'', headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise OSError(f"HTTP {self.status_code}")
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+
+class FakeFetcher:
+    """
+    Replaces 'Fetcher' for media downloads
+
+    Files are given as URL -> content. Range requests are answered with 206,
+    unless 'ranges' is False (then the whole file is sent with 200).
+    """
+
+    def __init__(self, files, ranges=True):
+        self.files = files
+        self.ranges = ranges
+        self.requests = []
+
+    def get(self, url, headers=None, stream=False):
+        headers = headers or {}
+        self.requests.append((url, headers.get('Range')))
+        content = self.files.get(url)
+        if content is None:
+            return FakeResponse(404)
+        if 'Range' in headers and self.ranges:
+            offset = int(headers['Range'][len('bytes='):-1])
+            if offset >= len(content):
+                return FakeResponse(416)
+            return FakeResponse(206, content[offset:], {'Content-Type': 'image/jpeg'})
+        return FakeResponse(200, content, {'Content-Type': 'image/jpeg'})
+
+    def log_summary(self):
+        pass
+
+
+def list_objects(dirname):
+    return sorted(str(path) for path in (twitter.Path(dirname) / 'objects').rglob('*') if path.is_file())
+
+
+def write_partial(store, url, content):
+    os.makedirs(os.path.join(store.dirname, 'partial'), exist_ok=True)
+    file_partial = os.path.join(store.dirname, 'partial', hashlib.sha256(url.encode('utf-8')).hexdigest())
+    with open(file_partial, 'wb') as fp:
+        fp.write(content)
+
+
+def test_same_content_is_stored_once(tmp_path):
+    store = twitter.MediaStore(str(tmp_path))
+    fetcher = FakeFetcher({'https://a.example/1.jpg': b'photo', 'https://b.example/2.jpg': b'photo'})
+
+    path_a = store.fetch('https://a.example/1.jpg', fetcher)
+    path_b = store.fetch('https://b.example/2.jpg', fetcher)
+
+    assert path_a == path_b
+    assert list_objects(tmp_path) == [path_a]
+    assert os.path.basename(path_a) == hashlib.sha256(b'photo').hexdigest() + '.jpg'
+
+
+def test_known_urls_are_not_fetched_again(tmp_path):
+    url = 'https://a.example/1.jpg'
+    twitter.MediaStore(str(tmp_path)).fetch(url, FakeFetcher({url: b'photo'}))
+
+    # A new store reads the index
+    store = twitter.MediaStore(str(tmp_path))
+    fetcher = FakeFetcher({url: b'photo'})
+    path = store.fetch(url, fetcher)
+
+    assert fetcher.requests == []
+    assert store.get_paths([url, 'https://a.example/unknown.jpg'], str(tmp_path)) == [
+        twitter.Path(os.path.relpath(path, str(tmp_path))).as_posix()
+    ]
+
+
+@pytest.mark.parametrize('ranges', [True, False])
+def test_partial_download_is_continued(tmp_path, ranges):
+    url = 'https://a.example/1.jpg'
+    content = bytes(range(256))*10
+    store = twitter.MediaStore(str(tmp_path))
+    write_partial(store, url, content[:1000])
+    fetcher = FakeFetcher({url: content}, ranges=ranges)
+
+    path = store.fetch(url, fetcher)
+
+    assert fetcher.requests == [(url, 'bytes=1000-')]
+    with open(path, 'rb') as fp:
+        assert fp.read() == content
+
+
+def test_unsatisfiable_range_starts_again(tmp_path):
+    url = 'https://a.example/1.jpg'
+    store = twitter.MediaStore(str(tmp_path))
+    write_partial(store, url, b'stale partial file, longer than the photo')
+    fetcher = FakeFetcher({url: b'photo'})
+
+    path = store.fetch(url, fetcher)
+
+    assert fetcher.requests == [(url, 'bytes=41-'), (url, None)]
+    with open(path, 'rb') as fp:
+        assert fp.read() == b'photo'
+
+
+def test_data_file_is_not_changed(data_dir, tmp_path):
+    tweets = list(benchmark.generate_history(50))
+    filename = str(tmp_path / 'data.json')
+    twitter.write_twitter_data(benchmark.generate_profile(), tweets, filename, 'json')
+    with open(filename, 'rb') as fp:
+        data = fp.read()
+    urls = [url for tweet in tweets for url in twitter.get_media_urls(tweet)]
+    assert urls
+
+    downloader = twitter.MediaDownloader(twitter.MediaStore(twitter.DIR_MEDIA), jobs=2)
+    downloader.fetcher = FakeFetcher({url: url.encode('utf-8') for url in urls})
+    try:
+        assert downloader.fetch_file(filename) == len(set(urls))
+    finally:
+        downloader.close()
+
+    with open(filename, 'rb') as fp:
+        assert fp.read() == data
+
+
+@pytest.mark.parametrize('column_cache', [False, True])
+def test_sheets_list_downloaded_media(data_dir, tmp_path, column_cache):
+    tweets = list(benchmark.generate_history(30))
+    filename = str(tmp_path / 'data.json')
+    twitter.write_twitter_data(benchmark.generate_profile(), tweets, filename, 'json')
+    urls = [url for tweet in tweets for url in twitter.get_media_urls(tweet)]
+    store = twitter.MediaStore(twitter.DIR_MEDIA)
+    fetcher = FakeFetcher({url: url.encode('utf-8') for url in urls})
+    for url in urls:
+        store.fetch(url, fetcher)
+
+    csv_file = twitter.convert_file_to_excel(filename, output_format='csv', media=True, column_cache=column_cache)
+
+    # The first sheet (all tweets) is written to the CSV file itself
+    with open(csv_file, newline='') as fp:
+        rows = list(csv.reader(fp))
+    listed = [row[-1] for row in rows[1:] if row[-1]]
+    assert len(listed) == len(urls)
+    assert all(os.path.isfile(tmp_path / path) for path in listed)
+
+
+def test_new_downloads_change_the_conversion_key(data_dir):
+    key = twitter.get_conversion_key(output_format='csv', media=True)
+    assert twitter.get_conversion_key(output_format='csv', media=True) == key
+
+    url = 'https://a.example/1.jpg'
+    twitter.MediaStore(twitter.DIR_MEDIA).fetch(url, FakeFetcher({url: b'photo'}))
+
+    assert twitter.get_conversion_key(output_format='csv', media=True) != key
+    assert twitter.get_conversion_key(output_format='csv') == twitter.get_conversion_key(output_format='csv', media=False)
+
+
+def fetch_all(tweets):
+    urls = [url for tweet in tweets for url in twitter.get_media_urls(tweet)]
+    store = twitter.MediaStore(twitter.DIR_MEDIA)
+    fetcher = FakeFetcher({url: url.encode('utf-8') for url in urls})
+    for url in urls:
+        store.fetch(url, fetcher)
+    return store
+
+
+def test_read_twitter_data_with_media(data_dir, tmp_path):
+    tweets = list(benchmark.generate_history(30))
+    filename = str(tmp_path / 'data.json')
+    twitter.write_twitter_data(benchmark.generate_profile(), tweets, filename, 'json')
+    store = fetch_all(tweets[:10])
+
+    _, read = twitter.read_twitter_data(filename, media=twitter.MediaStore(twitter.DIR_MEDIA))
+
+    for tweet, original in zip(read, tweets):
+        urls = twitter.get_media_urls(original) if original in tweets[:10] else []
+        assert tweet['media'] == store.get_paths(urls, str(tmp_path))
+        for path in tweet['media']:
+            with open(tmp_path / path, 'rb') as fp:
+                assert fp.read() in {url.encode('utf-8') for url in urls}
+    assert 'media' not in next(twitter.read_twitter_data(filename)[1])
+
+
+def test_query_export_lists_media(data_dir, tmp_path):
+    tweets = list(benchmark.generate_history(30))
+    write_snapshot(data_dir, 'alice', '2020-05-01_1200', tweets)
+    fetch_all(tweets)
+    archive_file = str(tmp_path / 'archive.sqlite')
+    twitter.archive_data_files(data_dir, archive_file)
+    csv_file = str(tmp_path / 'query.csv')
+
+    twitter.query_archive_to_excel(archive_file, csv_file, {}, media=True)
+
+    with open(csv_file, newline='') as fp:
+        rows = list(csv.reader(fp))
+    assert rows[0][-1] == 'media'
+    listed = [row[-1] for row in rows[1:] if row[-1]]
+    assert len(listed) == sum(len(twitter.get_media_urls(tweet)) for tweet in tweets)
+    assert all(os.path.isfile(tmp_path / path) for path in listed)
@@ -0,0 +1,69 @@
+import datetime
+import types
+
+import pytest
+
+import benchmark
+import twitter
+from test_download import read_tweet_ids, write_snapshot
+
+
+@pytest.fixture
+def polls(fake_scraper, monkeypatch):
+    """
+    Each poll finds 10 new tweets (the history grows at the top) and the
+    clock advances by 10 minutes, so every snapshot gets its own directory
+    """
+
+    history = list(benchmark.generate_history(60))
+    clock = [datetime.datetime(2020, 5, 1, 12, 0)]
+    num_polls = [0]
+
+    class FakeDateTime(datetime.datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return clock[0]
+
+    fake_datetime = types.SimpleNamespace(**{key: getattr(datetime, key) for key in dir(datetime) if not key.startswith('_')})
+    fake_datetime.datetime = FakeDateTime
+    monkeypatch.setattr(twitter, 'datetime', fake_datetime)
+
+    def get_tweets(query, pages=25):
+        num_polls[0] += 1
+        clock[0] += datetime.timedelta(minutes=10)
+        for tweet in history[max(0, 40 - 10*num_polls[0]):]:
+            yield dict(tweet, time=datetime.datetime.fromisoformat(tweet['time']))
+
+    monkeypatch.setattr(fake_scraper, 'get_tweets', get_tweets)
+    return history
+
+
+def watch(data_dir, num_polls):
+    return twitter.watch_accounts(
+        ['alice'], pages=5, state_file=f'{data_dir}/.watch.json', min_interval=0, max_interval=0, max_polls=num_polls,
+    )
+
+
+def test_watch_keeps_one_snapshot_per_account(data_dir, polls):
+    accounts = watch(data_dir, 3)
+
+    snapshots = twitter.load_catalog().snapshots('alice')
+    assert len(snapshots) == 1
+    assert accounts['alice']['snapshot'] == snapshots[0]['path']
+    assert read_tweet_ids(snapshots[0]['path']) == [tweet['tweetId'] for tweet in polls[10:]]
+
+    # A restarted watch continues with the same snapshot
+    watch(data_dir, 1)
+    (snapshot,) = twitter.load_catalog().snapshots('alice')
+    assert read_tweet_ids(snapshot['path']) == [tweet['tweetId'] for tweet in polls]
+
+
+def test_watch_keeps_snapshots_of_other_modes(data_dir, polls):
+    downloaded = write_snapshot(data_dir, 'alice', '2020-04-30_1200', polls[50:])
+
+    watch(data_dir, 2)
+
+    paths = [entry['path'] for entry in twitter.load_catalog().snapshots('alice')]
+    assert len(paths) == 2
+    assert paths[0] == downloaded
+    assert read_tweet_ids(paths[1]) == [tweet['tweetId'] for tweet in polls[20:]]
@@ -18,17 +18,46 @@ License: MIT
                 ||     ||
 """
 
-from collections import Counter, OrderedDict
-from functools import partial
+from array import array
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait as wait_futures
+from contextlib import contextmanager
+from functools import lru_cache, partial, wraps
 from importlib import import_module
+from importlib.util import find_spec
+from itertools import chain, islice, repeat
+from operator import contains
 from pathlib import Path
+from urllib.parse import quote, urlsplit
 import argparse
+import base64
+import cProfile
+import csv
 import datetime
+import gzip
+import hashlib
+import heapq
 import json
 import logging
+import mimetypes
+import mmap
 import os
+import random
 import re
+import shutil
+import signal
+import sqlite3
 import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import zlib
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
 
 logging.basicConfig(
     level=logging.INFO,
@@ -38,13 +67,6 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-COUNT = 0
-def get_unique_id():
-    """Return a unique number as string from a global counter"""
-    global COUNT
-    return (COUNT := COUNT + 1)
-
-
 def truncate_filepath(filepath, max_len=50, basename_only=False):
     """
     Truncate a long filepath --> '.../long/path.txt'
@@ -71,60 +93,593 @@ def truncate_filepath(filepath, max_len=50, basename_only=False):
     return prefix + pathname
 
 
-def import_module_by_name(module_name):
+class LazyModule:
+    """
+    Placeholder for a module which is imported on first use
+
+    Importing 'twitter_scraper' and 'openpyxl' takes a considerable part of
+    the start-up time, but not every mode needs them (e.g. '--help' or 'xl').
+    Attribute access imports the module, a missing module raises 'ImportError'.
+    """
+
+    def __init__(self, module_name):
+        object.__setattr__(self, '_module_name', module_name)
+        object.__setattr__(self, '_module', None)
+
+    def _load(self):
+        if self._module is None:
+            try:
+                module = import_module(self._module_name)
+            except ModuleNotFoundError:
+                raise ImportError(f"Module {self._module_name!r} not found. Please install the module.") from None
+            object.__setattr__(self, '_module', module)
+        return self._module
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._load(), name, value)
+
+    def __repr__(self):
+        state = 'loaded' if self._module is not None else 'not loaded'
+        return f"<LazyModule {self._module_name!r} ({state})>"
+
+
+# ----- Import non-standard libraries -----
+xl = LazyModule("openpyxl")
+tw = LazyModule("twitter_scraper")
+np = LazyModule("numpy")
+
+# Non-standard libraries needed by each mode (checked in 'cli()', see 'get_mode_dependencies()')
+MODE_DEPENDENCIES = {
+    'down': ('twitter_scraper', 'numpy', 'openpyxl'),
+    'watch': ('twitter_scraper', 'numpy'),
+    'xl': ('numpy', 'openpyxl'),
+    'ls': (),
+    'migrate': (),
+    'diff': ('numpy', 'openpyxl'),
+    'summary': ('numpy', 'openpyxl'),
+    'archive': (),
+    'query': ('numpy', 'openpyxl'),
+}
+
+
+def get_mode_dependencies(args):
     """
-    Import a module from a string representation
+    Return the non-standard libraries needed by the command line arguments
+
+    'openpyxl' is only needed if an Excel file is written (not for CSV or TSV
+    output, nor for 'down --no-excel'), 'requests' for media downloads (not for
+    'query --media', which only lists downloaded files).
 
     Args:
-        :module_name: (str) name of the module
+        :args: (obj) parsed arguments ('argparse.Namespace')
 
     Returns:
-        :module: (obj) loaded module (or None in case of error)
+        :module_names: (tuple) names of the required modules
     """
 
-    try:
-        module = import_module(module_name)
-    except ModuleNotFoundError:
-        logger.error(f"Module {module_name!r} not found. Please install the module.")
-        return None
-    else:
-        return module
+    dependencies = MODE_DEPENDENCIES.get(args.exec_mode, ())
+    output_format = getattr(args, 'output_format', None)
+    if output_format is None and getattr(args, 'output', None) is not None:
+        output_format = get_export_format(args.output)
+    if getattr(args, 'no_excel', False) or output_format not in (None, 'xlsx'):
+        dependencies = tuple(module_name for module_name in dependencies if module_name != 'openpyxl')
+    # Mode 'query' only lists media files, it does not download them
+    if getattr(args, 'media', False) and args.exec_mode != 'query' and 'twitter_scraper' not in dependencies:
+        dependencies += ('requests',)
+    return dependencies
 
 
-error = False
-# ----- Import non-standard libraries -----
-xl = import_module_by_name("openpyxl")
-tw = import_module_by_name("twitter_scraper")
-if None in (xl, tw):
-    error = True
+def check_dependencies(module_names):
+    """
+    Check the Python version and that non-standard libraries are installed
+
+    The modules are only located, not imported (see 'LazyModule').
+
+    Args:
+        :module_names: (iter) names of the required modules
+
+    Returns:
+        :ok: (bool) True if all requirements are met
+    """
+
+    ok = True
+    for module_name in module_names:
+        if module_name not in sys.modules and find_spec(module_name) is None:
+            logger.error(f"Module {module_name!r} not found. Please install the module.")
+            ok = False
+
+    # ----- Only support Python 3.8.x -----
+    if not (sys.version_info[0] == 3 and sys.version_info[1] >= 8):
+        logger.error("Python version 3.8.0 or higher is needed.")
+        ok = False
 
-# ----- Only support Python 3.8.x -----
-PY_VERSION = sys.version_info
-if not (PY_VERSION[0] == 3 and PY_VERSION[1] >= 8):
-    logger.error("Python version 3.8.0 or higher is needed.")
-    error = True
+    return ok
 
-if error:
-    sys.exit(1)
 
 PROG_NAME = 'TwitterHistory'
+VERSION = '0.3.0'  # Part of the conversion key (see 'get_conversion_key()'), raise it when the output files change
 HERE = os.path.abspath(os.path.dirname(__file__))
 DIR_DATA = os.path.join(HERE, 'data')
+FILE_ARCHIVE = os.path.join(DIR_DATA, 'archive.sqlite')
+DIR_CACHE = os.path.join(HERE, '.cache')
+FILE_WATCH_STATE = os.path.join(DIR_DATA, '.watch.json')  # Hidden, so that it is not taken for a data file
+DIR_MEDIA = os.path.join(DIR_DATA, 'media')
+
+EPOCH = datetime.datetime(1970, 1, 1)
+SECONDS_PER_DAY = 86400
+ACTIVITY_GRANULARITIES = ('hour', 'day', 'week', 'month', 'heatmap')
+WEEKDAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+FILTER_OPERATORS = ('AND', 'OR', 'NOT')
+FILTER_CHUNK_SIZE = 10000  # Number of tweets whose texts are searched for keywords at once
+
+# ----- Storage formats -----
+# Format name and file suffix, the data file of a snapshot is named 'data<suffix>'
+STORAGE_FORMATS = OrderedDict([
+    ('json', '.json'),
+    ('jsonl', '.jsonl'),
+    ('jsonl.gz', '.jsonl.gz'),
+])
+DATA_SUFFIXES = ('.jsonl.gz', '.jsonl', '.json')  # Longest suffix first
+GZIP_COMPRESSLEVEL = 6
+JSONL_BATCH_SIZE = 1000  # Number of lines parsed at once
+
+# ----- Download journal -----
+JOURNAL_FILENAME = 'data.jsonl.part'
+CHECKPOINT_INTERVAL = 100  # Number of tweets between two syncs to disk
+INCREMENTAL_KNOWN_RUN = 10  # Consecutive known tweets which end an incremental download (pinned tweets are known, too)
+
+# ----- Fetcher -----
+TWITTER_URL = 'https://twitter.com'
+FETCH_RATE = 2.0  # Maximum number of requests per second (all downloads together)
+FETCH_MIN_RATE = 0.05  # The rate is never reduced below this value
+FETCH_BURST = 5  # Number of requests which may be sent at once
+FETCH_RETRIES = 5
+FETCH_RETRY_STATUS = (429, 500, 502, 503, 504)
+FETCH_BACKOFF = 1.0  # Base delay (seconds) of the exponential backoff
+FETCH_MAX_BACKOFF = 120.0
+FETCH_TIMEOUT = 30.0
+FETCH_MODULES = ('twitter_scraper.modules.tweets', 'twitter_scraper.modules.profile')
+
+# ----- Sharded download -----
+# 'twitter_scraper' only uses the search path for queries starting with '#',
+# the fetcher removes this prefix again (see 'Fetcher.search_tweets()')
+SEARCH_PREFIX = '#search:'
+SHARD_JOBS = 4  # Maximum number of date windows of one account downloaded at once
+
+# ----- Response cache -----
+# Seconds until a cached response expires (profile pages and timeline pages)
+CACHE_TTL = OrderedDict((
+    ('profile', 6*3600),
+    ('timeline', 15*60),
+))
+CACHE_MAX_SIZE = 256*2**20  # Bytes, least recently used responses are removed beyond this size
+
+# ----- Watch -----
+WATCH_MIN_INTERVAL = 5*60  # Seconds between two polls of the most active accounts
+WATCH_MAX_INTERVAL = 24*3600  # Seconds between two polls of quiet accounts
+WATCH_TWEETS_PER_POLL = 10  # Expected number of new tweets between two polls
+WATCH_RATE_DAYS = 30  # The tweet rate is computed from the most recent days
+WATCH_TICK = 1.0  # Seconds between two checks for shutdown
+
+# ----- Media -----
+MEDIA_JOBS = 8  # Maximum number of concurrent media downloads (all accounts together)
+MEDIA_RATE = 10.0  # Maximum number of media requests per second
+MEDIA_ATTEMPTS = 3  # Number of times an interrupted media download is continued
+MEDIA_CHUNK_SIZE = 1 << 16
+MEDIA_INDEX_FILENAME = '.index.jsonl'  # Hidden, so that it is not taken for a data file
+
+# ----- External sort -----
+SORT_MEMORY_BUDGET = 512*2**20  # Bytes, larger histories are sorted on disk
+SORT_TWEET_SIZE = 1700  # Approximate memory of a parsed tweet in bytes (without its text)
+SORT_RECORD_SIZE = 100  # Approximate memory of a tweet in a sort run in bytes (without its JSON line)
+SORT_MERGE_WIDTH = 64  # Maximum number of runs merged at once
+
+# ----- Column cache -----
+COLUMN_CACHE_DIRNAME = '.columns'  # Memory-mapped columns of the data file, next to the data file
+COLUMN_CACHE_VERSION = 3
+COLUMN_STRINGS = ('time', 'text', 'hashtags', 'media_urls')  # Fields of each tweet in the string blob
+COLUMN_CHUNK_SIZE = 10000  # Number of tweets read from the columns at once
+
+# ----- Export formats -----
+# Format name and file suffix of the converted files ('csv' and 'tsv' write one file per sheet)
+EXPORT_FORMATS = OrderedDict([
+    ('xlsx', '.xlsx'),
+    ('csv', '.csv'),
+    ('csv.gz', '.csv.gz'),
+    ('tsv', '.tsv'),
+    ('tsv.gz', '.tsv.gz'),
+])
+
+# ----- Conversion cache -----
+XL_CACHE_FILENAME = '.xlcache'  # One manifest (JSON) per data directory
+
+# ----- Snapshot catalog -----
+CATALOG_FILENAME = '.catalog.json'  # Index of all snapshots in the data directory
+CATALOG_VERSION = 1
+
+# ----- Summary sketches -----
+# Approximate statistics in bounded memory, sketches of snapshots can be merged (see 'TweetSummary')
+SKETCH_VERSION = 1
+SKETCH_WIDTH = 4096  # Counters per row of the Count-Min sketches
+SKETCH_DEPTH = 4  # Rows (hash functions) of the Count-Min sketches
+SKETCH_CAPACITY = 500  # Candidates kept for the top hashtags and keywords (Space-Saving)
+SKETCH_PRECISION = 14  # HyperLogLog registers: 2**SKETCH_PRECISION (standard error about 0.8%)
+SKETCH_TOP_TWEETS = 20  # Tweets with the most likes (retweets)
+SKETCH_SAMPLE_SIZE = 50  # Tweets in the random sample
+SKETCH_SEED = 0
+SKETCH_BATCH_SIZE = 10000  # Tweets counted at once, each distinct word of a batch is hashed once
+SUMMARY_TOP_ITEMS = 25  # Hashtags and keywords listed in the summary sheet
+SUMMARY_CACHE_FILENAME = '.summary.json'  # Sketches of a snapshot, next to the data file
+SUMMARY_SKIP_PREFIXES = ('http://', 'https://', '#', '@')  # Links, hashtags and mentions are no keywords
+SUMMARY_WORD_PATTERN = re.compile(r"[^\W\d_]{3,}")
+SUMMARY_STOPWORDS = frozenset('''
+    about after again all also and any are because been before being but can could did does doing down
+    during each few for from further had has have having her here hers herself him himself his how into
+    its itself just more most nor not now off once only other our ours out over own same she should some
+    such than that the their theirs them then there these they this those through too under until very
+    was were what when where which while who whom why will with would you your yours yourself
+'''.split())
 
 # ----- Excel font and cell colours -----
-XL_FILL_GREEN = xl.styles.PatternFill(
-    start_color='A0D6B4',
-    end_color='A0D6B4',
-    fill_type='solid',
-)
+# Style descriptions, the 'openpyxl' objects are created on first use (see 'get_xl_style()')
+XL_FILL_GREEN = ('fill', 'A0D6B4')
+XL_FILL_RED = ('fill', 'FFBABA')
+XL_FONT_BOLD = ('font', 'bold')
+XL_MAX_TITLE_LENGTH = 31  # Longer sheet titles are not valid in Excel
 
-XL_FILL_RED = xl.styles.PatternFill(
-    start_color='FFBABA',
-    end_color='FFBABA',
-    fill_type='solid',
-)
 
-XL_FONT_BOLD = xl.styles.Font(bold=True)
+# ----- Metrics -----
+class Metrics:
+    """
+    Timers and counters of a run (see option '--profile')
+
+    Nothing is collected unless the metrics are enabled with 'reset()', so
+    the instrumentation costs (almost) nothing in a normal run. All methods
+    are thread-safe.
+
+    Attributes:
+        :timers: (dict) stage as key and [calls, seconds, max. seconds] as value
+        :counters: (dict) (name, labels) as key and count as value
+        :samples: (dict) name as key and list of observed values as value
+        :profiler: (obj) 'cProfile.Profile' for the hot functions (or None)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._profile_lock = threading.Lock()
+        self.reset(enabled=False)
+
+    def reset(self, enabled=True, profiler=None):
+        """
+        Remove all data and enable (or disable) collecting
+
+        Args:
+            :enabled: (bool) if True, collect metrics
+            :profiler: (obj) optional 'cProfile.Profile', enabled while hot functions run
+        """
+
+        self.enabled = enabled
+        self.profiler = profiler
+        self.start = time.time()
+        self.timers = OrderedDict()
+        self.counters = OrderedDict()
+        self.samples = OrderedDict()
+
+    def add_time(self, stage, seconds, calls=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            timer = self.timers.setdefault(stage, [0, 0.0, 0.0])
+            timer[0] += calls
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+
+    @contextmanager
+    def timer(self, stage):
+        """Context manager, the time spent inside is added to 'stage'"""
+
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+
+    @contextmanager
+    def profiling(self):
+        """Context manager, profile the code inside with 'profiler' (one thread at a time)"""
+
+        # Nested hot functions, or other threads, are covered by the active profiler
+        if self.profiler is None or not self._profile_lock.acquire(blocking=False):
+            yield
+            return
+        self.profiler.enable()
+        try:
+            yield
+        finally:
+            self.profiler.disable()
+            self._profile_lock.release()
+
+    def timed_iter(self, stage, iterable):
+        """
+        Yield the items of 'iterable', the time spent waiting for each item is added to 'stage'
+
+        Args:
+            :stage: (str) stage name
+            :iterable: (iter) e.g. a generator which fetches data from the network
+        """
+
+        if not self.enabled:
+            yield from iterable
+            return
+
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_time(stage, time.perf_counter() - start, calls=0)
+                return
+            self.add_time(stage, time.perf_counter() - start)
+            yield item
+
+    def count(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.samples.setdefault(name, []).append(value)
+
+    def state(self):
+        """Return all collected data (e.g. to send it from a worker process)"""
+
+        with self._lock:
+            return {
+                'timers': [(stage, list(timer)) for stage, timer in self.timers.items()],
+                'counters': list(self.counters.items()),
+                'samples': [(name, list(values)) for name, values in self.samples.items()],
+            }
+
+    def merge(self, state):
+        """Add data from 'state()' of another 'Metrics' object"""
+
+        for stage, (calls, seconds, max_seconds) in state['timers']:
+            self.add_time(stage, seconds, calls=calls)
+            self.timers[stage][2] = max(self.timers[stage][2], max_seconds)
+        for (name, labels), value in state['counters']:
+            self.count(name, value, **dict(labels))
+        for name, values in state['samples']:
+            for value in values:
+                self.observe(name, value)
+
+    def report(self):
+        """
+        Return all metrics as a dictionary
+
+        Returns:
+            :report: (dict) 'meta', 'stages', 'counters', 'samples' and 'rates'
+        """
+
+        def summary(values):
+            values = np.sort(np.asarray(values, dtype=float))
+            return OrderedDict((
+                ('count', int(values.size)),
+                ('sum', round(float(values.sum()), 6)),
+                ('min', round(float(values[0]), 6)),
+                ('max', round(float(values[-1]), 6)),
+                *((f'p{q}', round(float(np.percentile(values, q)), 6)) for q in (50, 90, 99)),
+            ))
+
+        with self._lock:
+            stages = OrderedDict(
+                (stage, OrderedDict((('calls', calls), ('seconds', round(seconds, 6)), ('max_seconds', round(max_seconds, 6)))))
+                for stage, (calls, seconds, max_seconds) in self.timers.items()
+            )
+            counters = OrderedDict((_format_metric_key(name, labels), value) for (name, labels), value in self.counters.items())
+            samples = OrderedDict((name, summary(values)) for name, values in self.samples.items() if values)
+
+        rates = OrderedDict()
+        num_tweets = counters.get('tweets_downloaded', 0)
+        if num_tweets and stages.get('download.fetch', {}).get('seconds'):
+            rates['tweets_per_second'] = round(num_tweets/stages['download.fetch']['seconds'], 3)
+
+        meta = OrderedDict((
+            ('prog', PROG_NAME),
+            ('version', VERSION),
+            ('argv', sys.argv[1:]),
+            ('start', datetime.datetime.fromtimestamp(self.start).isoformat(timespec='seconds')),
+            ('wall_seconds', round(time.time() - self.start, 6)),
+            ('peak_rss_bytes', get_peak_rss()),
+            ('peak_rss_children_bytes', get_peak_rss(children=True)),
+        ))
+        return OrderedDict((('meta', meta), ('stages', stages), ('counters', counters), ('samples', samples), ('rates', rates)))
+
+    def write(self, filename):
+        """
+        Write a report, JSON if 'filename' ends with '.json', otherwise Prometheus text format
+
+        Args:
+            :filename: (str) path of the report
+        """
+
+        report = self.report()
+        with open(filename, 'w') as fp:
+            if filename.endswith('.json'):
+                json.dump(report, fp, indent=4)
+                fp.write('\n')
+            else:
+                fp.write(_format_prometheus(report))
+
+
+def _format_metric_key(name, labels):
+    """Return a metric name with labels ('name{key="value"}')"""
+
+    if not labels:
+        return name
+    def escape(value):
+        return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+    return name + '{' + ','.join(f'{key}="{escape(value)}"' for key, value in labels) + '}'
+
+
+def _format_prometheus(report):
+    """
+    Return a metrics report in the Prometheus text format (for the 'textfile' collector)
+
+    Args:
+        :report: (dict) see 'Metrics.report()'
+
+    Returns:
+        :text: (str) metrics
+    """
+
+    prefix = PROG_NAME.lower()
+    lines = []
+
+    def metric(name, kind, help_text, values):
+        lines.append(f'# HELP {prefix}_{name} {help_text}')
+        lines.append(f'# TYPE {prefix}_{name} {kind}')
+        for key, value in values:
+            lines.append(f'{prefix}_{key} {value}')
+
+    stages = report['stages']
+    metric('stage_seconds_total', 'counter', 'Time spent in each stage',
+           ((_format_metric_key('stage_seconds_total', (('stage', stage),)), s['seconds']) for stage, s in stages.items()))
+    metric('stage_calls_total', 'counter', 'Number of calls of each stage',
+           ((_format_metric_key('stage_calls_total', (('stage', stage),)), s['calls']) for stage, s in stages.items()))
+
+    names = OrderedDict()
+    for key, value in report['counters'].items():
+        name, _, labels = key.partition('{')
+        names.setdefault(name, []).append((f'{name}_total' + ('{' + labels if labels else ''), value))
+    for name, values in names.items():
+        metric(f'{name}_total', 'counter', name.replace('_', ' ').capitalize(), values)
+
+    for name, summary in report['samples'].items():
+        values = [(_format_metric_key(name, (('quantile', q/100),)), summary[f'p{q}']) for q in (50, 90, 99)]
+        values += [(f'{name}_sum', summary['sum']), (f'{name}_count', summary['count'])]
+        metric(name, 'summary', name.replace('_', ' ').capitalize(), values)
+
+    for name, value in report['rates'].items():
+        metric(name, 'gauge', name.replace('_', ' ').capitalize(), ((name, value),))
+    metric('wall_seconds', 'gauge', 'Duration of the run', (('wall_seconds', report['meta']['wall_seconds']),))
+    if report['meta']['peak_rss_bytes'] is not None:
+        metric('peak_rss_bytes', 'gauge', 'Peak resident set size', (('peak_rss_bytes', report['meta']['peak_rss_bytes']),))
+
+    return '\n'.join(lines) + '\n'
+
+
+def get_peak_rss(children=False):
+    """
+    Return the peak resident set size (RSS) of this process (or of its terminated child processes)
+
+    Args:
+        :children: (bool) if True, return the peak RSS of child processes
+
+    Returns:
+        :peak_rss: (int) bytes (or None if not available, e.g. on Windows)
+    """
+
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    # Linux reports kilobytes, macOS reports bytes
+    return usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss*1024
+
+
+def instrument(stage):
+    """
+    Decorator, the time of each call is added to 'stage' (see 'Metrics')
+
+    With option '--cprofile', decorated functions are also profiled.
+
+    Args:
+        :stage: (str) stage name
+    """
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not METRICS.enabled:
+                return func(*args, **kwargs)
+            with METRICS.timer(stage), METRICS.profiling():
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _record_response(response, *args, **kwargs):
+    """Response hook for 'requests', records latency and size of each page"""
+
+    METRICS.count('pages_fetched')
+    METRICS.observe('page_fetch_seconds', response.elapsed.total_seconds())
+    METRICS.count('bytes_received', len(response.content))
+    return response
+
+
+def install_fetch_hooks():
+    """Record each request of 'twitter_scraper' (the modules share a 'requests' session)"""
+
+    tw._load()  # The sessions only exist once 'twitter_scraper' is imported
+    for module_name in FETCH_MODULES:
+        session = getattr(sys.modules.get(module_name), 'session', None)
+        hooks = getattr(session, 'hooks', {}).get('response')
+        if hooks is not None and _record_response not in hooks:
+            hooks.append(_record_response)
+
+
+@contextmanager
+def profile_run(args):
+    """
+    Context manager, collect metrics and write the reports selected on the command line
+
+    Args:
+        :args: (obj) parsed command line arguments ('profile', 'cprofile', 'tracemalloc')
+    """
+
+    profile_file = getattr(args, 'profile', None)
+    cprofile_file = getattr(args, 'cprofile', None)
+    tracemalloc_file = getattr(args, 'tracemalloc', None)
+    if not (profile_file or cprofile_file or tracemalloc_file):
+        yield
+        return
+
+    METRICS.reset(enabled=True, profiler=cProfile.Profile() if cprofile_file else None)
+    if tracemalloc_file:
+        tracemalloc.start()
+
+    try:
+        yield
+    finally:
+        if profile_file:
+            METRICS.write(profile_file)
+            logger.info(f"Metrics saved: {truncate_filepath(profile_file)}")
+        if cprofile_file:
+            METRICS.profiler.dump_stats(cprofile_file)
+            logger.info(f"Profile of hot functions saved: {truncate_filepath(cprofile_file)} (see module 'pstats')")
+        if tracemalloc_file:
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            snapshot.dump(tracemalloc_file)
+            logger.info(f"Memory snapshot saved: {truncate_filepath(tracemalloc_file)} (peak {peak/2**20:.1f} MB)")
+            for stat in snapshot.filter_traces([tracemalloc.Filter(True, __file__)]).statistics('lineno')[:5]:
+                logger.info(f"Memory: {stat}")
+
+
+METRICS = Metrics()
 
 
 # ----- JSON -----
@@ -185,61 +740,399 @@ def cli():
         'help': 'filter tweets by #hashtag or keyword (text and hashtags)',
     }
 
+    # Activity argument applies to mode 'xl' and mode 'down'
+    activity_args = ['--activity', '-a']
+    activity_kwargs = {
+        'metavar': 'GRANULARITY',
+        'nargs': '+',
+        'choices': ACTIVITY_GRANULARITIES,
+        'help': f"add activity sheets ({', '.join(ACTIVITY_GRANULARITIES)})",
+    }
+
+    # Excel engine argument applies to mode 'xl' and mode 'down'
+    engine_args = ['--excel-engine']
+    engine_kwargs = {
+        'choices': list(XL_ENGINES),
+        'default': 'stream',
+        'help': "'stream' writes rows directly to disk (low memory), 'standard' keeps the workbook in memory",
+    }
+
+    # Memory budget argument applies to mode 'xl', mode 'down' and mode 'query'
+    budget_args = ['--memory-budget']
+    budget_kwargs = {
+        'metavar': 'MB',
+        'type': float,
+        'default': SORT_MEMORY_BUDGET/2**20,
+        'help': f'larger histories are sorted on disk when converting (default: {SORT_MEMORY_BUDGET//2**20})',
+    }
+
+    # Output format argument applies to mode 'xl' and mode 'down'
+    output_format_args = ['--output-format']
+    output_format_kwargs = {
+        'choices': list(EXPORT_FORMATS),
+        'default': 'xlsx',
+        'help': "format of the converted files ('csv' and 'tsv' write one file per sheet, '.gz' compressed)",
+    }
+
+    # Column cache argument applies to mode 'xl', mode 'down', mode 'diff' and mode 'summary'
+    column_cache_args = ['--no-column-cache']
+    column_cache_kwargs = {
+        'action': 'store_true',
+        'help': f"do not read or create the memory-mapped columns of the data files ('{COLUMN_CACHE_DIRNAME}' folders)",
+    }
+
+    # Media arguments apply to mode 'xl' and mode 'down'
+    media_args = ['--media']
+    media_kwargs = {
+        'action': 'store_true',
+        'help': "download photos and videos to 'data/media' and list the files in the sheets",
+    }
+    media_jobs_args = ['--media-jobs']
+    media_jobs_kwargs = {
+        'metavar': 'N',
+        'type': int,
+        'default': MEDIA_JOBS,
+        'help': f'number of concurrent media downloads (default: {MEDIA_JOBS})',
+    }
+
+    # Summary argument applies to mode 'xl' and mode 'down'
+    summary_args = ['--summary']
+    summary_kwargs = {
+        'action': 'store_true',
+        'help': 'add a sheet with approximate top hashtags, keywords and tweets (see mode summary)',
+    }
+
+    # Storage format argument applies to mode 'down' and mode 'migrate'
+    format_args = ['--format']
+    format_kwargs = {
+        'dest': 'storage',
+        'choices': list(STORAGE_FORMATS),
+        'help': "storage format of the data files ('json' is pretty-printed, 'jsonl' has one tweet per line)",
+    }
+
     # ----- Mode 'down' -----
     sub = subparsers.add_parser('down', help='download target twitter feed')
     sub.add_argument('usernames', metavar='NAMES', nargs='+', type=str, help='target twitter profile')
     sub.add_argument('--pages', '-p', metavar='PAGES', type=int, help='number of pages to fetch', default=200)
     sub.add_argument('--no-excel', action='store_true', help='do not convert data to exel file')
+    sub.add_argument('--jobs', '-j', metavar='N', type=int, help='number of accounts to download concurrently', default=1)
+    sub.add_argument('--incremental', '-i', action='store_true', help='only fetch tweets newer than the latest snapshot and merge')
+    sub.add_argument('--since', metavar='YYYY-MM-DD', type=datetime.date.fromisoformat, help='first day (required with --shards)')
+    sub.add_argument('--until', metavar='YYYY-MM-DD', type=datetime.date.fromisoformat, help='last day (default: today)')
+    sub.add_argument('--shards', metavar='N', type=int, help='split the period into N date windows downloaded concurrently (search queries, --pages per window)', default=1)
+    sub.add_argument(*format_args, **format_kwargs, default='json')
     sub.add_argument(*filter_args, **filter_kwargs)
+    sub.add_argument(*activity_args, **activity_kwargs)
+    sub.add_argument(*engine_args, **engine_kwargs)
+    sub.add_argument(*output_format_args, **output_format_kwargs)
+    sub.add_argument(*budget_args, **budget_kwargs)
+    sub.add_argument(*column_cache_args, **column_cache_kwargs)
+    sub.add_argument(*media_args, **media_kwargs)
+    sub.add_argument(*media_jobs_args, **media_jobs_kwargs)
+    sub.add_argument(*summary_args, **summary_kwargs)
+
+    # ----- Mode 'watch' -----
+    sub = subparsers.add_parser('watch', help='poll twitter feeds for new tweets (runs until stopped)')
+    sub.add_argument('usernames', metavar='NAMES', nargs='+', type=str, help='target twitter profiles')
+    sub.add_argument('--pages', '-p', metavar='PAGES', type=int, help='maximum number of pages per poll', default=200)
+    sub.add_argument('--jobs', '-j', metavar='N', type=int, help='maximum number of concurrent polls', default=1)
+    sub.add_argument('--min-interval', metavar='MINUTES', type=float, help=f'minimum time between two polls of an account (default: {WATCH_MIN_INTERVAL//60})', default=WATCH_MIN_INTERVAL/60)
+    sub.add_argument('--max-interval', metavar='MINUTES', type=float, help=f'maximum time between two polls of an account (default: {WATCH_MAX_INTERVAL//60})', default=WATCH_MAX_INTERVAL/60)
+    sub.add_argument('--state', metavar='FILE', help='schedule file (default: data/.watch.json)', default=FILE_WATCH_STATE)
+    sub.add_argument(*format_args, **format_kwargs, default='json')
+
+    # Fetcher arguments apply to mode 'down' and mode 'watch'
+    for sub in (subparsers.choices['down'], subparsers.choices['watch']):
+        sub.add_argument('--rate', metavar='N', type=float, help=f'maximum number of requests per second (default: {FETCH_RATE})', default=FETCH_RATE)
+        sub.add_argument('--retries', metavar='N', type=int, help=f'number of retries of a failed request (default: {FETCH_RETRIES})', default=FETCH_RETRIES)
+        sub.add_argument('--base-url', metavar='URL', help=f'send requests to this server instead of {TWITTER_URL} (e.g. a local test server)')
+        sub.add_argument('--no-cache', action='store_true', help='do not use or store cached responses')
+        sub.add_argument('--refresh', action='store_true', help='do not use cached responses, but store new ones')
 
     # ----- Mode 'xl' -----
     sub = subparsers.add_parser('xl', help='convert data to excel spreadsheet')
     sub.add_argument("path", metavar='FILE or DIRECTORY', help="data to convert", type=str)
+    sub.add_argument('--jobs', '-j', metavar='N', type=int, help='number of files to convert in parallel', default=1)
+    sub.add_argument('--force', action='store_true', help='convert all files, even if the Excel files are up to date')
     sub.add_argument(*filter_args, **filter_kwargs)
+    sub.add_argument(*activity_args, **activity_kwargs)
+    sub.add_argument(*engine_args, **engine_kwargs)
+    sub.add_argument(*output_format_args, **output_format_kwargs)
+    sub.add_argument(*budget_args, **budget_kwargs)
+    sub.add_argument(*column_cache_args, **column_cache_kwargs)
+    sub.add_argument(*media_args, **media_kwargs)
+    sub.add_argument(*media_jobs_args, **media_jobs_kwargs)
+    sub.add_argument(*summary_args, **summary_kwargs)
+
+    # ----- Mode 'ls' -----
+    sub = subparsers.add_parser('ls', help='list downloaded snapshots (from the snapshot catalog)')
+    sub.add_argument('usernames', metavar='NAMES', nargs='*', type=str, help='only snapshots of these accounts')
+    sub.add_argument('--latest', action='store_true', help='only the latest snapshot of each account')
+    sub.add_argument('--rebuild', action='store_true', help='read all data files again and rebuild the catalog')
+    sub.add_argument('--json', action='store_true', help='print the catalog entries as JSON')
+
+    # ----- Mode 'migrate' -----
+    sub = subparsers.add_parser('migrate', help='convert stored data to another storage format')
+    sub.add_argument("path", metavar='DIRECTORY', nargs='?', help="data to convert (default: data directory)", type=str, default=DIR_DATA)
+    sub.add_argument(*format_args, **format_kwargs, default='jsonl.gz')
+
+    # ----- Mode 'diff' -----
+    sub = subparsers.add_parser('diff', help='compare engagement (likes, ...) between snapshots')
+    sub.add_argument('paths', metavar='SNAPSHOTS', nargs='+', help='data files, snapshot directories or directories with snapshots')
+    sub.add_argument('--output', '-o', metavar='FILE', default='diff.xlsx', help="output file, '.csv' or '.tsv' for CSV (default: diff.xlsx)")
+    sub.add_argument(*engine_args, **engine_kwargs)
+    sub.add_argument(*column_cache_args, **column_cache_kwargs)
+
+    # ----- Mode 'summary' -----
+    sub = subparsers.add_parser('summary', help='approximate statistics of many snapshots (top hashtags, keywords and tweets)')
+    sub.add_argument('paths', metavar='SNAPSHOTS', nargs='*', help='data files, snapshot directories or directories with snapshots (default: all accounts in the data directory)')
+    sub.add_argument('--all-snapshots', action='store_true', help='merge all snapshots, not only the latest snapshot of each account')
+    sub.add_argument('--output', '-o', metavar='FILE', default='summary.xlsx', help="output file, '.csv' or '.tsv' for CSV (default: summary.xlsx)")
+    sub.add_argument(*engine_args, **engine_kwargs)
+    sub.add_argument(*column_cache_args, **column_cache_kwargs)
+
+    # Archive argument applies to mode 'archive' and mode 'query'
+    archive_args = ['--archive']
+    archive_kwargs = {
+        'metavar': 'FILE',
+        'default': FILE_ARCHIVE,
+        'help': 'SQLite database with all snapshots (default: data/archive.sqlite)',
+    }
+
+    # ----- Mode 'archive' -----
+    sub = subparsers.add_parser('archive', help='add downloaded snapshots to the archive database')
+    sub.add_argument("path", metavar='DIRECTORY', nargs='?', help="data to add (default: data directory)", type=str, default=DIR_DATA)
+    sub.add_argument(*archive_args, **archive_kwargs)
+
+    # ----- Mode 'query' -----
+    sub = subparsers.add_parser('query', help='export tweets from the archive database to excel')
+    sub.add_argument('text', metavar='TEXT', nargs='?', help='full-text search in tweets (e.g. "tesla OR spacex")')
+    sub.add_argument('--user', '-u', metavar='NAMES', nargs='+', help='only tweets of these accounts')
+    sub.add_argument('--hashtag', '-t', metavar='HASHTAGS', nargs='+', help='only tweets with one of these hashtags')
+    sub.add_argument('--since', metavar='YYYY-MM-DD', type=datetime.date.fromisoformat, help='first day')
+    sub.add_argument('--until', metavar='YYYY-MM-DD', type=datetime.date.fromisoformat, help='last day')
+    sub.add_argument('--no-retweets', action='store_true', help='exclude retweets')
+    sub.add_argument('--limit', metavar='N', type=int, help='maximum number of tweets')
+    sub.add_argument('--output', '-o', metavar='FILE', default='query.xlsx', help="excel file to write, '.csv' or '.tsv' for CSV files (default: query.xlsx)")
+    sub.add_argument('--media', action='store_true', help="list the photos and videos which were downloaded before (see 'xl --media')")
+    sub.add_argument(*archive_args, **archive_kwargs)
+    sub.add_argument(*filter_args, **filter_kwargs)
+    sub.add_argument(*activity_args, **activity_kwargs)
+    sub.add_argument(*engine_args, **engine_kwargs)
+    sub.add_argument(*budget_args, **budget_kwargs)
+
+    # Profiling arguments apply to all modes
+    for sub in subparsers.choices.values():
+        sub.add_argument('--profile', metavar='FILE', help="write timers and counters of each stage ('.json' for JSON, otherwise Prometheus text format)")
+        sub.add_argument('--cprofile', metavar='FILE', help='write a cProfile dump of the hot functions (see module pstats)')
+        sub.add_argument('--tracemalloc', metavar='FILE', help='write a tracemalloc snapshot at the end of the run')
 
     args = parser.parse_args()
 
     logger.info(f"----- {PROG_NAME} (mode: {args.exec_mode}) -----")
 
-    # MODE: Download
-    if args.exec_mode == 'down':
-        for username in args.usernames:
-            username = parse_string(username, remove=(' ', ','))  # Remove commas
-            json_file = download_history(username, args.pages)
-            excel_file = json_file.replace('.json', '.xlsx')
-            # Convert data to Excel spreadsheet by default
-            if not args.no_excel:
-                twitter_data = load_twitter_data(json_file)
-                convert_to_excel(twitter_data, excel_file, filters=args.filter)
-
-    # MODE: Convert to Excel
-    elif args.exec_mode == 'xl':
-        if Path(args.path).is_file():
-            if not args.path.endswith('.json'):
-                logger.error(f"{truncate_filepath(args.path)!r} seems to be a file, but not recognized as JSON...")
+    excel_options = {
+        'filters': getattr(args, 'filter', None),
+        'activity': getattr(args, 'activity', None),
+        'engine': getattr(args, 'excel_engine', 'standard'),
+    }
+    if getattr(args, 'media', None) is not None:
+        excel_options['media'] = args.media
+    if getattr(args, 'summary', None) is not None:
+        excel_options['summary'] = args.summary
+    if getattr(args, 'no_column_cache', None) is not None:
+        excel_options['column_cache'] = not args.no_column_cache
+    if getattr(args, 'memory_budget', None) is not None:
+        excel_options['memory_budget'] = int(args.memory_budget*2**20)
+    if getattr(args, 'output_format', None) is not None:
+        excel_options['output_format'] = args.output_format
+
+    if not check_dependencies(get_mode_dependencies(args)):
+        sys.exit(1)
+
+    # Check filter expressions before any work is done
+    for filter_kw in getattr(args, 'filter', None) or ():
+        try:
+            parse_filter_expression(filter_kw)
+        except ValueError as e:
+            logger.error(str(e))
+            sys.exit(1)
+
+    if getattr(args, 'rate', 1) <= 0:
+        logger.error(f"Invalid rate {args.rate} (must be greater than 0)")
+        sys.exit(1)
+
+    if args.exec_mode in ('down', 'watch'):
+        usernames = [parse_string(username, remove=(' ', ',')) for username in args.usernames]  # Remove commas
+        usernames = [username for username in usernames if username]
+
+    with profile_run(args):
+        # MODE: Download
+        if args.exec_mode == 'down':
+            windows = None
+            if args.shards > 1 or args.since is not None or args.until is not None:
+                if args.since is None:
+                    logger.error("Sharded downloads need the first day (--since)")
+                    sys.exit(1)
+                until = args.until or datetime.date.today()
+                try:
+                    windows = get_date_windows(args.since, until + datetime.timedelta(days=1), args.shards)
+                except ValueError as e:
+                    logger.error(str(e))
+                    sys.exit(1)
+            cache = None if args.no_cache else ResponseCache(DIR_CACHE, refresh=args.refresh)
+            results = download_accounts(
+                usernames,
+                args.pages,
+                jobs=args.jobs,
+                incremental=args.incremental,
+                storage=args.storage,
+                excel=not args.no_excel,  # Convert data to Excel spreadsheet by default
+                excel_options=excel_options,
+                fetch_options={'rate': args.rate, 'retries': args.retries, 'base_url': args.base_url, 'cache': cache},
+                windows=windows,
+                media_options={'jobs': args.media_jobs, 'fetch_options': {'retries': args.retries}} if args.media else None,
+            )
+            if not all(results.values()):
+                sys.exit(1)
+
+        # MODE: Poll accounts until stopped
+        elif args.exec_mode == 'watch':
+            if not 0 < args.min_interval <= args.max_interval:
+                logger.error("Invalid interval (0 < min. interval <= max. interval)")
                 sys.exit(1)
-            filenames = (args.path,)
-        elif Path(args.path).is_dir():
-            logger.info("Trying to locate JSON files...")
-            filenames = list(Path(args.path).rglob('*.json'))
-            if not filenames:
-                logger.error(f"No JSON files found in {truncate_filepath(args.path)!r}...")
+            # Timeline pages must be fetched again on every poll, only profiles are taken from the cache
+            cache = None if args.no_cache else ResponseCache(DIR_CACHE, ttl={'timeline': 0}, refresh=args.refresh)
+            stop = threading.Event()
+            signal.signal(signal.SIGTERM, lambda *_: stop.set())
+            watch_accounts(
+                usernames,
+                args.pages,
+                jobs=args.jobs,
+                storage=args.storage,
+                state_file=args.state,
+                min_interval=args.min_interval*60,
+                max_interval=args.max_interval*60,
+                fetch_options={'rate': args.rate, 'retries': args.retries, 'base_url': args.base_url, 'cache': cache},
+                stop=stop,
+            )
+
+        # MODE: Convert to Excel
+        elif args.exec_mode == 'xl':
+            if Path(args.path).is_file():
+                if not args.path.endswith(DATA_SUFFIXES):
+                    logger.error(f"{truncate_filepath(args.path)!r} seems to be a file, but not recognized as twitter data (JSON or JSON Lines)...")
+                    sys.exit(1)
+                filenames = (args.path,)
+            elif Path(args.path).is_dir():
+                logger.info("Trying to locate data files...")
+                if os.path.isdir(DIR_DATA) and os.path.samefile(args.path, DIR_DATA):
+                    filenames = [entry['path'] for entry in load_catalog().snapshots()]
+                    # Data files outside the snapshot folders are not in the catalog
+                    known = {os.path.abspath(filename) for filename in filenames}
+                    others = [
+                        filename for filename in find_data_files(args.path)
+                        if os.path.abspath(filename) not in known
+                    ]
+                    if others:
+                        logger.warning(f"Found {len(others)} data file(s) which are not in a snapshot folder...")
+                    filenames.extend(others)
+                else:
+                    filenames = find_data_files(args.path)
+                if not filenames:
+                    logger.error(f"No data files found in {truncate_filepath(args.path)!r}...")
+                    sys.exit(1)
+                for filename in filenames:
+                    logger.info(f"Found {truncate_filepath(filename)}...")
+            else:
+                logger.error(f"Input {truncate_filepath(args.path)!r} not recognized as file or directory")
                 sys.exit(1)
-            for filename in filenames:
-                logger.info(f"Found {truncate_filepath(filename)}...")
-        else:
-            logger.error(f"Input {truncate_filepath(args.path)!r} not recognized as file or directory")
-            sys.exit(1)
 
-        # Convert JSON to XLSX (Excel files)
-        for filename in filenames:
-            json_file = os.path.abspath(filename)
-            excel_file = json_file.replace('.json', '.xlsx')
-            twitter_data = load_twitter_data(json_file)
-            convert_to_excel(twitter_data, excel_file, filters=args.filter)
+            filenames = [os.path.abspath(filename) for filename in filenames]
+            media_results = {}
+            if args.media:
+                media_results = download_media_files(filenames, jobs=args.media_jobs)
 
-    else:
-        parser.print_help()
+            # Convert JSON to XLSX (Excel files)
+            results = convert_files_to_excel(filenames, jobs=args.jobs, force=args.force, **excel_options)
+            if not all(results.values()) or not all(media_results.values()):
+                sys.exit(1)
+
+        # MODE: List snapshots
+        elif args.exec_mode == 'ls':
+            snapshots = load_catalog(rebuild=args.rebuild).snapshots()
+            if args.usernames:
+                snapshots = [entry for entry in snapshots if entry['username'] in args.usernames]
+            if args.latest:
+                snapshots = list(OrderedDict((entry['username'], entry) for entry in snapshots).values())
+            if args.json:
+                json.dump(snapshots, sys.stdout, indent=2)
+                print()
+            else:
+                print_snapshot_list(snapshots)
+
+        # MODE: Convert storage format
+        elif args.exec_mode == 'migrate':
+            if not Path(args.path).is_dir():
+                logger.error(f"Input {truncate_filepath(args.path)!r} not recognized as directory")
+                sys.exit(1)
+            results = migrate_data_files(args.path, args.storage)
+            if not all(results.values()):
+                sys.exit(1)
+
+        # MODE: Compare snapshots
+        elif args.exec_mode == 'diff':
+            try:
+                diff_snapshots(args.paths, args.output, engine=args.excel_engine, column_cache=not args.no_column_cache)
+            except (OSError, ValueError) as e:
+                logger.error(str(e))
+                sys.exit(1)
+
+        # MODE: Summary of snapshots
+        elif args.exec_mode == 'summary':
+            try:
+                summarize_snapshots(
+                    args.paths,
+                    args.output,
+                    engine=args.excel_engine,
+                    all_snapshots=args.all_snapshots,
+                    column_cache=not args.no_column_cache,
+                )
+            except (OSError, ValueError) as e:
+                logger.error(str(e))
+                sys.exit(1)
+
+        # MODE: Add snapshots to archive
+        elif args.exec_mode == 'archive':
+            if not Path(args.path).is_dir():
+                logger.error(f"Input {truncate_filepath(args.path)!r} not recognized as directory")
+                sys.exit(1)
+            results = archive_data_files(args.path, args.archive)
+            if not all(results.values()):
+                sys.exit(1)
+
+        # MODE: Export tweets from archive
+        elif args.exec_mode == 'query':
+            if not os.path.isfile(args.archive):
+                logger.error(f"Archive {truncate_filepath(args.archive)!r} not found (see mode 'archive')")
+                sys.exit(1)
+            criteria = {
+                'text': args.text,
+                'usernames': args.user,
+                'hashtags': args.hashtag,
+                'since': args.since,
+                'until': args.until,
+                'retweets': not args.no_retweets,
+                'limit': args.limit,
+            }
+            try:
+                query_archive_to_excel(args.archive, args.output, criteria, **excel_options)
+            except sqlite3.OperationalError as e:
+                logger.error(f"Query failed: {e}")
+                sys.exit(1)
+
+        else:
+            parser.print_help()
 
 
 def mkdir(dirname):
@@ -253,370 +1146,5509 @@ def mkdir(dirname):
     Path(dirname).mkdir(parents=True, exist_ok=True)
 
 
-def load_twitter_data(filename):
+# ----- Storage -----
+def get_storage_format(filename):
     """
-    Load twitter data from a file
+    Detect the storage format of a twitter data file from its content
 
     Args:
-        :filename: (str) path of the file to load
+        :filename: (str) path of the data file
 
     Returns:
-        :twitter_data: (dict) dictionary with twitter data
+        :storage: (str) one of 'STORAGE_FORMATS'
     """
 
-    logger.info(f"Importing twitter data from file: {truncate_filepath(filename)}")
-    with open(str(filename), "r") as fp:
-        twitter_data = json.load(fp)
-
-    logger.info(f"Found {len(twitter_data['history'])} tweets in imported file...")
-    return twitter_data
-
+    with open(str(filename), 'rb') as fp:
+        if fp.read(2) == b'\x1f\x8b':  # gzip magic number
+            return 'jsonl.gz'
+        fp.seek(0)
+        first_line = fp.readline()
 
-def get_tweet_url(username, tweet_id):
-    return f"https://twitter.com/{username}/status/{tweet_id}"
+    # A JSON Lines file starts with a complete header record (without tweets)
+    try:
+        header = json.loads(first_line)
+    except ValueError:
+        return 'json'
+    return 'jsonl' if isinstance(header, dict) and 'history' not in header else 'json'
 
 
-def download_history(username, pages):
+def open_data_file(filename, storage, mode='r'):
     """
-    Download tweets and save data on disk
+    Open a twitter data file in text mode
 
     Args:
-        :username: (str) target twitter account
-        :pages: (int) number of pages to download
+        :filename: (str) path of the data file
+        :storage: (str) one of 'STORAGE_FORMATS'
+        :mode: (str) 'r' or 'w'
 
     Returns:
-        :file_user_data: (str) file path for the downloaded user data
+        :fp: (obj) file object
     """
 
-    try:
-        profile = tw.Profile(username)
-        logger.info(f"Target: {username} ({profile.name}) | {profile.followers_count:,} followers")
-    except:
-        is_hashtag, _ = parse_filter_kw(username)
-        if is_hashtag:
-            logger.info(f"Interpreting {username!r} as a hashtag...")
-        else:
-            logger.error(f"Failed to fetch username data for {username!r}")
-        profile = None
-
-    logger.info(f"Downloading tweets ({pages} pages)...")
-    tweets = list(tw.get_tweets(username, pages))
-    logger.info(f"Downloaded {len(tweets)} tweets...")
-
-    now = datetime.datetime.now()
-    dir_user_data = os.path.join(DIR_DATA, f"{username}_{now.strftime('%F_%H%M')}")
-    mkdir(dir_user_data)
-    file_user_data = os.path.join(dir_user_data, "data.json")
-
-    profile_dict = profile.to_dict() if profile is not None else {}
-    data = {
-        "profile": profile_dict,
-        "history": tweets,
-    }
-    logger.info(f"Saving data: {truncate_filepath(file_user_data)}")
-    with open(file_user_data, 'w') as fp:
-        dump_pretty_json(data, fp)
-
-    return file_user_data
+    if storage == 'jsonl.gz':
+        return gzip.open(str(filename), mode + 't', encoding='utf-8', compresslevel=GZIP_COMPRESSLEVEL)
+    return open(str(filename), mode)
 
 
-def daterange(start_date, end_date):
+def get_data_filename(dirname, storage):
     """
-    Yield datetime objects (delta = 1 day) between start and end date
+    Return the path of the data file of a snapshot directory
 
     Args:
-        :start_date: (obj) start datetime object
-        :end_date: (obj) end datetime object
+        :dirname: (str) snapshot directory
+        :storage: (str) one of 'STORAGE_FORMATS'
 
-    Note:
-        * https://stackoverflow.com/questions/1060279/iterating-through-a-range-of-dates-in-python
+    Returns:
+        :filename: (str) path of the data file
     """
 
-    for n in range(int((end_date - start_date).days)):
-        yield start_date + datetime.timedelta(n)
+    return os.path.join(dirname, 'data' + STORAGE_FORMATS[storage])
 
 
-def get_tweets_per_day(twitter_data, count_zero_days=True, include_retweet=True):
+def find_data_file(dirname):
     """
-    Return the number of tweets posted per day
+    Return the data file of a snapshot directory (in any storage format)
 
     Args:
-        :twitter_data: (dict) dictionary with twitter data
-        :count_zero_days: (bool) if True, include days with zero tweets
-        :include_retweet: (bool) if True, include retweets
+        :dirname: (str) snapshot directory
 
     Returns:
-        :tweets_per_day: (dict) day (datetime object) as key and tweet count as value
+        :filename: (str) path of the data file (or None if there is no data file)
     """
 
-    tweets = get_tweets(twitter_data)
-    logger.info(f"Counting tweets per day (including retweets: {include_retweet})...")
-
-    tweets_per_day = Counter()
-    for tweet in tweets:
-        time = datetime.datetime.fromisoformat(tweet['time'])  # assuming date is a string here!!!
-        if tweet['isRetweet'] and not include_retweet:
-            continue
-        tweets_per_day[datetime.datetime(time.year, time.month, time.day)] += 1
+    for storage in STORAGE_FORMATS:
+        filename = get_data_filename(dirname, storage)
+        if os.path.isfile(filename):
+            return filename
+    return None
 
-    # Fill up the dictionary with zeros
-    if count_zero_days and len(tweets_per_day) > 1:
-        logger.info("Looking for days with zero tweets...")
-
-        # Get start and end date
-        all_dates = sorted(list(tweets_per_day.keys()))  # list of sorted dates
-        start_date, end_date = all_dates[0], all_dates[-1]
-        if end_date < start_date:
-            start_date, end_date, = end_date, start_date
 
-        logger.info(f"Date range is {start_date.strftime('%F')} to {end_date.strftime('%F')}")
-        for day in daterange(start_date, end_date):
-            tweets_per_day[datetime.datetime(day.year, day.month, day.day)] += 0
+def find_data_files(dirname):
+    """
+    Return all twitter data files in a directory and its sub-directories
 
-    tweets_per_day = _sort_date_dict(tweets_per_day)
-    return tweets_per_day
+    Hidden files and directories (e.g. the conversion cache and the column
+    cache) are ignored.
 
+    Args:
+        :dirname: (str) directory to search
 
-def _sort_date_dict(date_dict):
+    Returns:
+        :filenames: (list) paths of the data files
     """
-    Sort a dictionary with dates as keys in chronological order
 
-    Args:
-        :date_dict: (dict) dictionary (key must be dates in sortable format)
+    return sorted(
+        str(path) for path in Path(dirname).rglob('*')
+        if path.name.endswith(DATA_SUFFIXES) and path.is_file()
+        and not any(part.startswith('.') for part in path.relative_to(dirname).parts)
+    )
 
-    Returns:
-        :sorted_dict: (dict) dictionary sorted by keys
+
+def iter_twitter_data(filename):
     """
+    Yield the profile of a twitter data file, followed by its tweets
 
-    # Note: OrderedDict() should not be necessary in 3.8
-    return OrderedDict({k: v for k, v in sorted(date_dict.items())})
+    JSON Lines files are read one line at a time. Pretty JSON files ('json')
+    can only be parsed as a whole.
 
+    Args:
+        :filename: (str) path of the data file
+    """
 
-def _sort_tweets_by_date(tweets):
+    storage = get_storage_format(filename)
+    if storage == 'json':
+        with open(str(filename), 'r') as fp:
+            twitter_data = json.load(fp)
+        yield twitter_data['profile']
+        yield from twitter_data['history']
+        return
+
+    with open_data_file(filename, storage) as fp:
+        yield json.loads(next(fp, '{}'))['profile']
+        # Parsing a batch of lines at once is faster, and the records share their key strings
+        while True:
+            lines = list(islice(fp, JSONL_BATCH_SIZE))
+            if not lines:
+                break
+            yield from json.loads('[' + ','.join(line for line in lines if line.strip()) + ']')
+
+
+def read_twitter_data(filename, media=None):
     """
-    Ensure that tweets objects are are sorted by date
+    Read a twitter data file lazily
 
     Args:
-        :tweets: (list) Tweets from 'twitter_data'
+        :filename: (str) path of the data file
+        :media: (obj) 'MediaStore', if given, each tweet gets a key 'media' with the
+                paths of its downloaded files, relative to the data file (the
+                data file itself is not changed, see 'iter_tweets_with_media()')
 
     Returns:
-        :tweets_sorted: (list) sorted list of Tweets
+        :profile: (dict) profile data
+        :tweets: (iter) generator of tweets, the file is read while iterating
     """
 
-    # Sanity check of date format. Date string in iso-format expected.
-    # We assume that if first tweet looks okay, all will.
-    time_first_tweet = tweets[0]['time']
-    if not isinstance(time_first_tweet, str):
-        logger.error(f"Date must be a string, not {type(time_first_tweet)}. Exit.")
-        sys.exit(1)
-
-    match_iso8601 = re.compile(
-       r'^(-?(?:[1-9][0-9]*)?[0-9]{4})-(1[0-2]|0[1-9])-' +
-       r'(3[01]|0[1-9]|[12][0-9])T(2[0-3]|[01][0-9])' +
-       r':([0-5][0-9]):([0-5][0-9])(\.[0-9]+)?' +
-       r'(Z|[+-](?:2[0-3]|[01][0-9]):[0-5][0-9])?$'
-    ).match
+    records = iter_twitter_data(filename)
+    profile = next(records)
+    if media is not None:
+        records = iter_tweets_with_media(records, media, os.path.dirname(os.path.abspath(filename)))
+    return profile, records
 
-    if match_iso8601(time_first_tweet) is None:
-        logger.error(f"Date does not look like valid iso-format ({time_first_tweet!r}). Exit.")
-        sys.exit(1)
 
-    len_orig = len(tweets)
+@instrument('storage.load')
+def load_twitter_data(filename):
+    """
+    Load twitter data from a file
 
-    # Add unique ID as suffix to timestamps (as strings), since in some special
-    # cases, there can be two different tweets which have the exact same
-    # timestamp in which case some tweets could get 'lost'
-    tweets_as_date_dict = _sort_date_dict(
-        {
-            tweet['time'] + str(get_unique_id()): tweet
-            for tweet in tweets
-        }
-    )
+    Args:
+        :filename: (str) path of the file to load
 
-    tweets_sorted = list(tweets_as_date_dict.values())
+    Returns:
+        :twitter_data: (dict) dictionary with twitter data
+    """
 
-    if len(tweets_sorted) != len_orig:
-        logger.error(f"Some tweets went missing while sorting... Exit.")
-        sys.exit(1)
+    logger.info(f"Importing twitter data from file: {truncate_filepath(filename)}")
+    profile, tweets = read_twitter_data(filename)
+    twitter_data = {'profile': profile, 'history': list(tweets)}
 
-    return tweets_sorted
+    logger.info(f"Found {len(twitter_data['history'])} tweets in imported file...")
+    return twitter_data
 
 
-def get_tweets(twitter_data, sort=True):
+@instrument('storage.write')
+def write_twitter_data(profile, tweets, filename, storage='json'):
     """
-    Return tweets from twitter data or return error
+    Write twitter data to a file, one tweet at a time
+
+    The data is written to a temporary file, which replaces 'filename' once
+    it is complete and synced to disk.
 
     Args:
-        :twitter_data: (dict) dictionary with twitter data
-        :sort: (bool) if true tweets will be sorted by date
+        :profile: (dict) profile data
+        :tweets: (iter) tweets
+        :filename: (str) path of the data file
+        :storage: (str) one of 'STORAGE_FORMATS'
 
     Returns:
-        :tweets: (list) Tweets
+        :num_tweets: (int) number of written tweets
     """
 
-    tweets = twitter_data.get('history', None)
-    if tweets is None:
-        logger.error("Failed to retrieve tweets... Exit.")
-        sys.exit(1)
+    dump_compact_json = partial(json.dumps, cls=DateTimeEncoder, separators=(',', ':'))
+    num_tweets = 0
 
-    if sort and len(tweets) > 1:
-        tweets = _sort_tweets_by_date(tweets)
+    def count(tweets):
+        nonlocal num_tweets
+        for tweet in tweets:
+            num_tweets += 1
+            yield tweet
 
-    return tweets
+    file_tmp = str(filename) + '.tmp'
+    with open_data_file(file_tmp, storage, 'w') as fp:
+        if storage == 'json':
+            dump_pretty_twitter_data(profile, count(tweets), fp)
+        else:
+            fp.write(dump_compact_json({'profile': profile}) + '\n')
+            for tweet in count(tweets):
+                fp.write(dump_compact_json(tweet) + '\n')
 
+    # Synced after closing, when compressed files are complete
+    with open(file_tmp, 'rb+') as fp:
+        sync_file(fp)
+    os.replace(file_tmp, filename)
+    METRICS.count('bytes_written', os.path.getsize(filename), kind='data')
 
-def filter_tweets(tweets, filter_kw):
+    return num_tweets
+
+
+def migrate_data_files(dirname, storage):
     """
-    Filter tweets by a #hashtag or keyword
+    Convert all twitter data files in a directory tree to another storage format
+
+    Each file is replaced by a file with the new suffix (e.g. 'data.json' -->
+    'data.jsonl.gz'). Entries in the conversion cache are moved along, so
+    existing Excel files stay up to date.
 
     Args:
-        :tweets: (list) Tweets from 'twitter_data'
-        :filter_kw: (str) filter keyword
+        :dirname: (str) directory to search for data files
+        :storage: (str) target format, one of 'STORAGE_FORMATS'
 
     Returns:
-        :filtered_tweets: (list) Filtered tweets from 'twitter_data'
-
-    Note:
-        * If 'filter_kw' starts with '#' it is interpreted as a hashtag, and
-          only hashtags will be checked. If 'filter_kw' is not a hashtag, both
-          hashtags and the tweet text will be checked.
+        :results: (dict) filename as key and True (success) or False (failure) as value
     """
 
-    is_hashtag, parsed_kw = parse_filter_kw(filter_kw)
-    filtered_tweets = []
+    filenames = find_data_files(dirname)
+    results = OrderedDict((filename, False) for filename in filenames)
+    cache = ConversionCache()
+    size_before = size_after = 0
+    num_unchanged = 0
+    logger.info(f"Migrating {len(filenames)} file(s) to format {storage!r}...")
+
+    try:
+        for filename in filenames:
+            suffix = next(suffix for suffix in DATA_SUFFIXES if filename.endswith(suffix))
+            new_filename = filename[:-len(suffix)] + STORAGE_FORMATS[storage]
+
+            try:
+                source = file_fingerprint(filename, content=False)
+                if new_filename == filename and get_storage_format(filename) == storage:
+                    results[filename] = True
+                    num_unchanged += 1
+                    continue
+                if new_filename != filename and os.path.exists(new_filename):
+                    raise FileExistsError(f"{truncate_filepath(new_filename)!r} already exists")
+
+                profile, tweets = read_twitter_data(filename)
+                num_tweets = write_twitter_data(profile, tweets, new_filename, storage)
+                if new_filename != filename:
+                    os.remove(filename)
+                cache.rename(filename, new_filename, source)
+            except Exception as e:
+                logger.error(f"Failed to migrate {truncate_filepath(filename)}: {e}")
+                continue
+
+            results[filename] = True
+            size_before += source['size']
+            size_after += os.path.getsize(new_filename)
+            logger.info(
+                f"Migrated {truncate_filepath(new_filename)} ({num_tweets} tweets, "
+                f"{source['size']/1024:,.0f} KB --> {os.path.getsize(new_filename)/1024:,.0f} KB)"
+            )
+    finally:
+        cache.save()
+
+    failed = [filename for filename, success in results.items() if not success]
+    logger.info(
+        f"Summary: {len(results) - len(failed) - num_unchanged} migrated, {num_unchanged} unchanged, {len(failed)} failed | "
+        f"{size_before/1024:,.0f} KB --> {size_after/1024:,.0f} KB"
+    )
+    return results
+
+
+# ----- Archive -----
+ARCHIVE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    username TEXT NOT NULL COLLATE NOCASE,
+    taken_at TEXT NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    num_tweets INTEGER NOT NULL,
+    profile TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tweets (
+    id INTEGER PRIMARY KEY,
+    username TEXT NOT NULL COLLATE NOCASE,
+    tweet_id TEXT NOT NULL,
+    epoch INTEGER NOT NULL,
+    is_retweet INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    data TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    UNIQUE (username, tweet_id)
+);
+CREATE INDEX IF NOT EXISTS tweets_username_epoch ON tweets (username, epoch);
+CREATE INDEX IF NOT EXISTS tweets_epoch ON tweets (epoch);
+CREATE TABLE IF NOT EXISTS engagement (
+    username TEXT NOT NULL COLLATE NOCASE,
+    tweet_id TEXT NOT NULL,
+    snapshot_id INTEGER NOT NULL REFERENCES snapshots (id),
+    likes INTEGER NOT NULL,
+    retweets INTEGER NOT NULL,
+    replies INTEGER NOT NULL,
+    PRIMARY KEY (username, tweet_id, snapshot_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS hashtags (
+    hashtag TEXT NOT NULL,
+    username TEXT NOT NULL COLLATE NOCASE,
+    tweet_id TEXT NOT NULL,
+    PRIMARY KEY (hashtag, username, tweet_id)
+) WITHOUT ROWID;
+"""
+
+ARCHIVE_SCHEMA_FTS = """
+CREATE VIRTUAL TABLE IF NOT EXISTS tweets_fts USING fts5 (text, content='tweets', content_rowid='id');
+"""
+
+ARCHIVE_UPSERT_TWEET = """
+INSERT INTO tweets (username, tweet_id, epoch, is_retweet, text, data, updated_at)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (username, tweet_id) DO UPDATE SET
+    is_retweet = excluded.is_retweet,
+    data = excluded.data,
+    updated_at = excluded.updated_at
+WHERE excluded.updated_at >= tweets.updated_at
+"""
+
+
+class TweetArchive:
+    """
+    SQLite database with the tweets of all snapshots
+
+    Tweets are stored once per account (the same 'tweetId' can appear in
+    several accounts as retweet). The stored record is the one of the most
+    recent snapshot, the engagement counts (likes, ...) of every snapshot are
+    kept in the table 'engagement'. Tweet texts are indexed with FTS5, if the
+    SQLite library supports it, otherwise text queries fall back to 'LIKE'.
+    """
+
+    def __init__(self, filename):
+        self.filename = str(filename)
+        mkdir(os.path.dirname(os.path.abspath(self.filename)))
+        self.conn = sqlite3.connect(self.filename)
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        self.conn.executescript(ARCHIVE_SCHEMA)
+        try:
+            self.conn.executescript(ARCHIVE_SCHEMA_FTS)
+            self.has_fts = True
+        except sqlite3.OperationalError:
+            logger.warning("SQLite has no FTS5 support, text queries will be slow")
+            self.has_fts = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def _find_snapshot(self, name):
+        return self.conn.execute(
+            'SELECT id, size, mtime_ns, sha256 FROM snapshots WHERE name = ?', (name,)
+        ).fetchone()
+
+    @instrument('archive.ingest')
+    def ingest(self, filename):
+        """
+        Add a snapshot to the archive (unless it has been added before)
+
+        Args:
+            :filename: (str) path of the data file of the snapshot
+
+        Returns:
+            :num_tweets: (int) number of tweets in the snapshot (or None if the snapshot was skipped)
+        """
+
+        dirname = os.path.dirname(os.path.abspath(filename))
+        name = os.path.basename(dirname)
+        snapshot = parse_snapshot_dirname(name)
+        if snapshot is None:
+            raise ValueError(f"{truncate_filepath(dirname)!r} is not a snapshot directory (<username>_<YYYY-MM-DD>_<HHMM>)")
+        username, taken_at = snapshot
+        taken_at = taken_at.isoformat()
+
+        # The content hash is only needed if the file was touched (e.g. migrated to another format)
+        source = file_fingerprint(filename, content=False)
+        row = self._find_snapshot(name)
+        if row is not None and row[1:3] == (source['size'], source['mtime_ns']):
+            return None
+        source = file_fingerprint(filename)
+        if row is not None and row[3] == source['sha256']:
+            with self.conn:
+                self.conn.execute(
+                    'UPDATE snapshots SET path = ?, size = ?, mtime_ns = ? WHERE id = ?',
+                    (os.path.abspath(filename), source['size'], source['mtime_ns'], row[0])
+                )
+            return None
+
+        profile, tweets = read_twitter_data(filename)
+        dump_compact_json = partial(json.dumps, cls=DateTimeEncoder, separators=(',', ':'))
+
+        with self.conn:
+            if row is not None:
+                self.conn.execute('DELETE FROM engagement WHERE snapshot_id = ?', (row[0],))
+                self.conn.execute('DELETE FROM snapshots WHERE id = ?', (row[0],))
+            snapshot_id = self.conn.execute(
+                'INSERT INTO snapshots (name, username, taken_at, path, size, mtime_ns, sha256, num_tweets, profile) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, 0, ?)',
+                (name, username, taken_at, os.path.abspath(filename), source['size'],
+                 source['mtime_ns'], source['sha256'], dump_compact_json(profile))
+            ).lastrowid
+            max_id = self.conn.execute('SELECT COALESCE(MAX(id), 0) FROM tweets').fetchone()[0]
+
+            num_tweets = 0
+            for batch in iter(lambda: list(islice(tweets, JSONL_BATCH_SIZE)), []):
+                num_tweets += len(batch)
+                self.conn.executemany(ARCHIVE_UPSERT_TWEET, (
+                    (username, tweet['tweetId'], parse_epoch(tweet['time']), tweet['isRetweet'],
+                     tweet['text'], dump_compact_json(tweet), taken_at)
+                    for tweet in batch
+                ))
+                self.conn.executemany(
+                    'INSERT OR REPLACE INTO engagement VALUES (?, ?, ?, ?, ?, ?)',
+                    ((username, tweet['tweetId'], snapshot_id, tweet['likes'], tweet['retweets'], tweet['replies'])
+                     for tweet in batch)
+                )
+                self.conn.executemany(
+                    'INSERT OR IGNORE INTO hashtags VALUES (?, ?, ?)',
+                    ((parse_filter_kw(hashtag)[1], username, tweet['tweetId'])
+                     for tweet in batch for hashtag in tweet['entries']['hashtags'])
+                )
+
+            # New tweets get ascending row IDs, texts of existing tweets do not change
+            if self.has_fts:
+                self.conn.execute('INSERT INTO tweets_fts (rowid, text) SELECT id, text FROM tweets WHERE id > ?', (max_id,))
+            self.conn.execute('UPDATE snapshots SET num_tweets = ? WHERE id = ?', (num_tweets, snapshot_id))
+
+        return num_tweets
+
+    def query(self, *, text=None, usernames=None, hashtags=None, since=None, until=None, retweets=True, limit=None):
+        """
+        Return tweets matching all given criteria (sorted by date)
+
+        Args:
+            :text: (str) full-text query (FTS5 syntax), or words which must all appear in the text
+            :usernames: (list) accounts
+            :hashtags: (list) hashtags (a tweet must have at least one of them)
+            :since: (obj) 'datetime.date', first day
+            :until: (obj) 'datetime.date', last day
+            :retweets: (bool) if False, retweets are excluded
+            :limit: (int) maximum number of tweets
+
+        Returns:
+            :tweets: (list) Tweets (with an additional key 'username')
+        """
+
+        conditions = []
+        params = []
+
+        def day_epoch(date):
+            return int((datetime.datetime.combine(date, datetime.time()) - EPOCH).total_seconds())
+
+        if usernames:
+            conditions.append(f"t.username IN ({', '.join('?'*len(usernames))})")
+            params.extend(usernames)
+        if since is not None:
+            conditions.append('t.epoch >= ?')
+            params.append(day_epoch(since))
+        if until is not None:
+            conditions.append('t.epoch < ?')
+            params.append(day_epoch(until) + SECONDS_PER_DAY)
+        if not retweets:
+            conditions.append('t.is_retweet = 0')
+        if hashtags:
+            conditions.append(
+                'EXISTS (SELECT 1 FROM hashtags h WHERE h.username = t.username AND h.tweet_id = t.tweet_id '
+                f"AND h.hashtag IN ({', '.join('?'*len(hashtags))}))"
+            )
+            params.extend(parse_filter_kw(hashtag)[1] for hashtag in hashtags)
+        if text and self.has_fts:
+            conditions.append('t.id IN (SELECT rowid FROM tweets_fts WHERE tweets_fts MATCH ?)')
+            params.append(text)
+        elif text:
+            for word in text.split():
+                conditions.append("t.text LIKE ? ESCAPE '\\'")
+                params.append('%' + re.sub(r'([%_\\])', r'\\\1', word) + '%')
+
+        sql = 'SELECT t.username, t.data FROM tweets t'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY t.epoch, t.id'
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+
+        tweets = []
+        for username, data in self.conn.execute(sql, params):
+            tweet = json.loads(data)
+            tweet['username'] = username
+            tweets.append(tweet)
+        return tweets
+
+    def latest_profile(self, username):
+        """
+        Return the profile data of the most recent snapshot of an account
+
+        Args:
+            :username: (str) account
+
+        Returns:
+            :profile: (dict) profile data (empty if the account is not in the archive)
+        """
+
+        row = self.conn.execute(
+            'SELECT profile FROM snapshots WHERE username = ? ORDER BY taken_at DESC LIMIT 1', (username,)
+        ).fetchone()
+        return json.loads(row[0]) if row is not None else {}
+
+    def engagement_history(self, username, tweet_id):
+        """
+        Return the engagement counts of a tweet in all snapshots
+
+        Args:
+            :username: (str) account
+            :tweet_id: (str) tweet ID
+
+        Returns:
+            :history: (list) tuples (snapshot time, likes, retweets, replies)
+        """
+
+        return self.conn.execute(
+            'SELECT s.taken_at, e.likes, e.retweets, e.replies FROM engagement e '
+            'JOIN snapshots s ON s.id = e.snapshot_id '
+            'WHERE e.username = ? AND e.tweet_id = ? ORDER BY s.taken_at',
+            (username, tweet_id)
+        ).fetchall()
+
+
+def archive_data_files(dirname, archive_file):
+    """
+    Add all snapshots in a directory tree to the archive
+
+    Snapshots which are already part of the archive are skipped.
+
+    Args:
+        :dirname: (str) directory to search for data files
+        :archive_file: (str) path of the SQLite database
+
+    Returns:
+        :results: (dict) filename as key and True (success) or False (failure) as value
+    """
+
+    filenames = find_data_files(dirname)
+    results = OrderedDict((filename, False) for filename in filenames)
+    num_skipped = 0
+    start = time.perf_counter()
+    logger.info(f"Archiving {len(filenames)} snapshot(s) in {truncate_filepath(archive_file)}...")
+
+    def taken_at(filename):
+        snapshot = parse_snapshot_dirname(os.path.basename(os.path.dirname(filename)))
+        return snapshot[1] if snapshot is not None else EPOCH
+
+    # Oldest snapshots first (the most recent record of a tweet is kept in any order)
+    with TweetArchive(archive_file) as archive:
+        for filename in sorted(filenames, key=taken_at):
+            try:
+                num_tweets = archive.ingest(filename)
+            except Exception as e:
+                logger.error(f"Failed to archive {truncate_filepath(filename)}: {e}")
+                continue
+            results[filename] = True
+            if num_tweets is None:
+                num_skipped += 1
+            else:
+                logger.info(f"Archived {truncate_filepath(filename)} ({num_tweets} tweets)")
+        num_total = archive.conn.execute('SELECT COUNT(*) FROM tweets').fetchone()[0]
+
+    failed = [filename for filename, success in results.items() if not success]
+    logger.info(
+        f"Summary: {len(results) - len(failed) - num_skipped} archived, {num_skipped} skipped, {len(failed)} failed | "
+        f"{num_total} tweets in archive | {time.perf_counter() - start:.1f} s"
+    )
+    return results
+
+
+def query_archive_to_excel(archive_file, excel_file, criteria, **options):
+    """
+    Export tweets from the archive to an Excel file
+
+    Args:
+        :archive_file: (str) path of the SQLite database
+        :excel_file: (str) excel file name
+        :criteria: (dict) keyword arguments for 'TweetArchive.query()'
+        :options: (dict) keyword arguments for 'convert_to_excel()' (filters, ...)
+
+    Returns:
+        :num_tweets: (int) number of exported tweets
+    """
+
+    with TweetArchive(archive_file) as archive:
+        tweets = archive.query(**criteria)
+        usernames = sorted({tweet['username'] for tweet in tweets}, key=str.lower)
+        if len(usernames) == 1:
+            profile = archive.latest_profile(usernames[0])
+        else:
+            # Links to tweets use the key 'username' of each tweet
+            profile = {'name': ', '.join(usernames), 'username': None}
+
+    logger.info(f"Found {len(tweets)} tweets from {len(usernames)} account(s) in archive...")
+    if not tweets:
+        logger.warning("No tweets found, no excel file created")
+        return 0
+
+    convert_to_excel({'profile': profile, 'history': tweets}, excel_file, **options)
+    return len(tweets)
+
+
+def get_tweet_url(username, tweet_id):
+    if username is None:
+        return f"https://twitter.com/i/web/status/{tweet_id}"  # Works for any account
+    return f"https://twitter.com/{username}/status/{tweet_id}"
+
+
+# ----- Snapshot catalog -----
+def parse_snapshot_dirname(name):
+    """
+    Return the account and the time of a snapshot directory
+
+    Args:
+        :name: (str) directory name ('<username>_<YYYY-MM-DD>_<HHMM>')
+
+    Returns:
+        :snapshot: (tuple) username and 'datetime' (or None if 'name' is not a snapshot directory)
+    """
+
+    match = re.match(r'^(.+)_(\d{4}-\d{2}-\d{2}_\d{4})$', name)
+    if match is None:
+        return None
+    try:
+        taken_at = datetime.datetime.strptime(match.group(2), '%Y-%m-%d_%H%M')
+    except ValueError:
+        return None
+    return match.group(1), taken_at
+
+
+def _list_snapshot_dirs(username):
+    """
+    Return all snapshot directories of a twitter account in chronological order
+
+    Args:
+        :username: (str) twitter account
+
+    Returns:
+        :snapshots: (list) paths of the snapshot directories
+    """
+
+    if not os.path.isdir(DIR_DATA):
+        return []
+
+    # Snapshot directories are named '<username>_<YYYY-MM-DD>_<HHMM>'
+    match_snapshot = re.compile(rf'^{re.escape(username)}_\d{{4}}-\d{{2}}-\d{{2}}_\d{{4}}$').match
+    return sorted(
+        entry.path for entry in os.scandir(DIR_DATA)
+        if entry.is_dir() and match_snapshot(entry.name)
+    )
+
+
+def _iter_with_stats(tweets, stats):
+    """
+    Yield tweets and collect the numbers of the snapshot catalog
+
+    Args:
+        :tweets: (iter) tweets
+        :stats: (dict) updated with 'count', 'first' and 'last' (times of the oldest and newest tweet)
+    """
+
+    stats.update(count=0, first=None, last=None)
+    first_epoch = last_epoch = None
+    for tweet in tweets:
+        stats['count'] += 1
+        epoch = parse_epoch(tweet['time'])
+        if first_epoch is None or epoch < first_epoch:
+            first_epoch, stats['first'] = epoch, tweet['time']
+        if last_epoch is None or epoch > last_epoch:
+            last_epoch, stats['last'] = epoch, tweet['time']
+        yield tweet
+
+
+class SnapshotCatalog:
+    """
+    Index of the snapshots in the data directory ('CATALOG_FILENAME')
+
+    For each snapshot, the catalog records account, time of the snapshot,
+    number of tweets, times of the oldest and newest tweet and the
+    fingerprint of the data file. New snapshots are added by
+    'download_history()'. 'refresh()' only compares names and file sizes
+    and modification times, a data file is only read if it is not in the
+    catalog yet or has changed (e.g. after 'migrate').
+
+    Attributes:
+        :dirname: (str) data directory
+        :entries: (dict) path of the data file (relative to 'dirname') as key and entry (dict) as value
+    """
+
+    def __init__(self, dirname=None):
+        self.dirname = dirname if dirname is not None else DIR_DATA
+        self.filename = os.path.join(self.dirname, CATALOG_FILENAME)
+        self.entries = {}
+
+        try:
+            with open(self.filename, 'r') as fp:
+                catalog = json.load(fp)
+            if catalog.get('version') == CATALOG_VERSION:
+                self.entries = dict(catalog['snapshots'])
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+            logger.warning(f"Ignoring snapshot catalog {truncate_filepath(self.filename)!r}: {e}")
+
+    def add(self, filename, stats=None):
+        """
+        Add (or update) the entry of a snapshot
+
+        Args:
+            :filename: (str) path of the data file in a snapshot directory
+            :stats: (dict) 'count', 'first' and 'last' (see '_iter_with_stats()'), the data file is read if not given
+
+        Returns:
+            :entry: (dict) catalog entry
+        """
+
+        dir_snapshot = os.path.dirname(os.path.abspath(filename))
+        snapshot = parse_snapshot_dirname(os.path.basename(dir_snapshot))
+        if snapshot is None:
+            raise ValueError(f"{truncate_filepath(filename)!r} is not in a snapshot directory (<username>_<YYYY-MM-DD>_<HHMM>)")
+
+        fingerprint = file_fingerprint(filename)
+        if stats is None:
+            stats = {}
+            for _ in _iter_with_stats(read_twitter_data(filename)[1], stats):
+                pass
+
+        username, taken_at = snapshot
+        entry = OrderedDict((
+            ('username', username),
+            ('taken_at', taken_at.strftime('%F %H:%M')),
+            ('count', stats['count']),
+            ('first', stats['first']),
+            ('last', stats['last']),
+            ('storage', get_storage_format(filename)),
+            *fingerprint.items(),
+        ))
+        self.entries[Path(os.path.relpath(os.path.abspath(filename), self.dirname)).as_posix()] = entry
+        return entry
+
+    def remove(self, filename):
+        """Remove the entry of a snapshot (if there is one)"""
+
+        self.entries.pop(Path(os.path.relpath(os.path.abspath(filename), self.dirname)).as_posix(), None)
+
+    def refresh(self, rebuild=False):
+        """
+        Bring the catalog up to date with the snapshot directories
+
+        Args:
+            :rebuild: (bool) if True, read all data files again
+
+        Returns:
+            :changed: (bool) True if entries were added, updated or removed
+        """
+
+        found = OrderedDict()
+        if os.path.isdir(self.dirname):
+            for entry in os.scandir(self.dirname):
+                if entry.is_dir() and parse_snapshot_dirname(entry.name) is not None:
+                    filename = find_data_file(entry.path)
+                    if filename is not None:
+                        found[Path(os.path.relpath(filename, self.dirname)).as_posix()] = filename
+
+        changed = False
+        for relpath in set(self.entries) - set(found):
+            del self.entries[relpath]
+            changed = True
+
+        todo = []
+        for relpath, filename in found.items():
+            entry = self.entries.get(relpath)
+            if not rebuild and entry is not None:
+                try:
+                    stat = os.stat(filename)
+                except OSError:
+                    continue
+                if (stat.st_size, stat.st_mtime_ns) == (entry.get('size'), entry.get('mtime_ns')):
+                    continue
+            todo.append(filename)
+
+        if todo:
+            logger.info(f"Updating snapshot catalog ({len(todo)} snapshot(s) to read)...")
+        for filename in todo:
+            try:
+                self.add(filename)
+            except Exception as e:
+                logger.warning(f"Could not add {truncate_filepath(filename)!r} to the snapshot catalog: {e}")
+            else:
+                changed = True
+        return changed
+
+    def snapshots(self, username=None):
+        """
+        Return the entries of all snapshots (or of one account)
+
+        Args:
+            :username: (str) twitter account (all accounts if None)
+
+        Returns:
+            :snapshots: (list) entries sorted by account and time, with the absolute path of the data file ('path')
+        """
+
+        snapshots = [
+            dict(entry, path=os.path.join(self.dirname, relpath))
+            for relpath, entry in self.entries.items()
+            if username is None or entry['username'] == username
+        ]
+        return sorted(snapshots, key=lambda entry: (entry['username'], entry['taken_at'], entry['path']))
+
+    def save(self):
+        """Write the catalog to disk"""
+
+        mkdir(self.dirname)
+        catalog = OrderedDict((
+            ('version', CATALOG_VERSION),
+            ('snapshots', OrderedDict(sorted(self.entries.items()))),
+        ))
+        file_tmp = f'{self.filename}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(file_tmp, 'w') as fp:
+            json.dump(catalog, fp, indent=2)
+        os.replace(file_tmp, self.filename)
+
+
+_CATALOG_LOCK = threading.Lock()
+
+
+def load_catalog(rebuild=False):
+    """
+    Return the snapshot catalog of the data directory, brought up to date (see 'SnapshotCatalog.refresh()')
+
+    Args:
+        :rebuild: (bool) if True, read all data files again
+
+    Returns:
+        :catalog: (obj) 'SnapshotCatalog'
+    """
+
+    with _CATALOG_LOCK:
+        catalog = SnapshotCatalog()
+        if catalog.refresh(rebuild) or not os.path.isfile(catalog.filename):
+            try:
+                catalog.save()
+            except OSError as e:
+                logger.warning(f"Could not save snapshot catalog: {e}")
+        return catalog
+
+
+def add_to_catalog(filename, stats=None):
+    """
+    Add a new snapshot to the catalog of the data directory
+
+    Args:
+        :filename: (str) path of the data file
+        :stats: (dict) 'count', 'first' and 'last' (see '_iter_with_stats()')
+    """
+
+    with _CATALOG_LOCK:
+        try:
+            catalog = SnapshotCatalog()
+            catalog.add(filename, stats)
+            catalog.save()
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not add {truncate_filepath(filename)!r} to the snapshot catalog: {e}")
+
+
+def remove_snapshot(filename):
+    """
+    Delete a snapshot directory and remove it from the catalog of the data directory
+
+    Args:
+        :filename: (str) path of the data file of the snapshot
+    """
+
+    dir_snapshot = os.path.dirname(os.path.abspath(filename))
+    if parse_snapshot_dirname(os.path.basename(dir_snapshot)) is None:
+        raise ValueError(f"{truncate_filepath(filename)!r} is not in a snapshot directory (<username>_<YYYY-MM-DD>_<HHMM>)")
+    with _CATALOG_LOCK:
+        shutil.rmtree(dir_snapshot)
+        try:
+            catalog = SnapshotCatalog()
+            catalog.remove(filename)
+            catalog.save()
+        except OSError as e:
+            logger.warning(f"Could not remove {truncate_filepath(filename)!r} from the snapshot catalog: {e}")
+
+
+def print_snapshot_list(snapshots, fp=None):
+    """
+    Print a table of snapshots (see 'SnapshotCatalog.snapshots()')
+
+    Args:
+        :snapshots: (list) catalog entries
+        :fp: (obj) file object (default: standard output)
+    """
+
+    fp = fp if fp is not None else sys.stdout
+    headers = ("Account", "Snapshot", "Tweets", "Oldest tweet", "Newest tweet", "Size", "SHA-256")
+    rows = [
+        (
+            entry['username'],
+            entry['taken_at'],
+            f"{entry['count']:,}",
+            (entry['first'] or '-')[:16].replace('T', ' '),
+            (entry['last'] or '-')[:16].replace('T', ' '),
+            f"{entry['size']/1024:,.0f} KB",
+            entry['sha256'][:12],
+        )
+        for entry in snapshots
+    ]
+    widths = [max(len(str(value)) for value in column) for column in zip(headers, *rows)]
+    right = {2, 5}  # Numbers are aligned to the right
+    for row in (headers, *rows):
+        print('  '.join(
+            str(value).rjust(width) if i in right else str(value).ljust(width)
+            for i, (value, width) in enumerate(zip(row, widths))
+        ).rstrip(), file=fp)
+
+    num_accounts = len({entry['username'] for entry in snapshots})
+    num_tweets = sum(entry['count'] for entry in snapshots)
+    print(f"\n{len(snapshots)} snapshot(s) of {num_accounts} account(s), {num_tweets:,} tweets", file=fp)
+
+
+def find_latest_snapshot(username):
+    """
+    Return the data file of the most recent snapshot of a twitter account (see 'SnapshotCatalog')
+
+    Args:
+        :username: (str) twitter account
+
+    Returns:
+        :filename: (str) path of the latest data file (or None if there is no snapshot)
+    """
+
+    snapshots = load_catalog().snapshots(username)
+    return snapshots[-1]['path'] if snapshots else None
+
+
+def find_unfinished_snapshot(username):
+    """
+    Return the directory of an interrupted download of a twitter account
+
+    Args:
+        :username: (str) twitter account
+
+    Returns:
+        :dirname: (str) path of the snapshot directory (or None if there is no interrupted download)
+    """
+
+    for dir_snapshot in reversed(_list_snapshot_dirs(username)):
+        if find_data_file(dir_snapshot) is not None:
+            return None
+        if os.path.isfile(os.path.join(dir_snapshot, JOURNAL_FILENAME)):
+            return dir_snapshot
+    return None
+
+
+def iter_unique_tweets(*tweet_sources):
+    """
+    Yield tweets from one or more sources, skipping duplicates by 'tweetId'
+
+    Args:
+        :tweet_sources: (iterables) sources of tweets, the first occurrence of a tweet is kept
+    """
+
+    seen_ids = set()
+    for tweets in tweet_sources:
+        for tweet in tweets:
+            if tweet['tweetId'] in seen_ids:
+                continue
+            seen_ids.add(tweet['tweetId'])
+            yield tweet
+
+
+def merge_tweets(new_tweets, old_tweets):
+    """
+    Merge two lists of tweets, removing duplicates by 'tweetId'
+
+    Args:
+        :new_tweets: (list) recently downloaded tweets
+        :old_tweets: (list) previously downloaded tweets
+
+    Returns:
+        :merged_tweets: (list) merged tweets
+
+    Note:
+        * If a tweet appears in both lists, the record from 'new_tweets' is
+          kept, since it has the most recent engagement counts (likes, ...)
+    """
+
+    return list(iter_unique_tweets(new_tweets, old_tweets))
+
+
+# ----- Fetcher -----
+class RateLimiter:
+    """
+    Token bucket which adapts its rate to the responses of the server
+
+    The rate is halved whenever the server is overloaded or throttles us
+    (429, 5xx), and grows again slowly with every successful request, but
+    never beyond the initial (maximum) rate. All methods are thread-safe.
+
+    Attributes:
+        :rate: (float) current number of requests per second
+        :max_rate: (float) maximum number of requests per second
+        :burst: (int) maximum number of tokens in the bucket
+    """
+
+    def __init__(self, rate=FETCH_RATE, burst=FETCH_BURST, min_rate=FETCH_MIN_RATE):
+        self.rate = rate
+        self.max_rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take a token from the bucket, wait until one is available
+
+        Returns:
+            :wait: (float) seconds waited
+        """
+
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated)*self.rate)
+            self._updated = now
+            # A missing token is borrowed, so that waiting threads queue up in order
+            self._tokens -= 1
+            wait = -self._tokens/self.rate if self._tokens < 0 else 0.0
+
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def throttle(self):
+        """Multiplicative decrease of the rate (the server is overloaded)"""
+
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate/2)
+            self._tokens = min(self._tokens, 0.0)
+
+    def relax(self):
+        """Additive increase of the rate (a request succeeded)"""
+
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate/10)
+
+
+class ResponseCache:
+    """
+    On-disk cache of HTTP responses (profile pages and timeline pages)
+
+    Each response is stored in a file named by the SHA-256 hash of the
+    request (method, URL and query parameters). The file starts with a JSON
+    header line (URL, kind, status, headers, time of the download), followed
+    by the raw body. A response expires after the time to live of its kind
+    (see 'CACHE_TTL'). If the cache grows beyond 'max_size' bytes, the least
+    recently used responses are removed, the modification time of a file is
+    updated whenever it is read. Only successful GET requests are cached.
+    All methods are thread-safe.
+
+    Attributes:
+        :dirname: (str) cache directory
+        :ttl: (dict) kind as key and seconds as value
+        :max_size: (int) maximum size of all cached responses in bytes
+        :refresh: (bool) if True, cached responses are not used, but new responses are stored
+        :stats: (dict) number of hits, misses, expired, stored and evicted responses
+    """
+
+    def __init__(self, dirname=DIR_CACHE, *, ttl=None, max_size=CACHE_MAX_SIZE, refresh=False):
+        self.dirname = str(dirname)
+        self.ttl = OrderedDict(CACHE_TTL, **(ttl or {}))
+        self.max_size = max_size
+        self.refresh = refresh
+        self.stats = {'hits': 0, 'misses': 0, 'expired': 0, 'stored': 0, 'evicted': 0}
+        self._size = None  # Total size, computed on first write
+        self._lock = threading.Lock()
+        self._requests = import_module('requests')
+
+    @staticmethod
+    def get_kind(url):
+        """Return the kind of a request ('timeline' or 'profile')"""
+
+        path = url.split('?', 1)[0]
+        return 'timeline' if '/timeline' in path else 'profile'
+
+    @staticmethod
+    def get_key(method, url, params=None):
+        """
+        Return the cache key of a request
+
+        Args:
+            :method: (str) HTTP method
+            :url: (str) URL
+            :params: (dict) query parameters (or None)
+
+        Returns:
+            :key: (str) SHA-256 hash (hex)
+        """
+
+        params = sorted((str(key), str(value)) for key, value in (params or {}).items())
+        request = json.dumps([method.upper(), url, params], separators=(',', ':'))
+        return hashlib.sha256(request.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.dirname, key[:2], key)
+
+    def _add_stats(self, name, value=1, kind=None):
+        with self._lock:
+            self.stats[name] += value
+        if kind is not None:
+            METRICS.count(f'cache_{name}', value, kind=kind)
+
+    def get(self, method, url, params=None):
+        """
+        Return a cached response
+
+        Args:
+            :method: (str) HTTP method
+            :url: (str) URL
+            :params: (dict) query parameters (or None)
+
+        Returns:
+            :response: (obj) 'requests.Response' (or None if there is no valid cached response)
+        """
+
+        kind = self.get_kind(url)
+        if self.refresh or method.upper() != 'GET':
+            self._add_stats('misses', kind=kind)
+            return None
+
+        path = self._path(self.get_key(method, url, params))
+        try:
+            with open(path, 'rb') as fp:
+                header = json.loads(fp.readline())
+                body = fp.read()
+        except FileNotFoundError:
+            self._add_stats('misses', kind=kind)
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring damaged cache entry {truncate_filepath(path)}: {e}")
+            self._add_stats('misses', kind=kind)
+            return None
+
+        if time.time() - header['stored_at'] > self.ttl.get(kind, 0):
+            self._add_stats('expired', kind=kind)
+            return None
+
+        try:
+            os.utime(path)  # Mark as recently used
+        except OSError:
+            pass
+        self._add_stats('hits', kind=kind)
+
+        response = self._requests.Response()
+        response.status_code = header['status']
+        response.headers = self._requests.structures.CaseInsensitiveDict(header['headers'])
+        response.url = header['url']
+        response.encoding = header['encoding']
+        response.reason = 'OK (cached)'
+        response.elapsed = datetime.timedelta(0)
+        response._content = body
+        return response
+
+    def put(self, method, url, params, response):
+        """
+        Store a response (unless it is not cacheable)
+
+        Args:
+            :method: (str) HTTP method
+            :url: (str) URL
+            :params: (dict) query parameters (or None)
+            :response: (obj) 'requests.Response'
+        """
+
+        if method.upper() != 'GET' or response.status_code != 200:
+            return
+
+        kind = self.get_kind(url)
+        path = self._path(self.get_key(method, url, params))
+        header = {
+            'url': response.url,
+            'kind': kind,
+            'status': response.status_code,
+            'headers': dict(response.headers),
+            'encoding': response.encoding,
+            'stored_at': time.time(),
+        }
+
+        try:
+            mkdir(os.path.dirname(path))
+            old_size = os.path.getsize(path) if os.path.isfile(path) else 0
+            file_tmp = f'{path}.{threading.get_ident()}.tmp'
+            with open(file_tmp, 'wb') as fp:
+                fp.write(json.dumps(header).encode('utf-8') + b'\n')
+                fp.write(response.content)
+            size = os.path.getsize(file_tmp)
+            os.replace(file_tmp, path)
+        except OSError as e:
+            logger.warning(f"Could not cache response of {url}: {e}")
+            return
+
+        self._add_stats('stored', kind=kind)
+        with self._lock:
+            if self._size is None:
+                self._size = self._scan_size()
+            else:
+                self._size += size - old_size
+            if self._size > self.max_size:
+                self._evict()
+
+    def _iter_entries(self):
+        """Yield (modification time, size, path) of all cached responses"""
+
+        if not os.path.isdir(self.dirname):
+            return
+        for subdir in os.scandir(self.dirname):
+            if not subdir.is_dir():
+                continue
+            for entry in os.scandir(subdir.path):
+                if entry.name.endswith('.tmp'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                yield stat.st_mtime, stat.st_size, entry.path
+
+    def _scan_size(self):
+        return sum(size for _, size, _ in self._iter_entries())
+
+    def _evict(self):
+        """Remove least recently used responses until the cache is not larger than 'max_size'"""
+
+        entries = sorted(self._iter_entries())
+        self._size = sum(size for _, size, _ in entries)
+        num_evicted = 0
+        for _, size, path in entries:
+            if self._size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._size -= size
+            num_evicted += 1
+
+        self.stats['evicted'] += num_evicted
+        METRICS.count('cache_evicted', num_evicted)
+        logger.debug(f"Removed {num_evicted} response(s) from cache ({self._size/2**20:.1f} MB left)")
+
+    def log_summary(self):
+        """Log number of cache hits and misses"""
+
+        stats = self.stats
+        logger.info(
+            f"Cache: {stats['hits']} hits, {stats['misses'] + stats['expired']} misses ({stats['expired']} expired) | "
+            f"{stats['stored']} stored, {stats['evicted']} evicted{' | refresh' if self.refresh else ''}"
+        )
+
+
+class Fetcher:
+    """
+    HTTP client used by 'twitter_scraper' for all requests
+
+    The fetcher replaces the 'requests' sessions of 'twitter_scraper' (see
+    'install()'). All downloads share one session, so keep-alive connections
+    are reused across accounts. Requests are paced by a 'RateLimiter'. Failed
+    requests (connection errors, timeouts, 429 and 5xx) are retried with
+    jittered exponential backoff. With 'base_url' the requests go to another
+    server than Twitter, e.g. a local test server with canned pages. With a
+    'ResponseCache', cached responses are returned without any request.
+
+    Attributes:
+        :session: (obj) 'requests.Session'
+        :limiter: (obj) 'RateLimiter'
+        :cache: (obj) 'ResponseCache' (or None)
+        :stats: (dict) number of requests, retries and failures, total latency
+    """
+
+    def __init__(self, *, rate=FETCH_RATE, retries=FETCH_RETRIES, timeout=FETCH_TIMEOUT, base_url=None, pool_size=10,
+                 cache=None):
+        requests = import_module('requests')
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=max(1, pool_size))
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.limiter = RateLimiter(rate)
+        self.retries = retries
+        self.timeout = timeout
+        self.base_url = base_url.rstrip('/') if base_url else None
+        self.cache = cache
+        self.stats = {'requests': 0, 'retries': 0, 'failed': 0, 'seconds': 0.0, 'max_seconds': 0.0}
+        self._lock = threading.Lock()
+        self._network_errors = (requests.ConnectionError, requests.Timeout)
+
+    @property
+    def hooks(self):
+        """Hooks of the session (see 'install_fetch_hooks()')"""
+
+        return self.session.hooks
+
+    def install(self):
+        """
+        Send all requests of 'twitter_scraper' through this fetcher
+
+        Returns:
+            :self: (obj) this fetcher
+        """
+
+        tw._load()
+        for module_name in FETCH_MODULES:
+            module = sys.modules.get(module_name)
+            if module is not None and hasattr(module, 'session'):
+                module.session = self
+        return self
+
+    def get_profile(self, username):
+        """Return the 'twitter_scraper' profile of an account"""
+
+        with METRICS.timer('download.profile'):
+            return tw.Profile(username)
+
+    def get_tweets(self, query, pages):
+        """Yield tweets of an account or hashtag (newest first)"""
+
+        yield from METRICS.timed_iter('download.fetch', tw.get_tweets(query, pages))
+
+    def search_tweets(self, query, pages):
+        """
+        Yield tweets of a search query (e.g. 'from:user since:2020-01-01')
+
+        'twitter_scraper' sends only hashtags to the search path. The query is
+        passed as a hashtag with 'SEARCH_PREFIX', which is removed again from
+        the URL in 'request()'.
+        """
+
+        yield from METRICS.timed_iter('download.fetch', tw.get_tweets(SEARCH_PREFIX + query, pages))
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def request(self, method, url, **kwargs):
+        """
+        Send a request, wait for the rate limiter and retry on failure
+
+        Cached responses are returned immediately (the rate limiter is not used).
+
+        Args:
+            :method: (str) HTTP method
+            :url: (str) URL
+            :kwargs: (dict) keyword arguments for 'requests.Session.request()'
+
+        Returns:
+            :response: (obj) 'requests.Response'
+        """
+
+        # Raw search query (see 'search_tweets()')
+        url = url.replace('q=' + quote(SEARCH_PREFIX), 'q=', 1)
+        if self.base_url is not None and url.startswith(TWITTER_URL):
+            url = self.base_url + url[len(TWITTER_URL):]
+        kwargs.setdefault('timeout', self.timeout)
+
+        if self.cache is not None:
+            response = self.cache.get(method, url, kwargs.get('params'))
+            if response is not None:
+                logger.debug(f"{method} {url} --> cache")
+                return response
+
+        for attempt in range(self.retries + 1):
+            METRICS.observe('fetch_wait_seconds', self.limiter.acquire())
+            start = time.perf_counter()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except self._network_errors as e:
+                response, error = None, e
+                reason = type(e).__name__
+            else:
+                reason = f"HTTP {response.status_code}"
+            seconds = time.perf_counter() - start
+            self._add_stats(seconds=seconds, retries=int(attempt > 0))
+            logger.debug(f"{method} {url} --> {reason} ({seconds:.2f} s)")
+
+            if response is not None and response.status_code not in FETCH_RETRY_STATUS:
+                self.limiter.relax()
+                if self.cache is not None:
+                    self.cache.put(method, url, kwargs.get('params'), response)
+                return response
+
+            # Only answers of the server are a sign of overload
+            if response is not None:
+                self.limiter.throttle()
+            if attempt == self.retries:
+                break
+            delay = self.get_backoff(attempt, response)
+            METRICS.count('fetch_retries', reason=reason)
+            logger.warning(
+                f"Request failed ({reason}), retry {attempt + 1}/{self.retries} in {delay:.1f} s "
+                f"(rate now {self.limiter.rate:.2f}/s): {url}"
+            )
+            time.sleep(delay)
+
+        self._add_stats(failed=1)
+        METRICS.count('fetch_failures', reason=reason)
+        if response is None:
+            raise error
+        response.raise_for_status()
+        return response
+
+    @staticmethod
+    def get_backoff(attempt, response=None):
+        """
+        Return the delay before the next attempt ('full jitter')
+
+        A 'Retry-After' header (in seconds) of the server is respected.
+
+        Args:
+            :attempt: (int) number of the failed attempt (0 for the first request)
+            :response: (obj) response of the failed request (or None)
+
+        Returns:
+            :delay: (float) seconds
+        """
+
+        delay = random.uniform(0, min(FETCH_MAX_BACKOFF, FETCH_BACKOFF*2**attempt))
+        retry_after = response.headers.get('Retry-After', '') if response is not None else ''
+        if retry_after.isdigit():
+            delay = max(delay, min(FETCH_MAX_BACKOFF, float(retry_after)))
+        return delay
+
+    def _add_stats(self, *, seconds=None, retries=0, failed=0):
+        with self._lock:
+            if seconds is not None:
+                self.stats['requests'] += 1
+                self.stats['seconds'] += seconds
+                self.stats['max_seconds'] = max(self.stats['max_seconds'], seconds)
+            self.stats['retries'] += retries
+            self.stats['failed'] += failed
+
+    def log_summary(self):
+        """Log number of requests, retries and latencies"""
+
+        stats = self.stats
+        mean = stats['seconds']/stats['requests'] if stats['requests'] else 0.0
+        logger.info(
+            f"Requests: {stats['requests']} ({stats['retries']} retries, {stats['failed']} failed) | "
+            f"latency {mean:.2f} s mean, {stats['max_seconds']:.2f} s max | rate {self.limiter.rate:.2f}/s"
+        )
+        if self.cache is not None:
+            self.cache.log_summary()
+
+
+# ----- Sharded download -----
+def get_date_windows(since, until, num_windows):
+    """
+    Split a period into date windows of (almost) equal length
+
+    Args:
+        :since: (obj) first day ('datetime.date')
+        :until: (obj) day after the last day ('datetime.date')
+        :num_windows: (int) number of windows (at most one window per day)
+
+    Returns:
+        :windows: (list) tuples (since, until), newest window first
+    """
+
+    num_days = (until - since).days
+    if num_days <= 0:
+        raise ValueError(f"Invalid period {since} to {until} (must contain at least one day)")
+    num_windows = max(1, min(num_windows, num_days))
+
+    windows = []
+    for i in range(num_windows):
+        start = since + datetime.timedelta(days=num_days*i//num_windows)
+        end = since + datetime.timedelta(days=num_days*(i + 1)//num_windows)
+        windows.append((start, end))
+    return windows[::-1]
+
+
+def get_search_query(username, since, until):
+    """Return the search query for the tweets of an account (or hashtag) in a date window"""
+
+    is_hashtag, _ = parse_filter_kw(username)
+    target = username if is_hashtag else f'from:{username}'
+    return f"{target} since:{since.strftime('%F')} until:{until.strftime('%F')}"
+
+
+def _fetch_window(fetcher, query, pages):
+    """Return the tweets of one date window, newest first"""
+
+    tweets = list(fetcher.search_tweets(query, pages))
+    # Equal times keep the order of the search results ('sorted()' is stable)
+    return sorted(tweets, key=lambda tweet: tweet['time'], reverse=True)
+
+
+def iter_sharded_tweets(fetcher, username, windows, pages, jobs=SHARD_JOBS):
+    """
+    Download date windows concurrently and yield tweets newest first
+
+    Each window is a separate search query, so a deep history is not limited
+    to one chain of timeline pages. Windows run in a pool of at most 'jobs'
+    threads (all requests still share the rate limiter of 'fetcher'). Tweets
+    are yielded window by window in the order of 'windows', duplicates (e.g.
+    at window boundaries) are skipped by tweet ID. Windows which are not
+    started yet are cancelled when the generator is closed.
+
+    Args:
+        :fetcher: (obj) 'Fetcher'
+        :username: (str) target twitter account or hashtag
+        :windows: (list) tuples (since, until), newest window first (see 'get_date_windows()')
+        :pages: (int) maximum number of pages per window
+        :jobs: (int) maximum number of concurrent windows
+
+    Yields:
+        :tweet: (dict) tweet
+    """
+
+    seen_ids = set()
+    jobs = max(1, min(jobs, len(windows)))
+    logger.info(f"[{username}] Downloading {len(windows)} date window(s) with {jobs} job(s)...")
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = [
+            pool.submit(_fetch_window, fetcher, get_search_query(username, since, until), pages)
+            for since, until in windows
+        ]
+        try:
+            for (since, until), future in zip(windows, futures):
+                tweets = future.result()
+                METRICS.count('shard_windows')
+                logger.info(f"[{username}] {since.strftime('%F')} to {until.strftime('%F')}: {len(tweets)} tweets")
+                for tweet in tweets:
+                    if tweet['tweetId'] in seen_ids:
+                        METRICS.count('shard_duplicates')
+                        continue
+                    seen_ids.add(tweet['tweetId'])
+                    yield tweet
+        finally:
+            for future in futures:
+                future.cancel()
+
+
+# ----- Download journal -----
+def recover_journal(filename):
+    """
+    Read a download journal and cut off an incomplete last record
+
+    The journal is a JSON Lines file. The first line holds the profile, every
+    following line holds one tweet. If the download was interrupted, the last
+    line may have been written only partially. It is removed, so that new
+    records can be appended.
+
+    Args:
+        :filename: (str) path of the journal
+
+    Returns:
+        :profile: (dict) profile data (or None if there is no valid header)
+        :tweet_ids: (set) IDs of tweets in the journal
+    """
+
+    profile = None
+    tweet_ids = set()
+    valid_size = 0
+
+    with open(filename, 'rb') as fp:
+        for line in fp:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            if not line.endswith(b'\n'):
+                break
+            if profile is None:
+                profile = record.get('profile', {})
+            else:
+                tweet_ids.add(record['tweetId'])
+            valid_size += len(line)
+
+    if valid_size != os.path.getsize(filename):
+        logger.warning(f"Removing incomplete record from journal {truncate_filepath(filename)}")
+        os.truncate(filename, valid_size)
+
+    return profile, tweet_ids
+
+
+def iter_journal_tweets(filename):
+    """
+    Yield the tweets stored in a download journal
+
+    Args:
+        :filename: (str) path of the journal
+    """
+
+    with open(filename, 'r') as fp:
+        next(fp, None)  # Header with profile data
+        for line in fp:
+            yield json.loads(line)
+
+
+@instrument('storage.sync')
+def sync_file(fp):
+    """
+    Flush a file object and force the data to be written to disk
+
+    Args:
+        :fp: (obj) file object
+    """
+
+    fp.flush()
+    os.fsync(fp.fileno())
+
+
+def dump_pretty_twitter_data(profile, tweets, fp):
+    """
+    Write twitter data as pretty JSON, one tweet at a time
+
+    The output is identical to 'dump_pretty_json()' for the dictionary
+    {'profile': profile, 'history': list(tweets)}, but 'tweets' can be a
+    generator, which is never held in memory as a whole.
+
+    Args:
+        :profile: (dict) profile data
+        :tweets: (iter) tweets
+        :fp: (obj) file object
+    """
+
+    def dumps(obj, indent):
+        string = json.dumps(obj, cls=DateTimeEncoder, indent=4, separators=(',', ': '))
+        return string.replace('\n', '\n' + ' '*indent)
+
+    fp.write('{\n    "profile": ' + dumps(profile, indent=4) + ',\n    "history": [')
+    separator = '\n        '
+    for tweet in tweets:
+        fp.write(separator + dumps(tweet, indent=8))
+        separator = ',\n        '
+    fp.write(('\n    ]' if separator.startswith(',') else ']') + '\n}')
+
+
+@instrument('download')
+def download_history(username, pages, incremental=False, storage='json', fetcher=None, skip_unchanged=False,
+                     windows=None):
+    """
+    Download tweets and save data on disk
+
+    Tweets are appended to a journal file as they are downloaded. The journal
+    is synced to disk every 'CHECKPOINT_INTERVAL' tweets. If a download is
+    interrupted, the next call continues with the same snapshot and only
+    appends tweets which are not yet in the journal. When the download is
+    complete, the journal is converted to the data file and removed.
+
+    Args:
+        :username: (str) target twitter account
+        :pages: (int) number of pages to download
+        :incremental: (bool) if True, stop after 'INCREMENTAL_KNOWN_RUN' consecutive
+                      tweets which are already part of the latest snapshot, and
+                      merge with that snapshot
+        :storage: (str) storage format of the data file (see 'STORAGE_FORMATS')
+        :fetcher: (obj) 'Fetcher' for all requests (a new one by default)
+        :skip_unchanged: (bool) if True (and 'incremental'), no new snapshot is
+                         saved if there are no new tweets
+        :windows: (list) date windows (see 'get_date_windows()'), if given, the
+                  windows are downloaded concurrently with search queries and
+                  'pages' applies to each window
+
+    Returns:
+        :file_user_data: (str) file path for the downloaded user data (the
+                         latest snapshot if no new snapshot was saved)
+    """
+
+    if fetcher is None:
+        fetcher = Fetcher()
+    fetcher.install()
+    if METRICS.enabled:
+        install_fetch_hooks()
+
+    try:
+        profile = fetcher.get_profile(username)
+        logger.info(f"Target: {username} ({profile.name}) | {profile.followers_count:,} followers")
+    except Exception as e:
+        is_hashtag, _ = parse_filter_kw(username)
+        if is_hashtag:
+            logger.info(f"Interpreting {username!r} as a hashtag...")
+        else:
+            logger.error(f"Failed to fetch username data for {username!r}: {e!r}")
+        profile = None
+
+    # Only the IDs of the previous snapshot are kept in memory, its tweets are streamed when merging
+    known_ids = set()
+    file_latest = None
+    if incremental:
+        file_latest = find_latest_snapshot(username)
+        if file_latest is None:
+            logger.info(f"[{username}] No previous snapshot found, downloading full history...")
+        else:
+            known_ids = {tweet['tweetId'] for tweet in read_twitter_data(file_latest)[1]}
+            logger.info(f"[{username}] Found {len(known_ids)} tweets in previous snapshot...")
+
+    dir_user_data = find_unfinished_snapshot(username)
+    journal_ids = set()
+    if dir_user_data is None:
+        now = datetime.datetime.now()
+        dir_user_data = os.path.join(DIR_DATA, f"{username}_{now.strftime('%F_%H%M')}")
+        mkdir(dir_user_data)
+    file_journal = os.path.join(dir_user_data, JOURNAL_FILENAME)
+    file_user_data = get_data_filename(dir_user_data, storage)
+
+    journal_profile = None
+    if os.path.isfile(file_journal):
+        journal_profile, journal_ids = recover_journal(file_journal)
+        logger.info(f"[{username}] Resuming interrupted download ({len(journal_ids)} tweets saved)...")
+
+    if windows:
+        logger.info(f"[{username}] Downloading tweets ({pages} pages per window)...")
+        tweet_source = iter_sharded_tweets(fetcher, username, windows, pages)
+    else:
+        logger.info(f"[{username}] Downloading tweets ({pages} pages)...")
+        tweet_source = fetcher.get_tweets(username, pages)
+    num_tweets = 0
+    num_known = 0  # Consecutive tweets of the previous snapshot
+    with open(file_journal, 'a') as fp:
+        journal_start = fp.tell()
+        if journal_profile is None:
+            journal_profile = profile.to_dict() if profile is not None else {}
+            fp.write(json.dumps({'profile': journal_profile}, cls=DateTimeEncoder) + '\n')
+
+        for tweet in tweet_source:
+            num_tweets += 1
+            METRICS.count('tweets_downloaded')
+            if tweet['tweetId'] not in journal_ids:
+                journal_ids.add(tweet['tweetId'])
+                fp.write(json.dumps(tweet, cls=DateTimeEncoder) + '\n')
+                if len(journal_ids) % CHECKPOINT_INTERVAL == 0:
+                    sync_file(fp)
+            # Tweets arrive newest first, so everything after a run of known tweets is
+            # already known. A single known tweet (e.g. a pinned tweet on top) is not enough.
+            num_known = num_known + 1 if tweet['tweetId'] in known_ids else 0
+            if known_ids and num_known >= min(INCREMENTAL_KNOWN_RUN, len(known_ids)):
+                logger.info(f"[{username}] Reached previous snapshot, stop downloading...")
+                break
+        tweet_source.close()  # Cancels pending date windows
+        sync_file(fp)
+        METRICS.count('bytes_written', fp.tell() - journal_start, kind='journal')
+    logger.info(f"[{username}] Downloaded {num_tweets} tweets...")
+
+    if skip_unchanged and file_latest is not None and journal_ids <= known_ids:
+        logger.info(f"[{username}] No new tweets, keeping {truncate_filepath(file_latest)}")
+        os.remove(file_journal)
+        try:
+            os.rmdir(dir_user_data)
+        except OSError:
+            pass
+        return file_latest
+
+    tweets = iter_journal_tweets(file_journal)
+    if file_latest is not None:
+        tweets = iter_unique_tweets(tweets, read_twitter_data(file_latest)[1])
+        logger.info(f"[{username}] Merging with previous snapshot...")
+
+    logger.info(f"[{username}] Saving data: {truncate_filepath(file_user_data)}")
+    stats = {}
+    write_twitter_data(journal_profile, _iter_with_stats(tweets, stats), file_user_data, storage)
+    os.remove(file_journal)
+    add_to_catalog(file_user_data, stats)
+
+    return file_user_data
+
+
+def _download_account(username, pages, incremental, storage, fetcher, windows=None, media=None):
+    """Download an account and (optionally) its media, return the path of the data file"""
+
+    json_file = download_history(username, pages, incremental, storage, fetcher, windows=windows)
+    if media is not None:
+        media.fetch_file(json_file)
+    return json_file
+
+
+def download_accounts(usernames, pages, *, jobs=1, incremental=False, storage='json', excel=True, excel_options=None,
+                      fetch_options=None, windows=None, media_options=None):
+    """
+    Download several accounts concurrently and convert the data to Excel
+
+    Downloads run in a pool of at most 'jobs' threads. Excel conversion is
+    a separate stage with its own (single) worker, so finished accounts are
+    converted while other downloads are still waiting for the network.
+
+    Args:
+        :usernames: (list) target twitter accounts
+        :pages: (int) number of pages to download per account
+        :jobs: (int) maximum number of concurrent downloads
+        :incremental: (bool) if True, merge new tweets into the latest snapshots
+        :storage: (str) storage format of the data files (see 'STORAGE_FORMATS')
+        :excel: (bool) if True, convert downloaded data to Excel files
+        :excel_options: (dict) keyword arguments for 'convert_to_excel()' (filters, ...)
+        :fetch_options: (dict) keyword arguments for 'Fetcher()' (rate, retries, ...)
+        :windows: (list) date windows downloaded concurrently per account (see 'get_date_windows()')
+        :media_options: (dict) keyword arguments for 'MediaDownloader()', if given, the
+                        photos and videos of each account are downloaded after its tweets
+
+    Returns:
+        :results: (dict) username as key and True (success) or False (failure) as value
+    """
+
+    results = OrderedDict((username, False) for username in usernames)
+    jobs = max(1, min(jobs, len(usernames)))
+    logger.info(f"Downloading {len(usernames)} account(s) with {jobs} job(s)...")
+    num_windows = min(len(windows), SHARD_JOBS) if windows else 1
+    fetcher = Fetcher(pool_size=jobs*num_windows, **(fetch_options or {}))
+    media = MediaDownloader(**media_options) if media_options is not None else None
+
+    with ThreadPoolExecutor(max_workers=jobs) as down_pool, ThreadPoolExecutor(max_workers=1) as xl_pool:
+        down_futures = {
+            down_pool.submit(_download_account, username, pages, incremental, storage, fetcher, windows, media): username
+            for username in usernames
+        }
+        xl_futures = {}
+
+        for future in as_completed(down_futures):
+            username = down_futures[future]
+            try:
+                json_file = future.result()
+            except Exception as e:
+                logger.error(f"[{username}] Download failed: {e!r}")
+                continue
+
+            if excel:
+                xl_futures[xl_pool.submit(convert_file_to_excel, json_file, **(excel_options or {}))] = username
+            else:
+                logger.info(f"[{username}] Done: {truncate_filepath(json_file)}")
+                results[username] = True
+
+        for future in as_completed(xl_futures):
+            username = xl_futures[future]
+            try:
+                excel_file = future.result()
+            except Exception as e:
+                logger.error(f"[{username}] Excel conversion failed: {e!r}")
+            else:
+                logger.info(f"[{username}] Done: {truncate_filepath(excel_file)}")
+                results[username] = True
+
+    fetcher.log_summary()
+    if media is not None:
+        media.close()
+    failed = [username for username, success in results.items() if not success]
+    logger.info(f"Summary: {len(results) - len(failed)} succeeded, {len(failed)} failed")
+    if failed:
+        logger.error(f"Failed accounts: {', '.join(failed)}")
+    return results
+
+
+# ----- Media -----
+def get_media_urls(tweet):
+    """
+    Return the URLs of the photos and videos of a tweet
+
+    Note: 'twitter_scraper' only saves the ID of a video, videos without a
+    URL ('url' or 'preview') cannot be downloaded.
+
+    Args:
+        :tweet: (dict) tweet
+
+    Returns:
+        :urls: (list) media URLs
+    """
+
+    entries = tweet.get('entries', {})
+    urls = list(entries.get('photos', ()))
+    for video in entries.get('videos', ()):
+        url = (video.get('url') or video.get('preview')) if isinstance(video, dict) else video
+        if url:
+            urls.append(url)
+    return urls
+
+
+def iter_tweets_with_media(tweets, store, start=os.curdir):
+    """
+    Yield tweets with a key 'media', the paths of their files in a 'MediaStore'
+
+    The files are looked up by the URLs of each tweet (see 'get_media_urls()')
+    in the index of the store, tweets without downloaded files get an empty list.
+
+    Args:
+        :tweets: (iter) tweets
+        :store: (obj) 'MediaStore'
+        :start: (str) directory the paths are relative to (e.g. of the data file)
+
+    Yields:
+        :tweet: (dict) tweet
+    """
+
+    for tweet in tweets:
+        tweet['media'] = store.get_paths(get_media_urls(tweet), start)
+        yield tweet
+
+
+def get_media_index_size(dirname=None):
+    """Return the size of the index of a 'MediaStore' in bytes (0 if there is none)"""
+
+    try:
+        return os.path.getsize(os.path.join(DIR_MEDIA if dirname is None else dirname, MEDIA_INDEX_FILENAME))
+    except OSError:
+        return 0
+
+
+class MediaStore:
+    """
+    Content-addressed store of downloaded media files
+
+    Files are named after the SHA-256 hash of their content (e.g.
+    'objects/3f/3fa1...jpg'), so a photo which appears in several tweets,
+    accounts or snapshots is stored only once. The index ('.index.jsonl', one
+    line per download) maps URLs to files, known URLs are not downloaded
+    again. Unfinished downloads are kept in 'partial' and continued with a
+    range request. The data files are never changed, the sheets look up the
+    files of a tweet by its URLs (see 'get_paths()').
+
+    Attributes:
+        :dirname: (str) directory of the store
+        :index: (dict) URL as key and path of the file (relative to 'dirname') as value
+    """
+
+    def __init__(self, dirname=DIR_MEDIA):
+        self.dirname = dirname
+        self.index = {}
+        self._lock = threading.Lock()
+
+        try:
+            with open(os.path.join(dirname, MEDIA_INDEX_FILENAME), 'r', encoding='utf-8') as fp:
+                for line in fp:
+                    try:
+                        entry = json.loads(line)
+                        self.index[entry['url']] = entry['path']
+                    except (ValueError, KeyError, TypeError):
+                        continue  # E.g. last line of an interrupted run
+        except FileNotFoundError:
+            pass
+
+    def get(self, url):
+        """Return the path of the file of a URL (or None if it was not downloaded yet)"""
+
+        path = self.index.get(url)
+        if path is None:
+            return None
+        path = os.path.join(self.dirname, path)
+        return path if os.path.isfile(path) else None
+
+    def get_paths(self, urls, start=os.curdir):
+        """
+        Return the paths of the downloaded files of some URLs
+
+        Args:
+            :urls: (list) media URLs (see 'get_media_urls()')
+            :start: (str) directory the paths are relative to (e.g. of the Excel file)
+
+        Returns:
+            :paths: (list) relative paths (with '/'), URLs which were not downloaded are left out
+        """
+
+        paths = (self.get(url) for url in urls)
+        return [Path(os.path.relpath(path, start)).as_posix() for path in paths if path is not None]
+
+    def fetch(self, url, fetcher):
+        """
+        Download a file (unless it is already in the store)
+
+        Args:
+            :url: (str) media URL
+            :fetcher: (obj) 'Fetcher'
+
+        Returns:
+            :path: (str) path of the file
+        """
+
+        path = self.get(url)
+        if path is not None:
+            return path
+
+        mkdir(os.path.join(self.dirname, 'partial'))
+        file_partial = os.path.join(self.dirname, 'partial', hashlib.sha256(url.encode('utf-8')).hexdigest())
+        requests = import_module('requests')
+        errors = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)
+        for attempt in range(MEDIA_ATTEMPTS):
+            try:
+                content_type = self._download(url, file_partial, fetcher)
+                break
+            except errors as e:
+                if attempt + 1 == MEDIA_ATTEMPTS:
+                    raise
+                logger.warning(f"Media download interrupted ({type(e).__name__}), continuing: {url}")
+
+        sha256 = hashlib.sha256()
+        with open(file_partial, 'rb') as fp:
+            for chunk in iter(partial(fp.read, 1 << 20), b''):
+                sha256.update(chunk)
+        digest = sha256.hexdigest()
+        suffix = os.path.splitext(urlsplit(url).path)[1].lower()
+        if not re.fullmatch(r'\.[a-z0-9]{1,5}', suffix):
+            suffix = mimetypes.guess_extension(content_type or '') or ''
+        relpath = f"objects/{digest[:2]}/{digest}{suffix}"
+        path = os.path.join(self.dirname, relpath)
+
+        mkdir(os.path.dirname(path))
+        if os.path.isfile(path):
+            os.remove(file_partial)  # Same content from another URL
+            METRICS.count('media_duplicates')
+        else:
+            os.replace(file_partial, path)
+
+        with self._lock:
+            self.index[url] = relpath
+            with open(os.path.join(self.dirname, MEDIA_INDEX_FILENAME), 'a', encoding='utf-8') as fp:
+                fp.write(json.dumps({'url': url, 'path': relpath, 'size': os.path.getsize(path)}) + '\n')
+        return path
+
+    def _download(self, url, file_partial, fetcher):
+        """Download to 'file_partial' (continued if it exists), return the content type"""
+
+        offset = os.path.getsize(file_partial) if os.path.isfile(file_partial) else 0
+        headers = {'Range': f'bytes={offset}-'} if offset else {}
+        response = fetcher.get(url, headers=headers, stream=True)
+        with response:
+            if response.status_code == 416:  # Range not satisfiable, start again
+                os.remove(file_partial)
+                return self._download(url, file_partial, fetcher)
+            response.raise_for_status()
+            # Servers without range requests send the whole file again
+            mode = 'ab' if response.status_code == 206 else 'wb'
+            with open(file_partial, mode) as fp:
+                for chunk in response.iter_content(MEDIA_CHUNK_SIZE):
+                    fp.write(chunk)
+                    METRICS.count('bytes_received', len(chunk), kind='media')
+            return response.headers.get('Content-Type', '').split(';')[0].strip()
+
+
+class MediaDownloader:
+    """
+    Download the media of twitter data files to a 'MediaStore'
+
+    All downloads share one pool of at most 'jobs' threads and a separate
+    'Fetcher' (media servers are not paced like Twitter pages). A URL which
+    is requested by several files at once is downloaded only once. The data
+    files are only read, the index of the store maps the URLs to the files.
+
+    Attributes:
+        :store: (obj) 'MediaStore'
+        :fetcher: (obj) 'Fetcher'
+        :stats: (dict) number of downloaded, known, failed and skipped media
+    """
+
+    def __init__(self, store=None, *, jobs=MEDIA_JOBS, fetch_options=None):
+        fetch_options = dict({'rate': MEDIA_RATE}, **(fetch_options or {}))
+        fetch_options['cache'] = None  # Files are kept in the store, not in the response cache
+        self.store = store if store is not None else MediaStore()
+        self.fetcher = Fetcher(pool_size=jobs, **fetch_options)
+        self.stats = {'downloaded': 0, 'known': 0, 'failed': 0, 'skipped': 0}
+        self._pool = ThreadPoolExecutor(max_workers=max(1, jobs))
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def _submit(self, url):
+        with self._lock:
+            future = self._futures.get(url)
+            if future is None:
+                future = self._futures[url] = self._pool.submit(self.store.fetch, url, self.fetcher)
+            return future
+
+    def fetch_urls(self, urls):
+        """
+        Download media files concurrently
+
+        Args:
+            :urls: (iter) media URLs
+
+        Returns:
+            :paths: (dict) URL as key and path of the file as value (None if the download failed)
+        """
+
+        paths = OrderedDict()
+        futures = OrderedDict()
+        for url in OrderedDict.fromkeys(urls):
+            path = self.store.get(url)
+            if path is not None:
+                paths[url] = path
+                self._add_stats('known')
+            else:
+                futures[url] = self._submit(url)
+
+        for url, future in futures.items():
+            try:
+                paths[url] = future.result()
+            except Exception as e:
+                logger.warning(f"Media download failed ({e!r}): {url}")
+                paths[url] = None
+                self._add_stats('failed')
+            else:
+                self._add_stats('downloaded')
+            with self._lock:
+                self._futures.pop(url, None)  # Failed URLs are tried again by the next file
+        return paths
+
+    @instrument('media.file')
+    def fetch_file(self, json_file):
+        """
+        Download the media of a data file
+
+        Args:
+            :json_file: (str) path of the twitter data file
+
+        Returns:
+            :num_files: (int) number of media files of the tweets in the store
+        """
+
+        # Only the URLs are kept in memory, in the order of the tweets
+        urls = []
+        num_skipped = 0
+        for tweet in read_twitter_data(json_file)[1]:
+            tweet_urls = get_media_urls(tweet)
+            entries = tweet.get('entries', {})
+            num_skipped += len(entries.get('photos', ())) + len(entries.get('videos', ())) - len(tweet_urls)
+            urls.extend(tweet_urls)
+        self._add_stats('skipped', num_skipped)
+
+        logger.info(f"Downloading {len(set(urls))} media file(s) of {truncate_filepath(json_file)}...")
+        paths = self.fetch_urls(urls)
+        return sum(path is not None for path in paths.values())
+
+    def _add_stats(self, key, value=1):
+        if not value:
+            return
+        with self._lock:
+            self.stats[key] += value
+        METRICS.count('media_files', value, result=key)
+
+    def close(self):
+        """Wait for running downloads and log a summary"""
+
+        self._pool.shutdown(wait=True)
+        stats = self.stats
+        logger.info(
+            f"Media: {stats['downloaded']} downloaded, {stats['known']} already stored, "
+            f"{stats['failed']} failed, {stats['skipped']} videos without URL"
+        )
+        self.fetcher.log_summary()
+
+
+def download_media_files(filenames, *, jobs=MEDIA_JOBS, store_dir=DIR_MEDIA, fetch_options=None):
+    """
+    Download the media of several data files (see 'MediaDownloader')
+
+    Args:
+        :filenames: (list) paths of the twitter data files
+        :jobs: (int) maximum number of concurrent downloads
+        :store_dir: (str) directory of the 'MediaStore'
+        :fetch_options: (dict) keyword arguments for 'Fetcher()' (rate, retries, ...)
+
+    Returns:
+        :results: (dict) filename as key and True (success) or False (failure) as value
+    """
+
+    results = OrderedDict((filename, False) for filename in filenames)
+    downloader = MediaDownloader(MediaStore(store_dir), jobs=jobs, fetch_options=fetch_options)
+    try:
+        for filename in filenames:
+            try:
+                downloader.fetch_file(filename)
+            except Exception as e:
+                logger.error(f"Failed to download media of {truncate_filepath(filename)}: {e!r}")
+            else:
+                results[filename] = True
+    finally:
+        downloader.close()
+    return results
+
+
+# ----- Watch -----
+def estimate_tweet_rate(filename, days=WATCH_RATE_DAYS):
+    """
+    Return the average number of tweets per day of an account in the most recent days
+
+    Args:
+        :filename: (str) path of the data file of the latest snapshot
+        :days: (int) number of days to consider (fewer if the history is shorter)
+
+    Returns:
+        :tweets_per_day: (float) average number of tweets per day
+    """
+
+    _, tweets = read_column_table(filename)
+    tweets_per_day = get_tweets_per_day(build_tweet_table(tweets))
+    if not tweets_per_day:
+        return 0.0
+
+    now = datetime.datetime.now()
+    start = max(next(iter(tweets_per_day)), now - datetime.timedelta(days=days))
+    num_tweets = sum(count for day, count in tweets_per_day.items() if day >= start)
+    return num_tweets/max(1.0, (now - start).total_seconds()/SECONDS_PER_DAY)
+
+
+def get_poll_interval(tweets_per_day, min_interval=WATCH_MIN_INTERVAL, max_interval=WATCH_MAX_INTERVAL):
+    """
+    Return the time between two polls of an account
+
+    An account is polled when about 'WATCH_TWEETS_PER_POLL' new tweets are expected.
+
+    Args:
+        :tweets_per_day: (float) average number of tweets per day (or None if unknown)
+        :min_interval: (float) minimum interval in seconds
+        :max_interval: (float) maximum interval in seconds
+
+    Returns:
+        :interval: (float) seconds
+    """
+
+    if tweets_per_day is None:
+        return min_interval
+    if tweets_per_day <= 0:
+        return max_interval
+    return min(max_interval, max(min_interval, WATCH_TWEETS_PER_POLL/tweets_per_day*SECONDS_PER_DAY))
+
+
+class WatchSchedule:
+    """
+    Poll schedule of the accounts in mode 'watch'
+
+    The accounts are kept in a priority queue (heap) ordered by the time of
+    their next poll. The state of each account (interval, time of the next
+    poll, number of polls and failures, snapshot saved by the last poll) is
+    saved in a JSON file, so that a
+    restarted daemon continues with the same schedule. Accounts in the file
+    which are not watched in this run are kept in the file.
+
+    Attributes:
+        :accounts: (dict) username as key and state (dict) as value
+    """
+
+    def __init__(self, filename, usernames, *, min_interval=WATCH_MIN_INTERVAL, max_interval=WATCH_MAX_INTERVAL):
+        self.filename = str(filename)
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self._saved = self._load()
+        self._heap = []
+        self.accounts = OrderedDict()
+
+        now = time.time()
+        for username in usernames:
+            state = self._saved.get(username, {})
+            self.accounts[username] = {
+                'interval': state.get('interval', min_interval),
+                'next_poll': state.get('next_poll', now),
+                'last_poll': state.get('last_poll'),
+                'tweets_per_day': state.get('tweets_per_day'),
+                'polls': state.get('polls', 0),
+                'failures': state.get('failures', 0),
+                'snapshot': state.get('snapshot'),
+            }
+            heapq.heappush(self._heap, (self.accounts[username]['next_poll'], username))
+
+    def _load(self):
+        try:
+            with open(self.filename, 'r') as fp:
+                accounts = json.load(fp)['accounts']
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.warning(f"Ignoring watch state {truncate_filepath(self.filename)!r}: {e}")
+            return {}
+        return accounts if isinstance(accounts, dict) else {}
+
+    def next_due(self):
+        """Return the time of the next poll (or None if no account is waiting)"""
+
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now):
+        """
+        Remove the account with the earliest poll from the queue, if it is due
+
+        Args:
+            :now: (float) current time (seconds since 1970-01-01)
+
+        Returns:
+            :username: (str) account to poll (or None if no account is due)
+        """
+
+        if not self._heap or self._heap[0][0] > now:
+            return None
+        return heapq.heappop(self._heap)[1]
+
+    def reschedule(self, username, tweets_per_day=None, failed=False):
+        """
+        Put an account back into the queue after a poll
+
+        After a failure the account is polled again with exponential backoff
+        (starting from 'min_interval'), the regular interval is not changed.
+
+        Args:
+            :username: (str) account
+            :tweets_per_day: (float) tweet rate after a successful poll
+            :failed: (bool) True if the poll failed
+
+        Returns:
+            :delay: (float) seconds until the next poll
+        """
+
+        state = self.accounts[username]
+        now = time.time()
+        state['last_poll'] = now
+        state['polls'] += 1
+        if failed:
+            state['failures'] += 1
+            delay = min(self.max_interval, self.min_interval*2**(state['failures'] - 1))
+        else:
+            state['failures'] = 0
+            state['tweets_per_day'] = tweets_per_day
+            state['interval'] = delay = get_poll_interval(tweets_per_day, self.min_interval, self.max_interval)
+        state['next_poll'] = now + delay
+        heapq.heappush(self._heap, (state['next_poll'], username))
+        return delay
+
+    def save(self):
+        """Write the state of all accounts to disk"""
+
+        accounts = OrderedDict(self._saved)
+        accounts.update(self.accounts)
+        try:
+            mkdir(os.path.dirname(os.path.abspath(self.filename)))
+            with open(self.filename + '.tmp', 'w') as fp:
+                json.dump({'accounts': accounts}, fp, indent=2)
+            os.replace(self.filename + '.tmp', self.filename)
+        except OSError as e:
+            logger.warning(f"Could not save watch state {truncate_filepath(self.filename)!r}: {e}")
+
+
+def _watch_poll(username, pages, storage, fetcher, previous=None):
+    """
+    Download new tweets of an account (runs in a worker thread of 'watch_accounts()')
+
+    New tweets are merged with the latest snapshot. If that snapshot was saved
+    by the previous poll ('previous'), it is removed after the merge, so the
+    watch keeps only one snapshot per account. Snapshots of other modes (e.g.
+    'down') are never removed.
+
+    Args:
+        :username: (str) target twitter account
+        :pages: (int) maximum number of pages
+        :storage: (str) storage format of the data file (see 'STORAGE_FORMATS')
+        :fetcher: (obj) 'Fetcher'
+        :previous: (str) data file saved by the previous poll of the account
+
+    Returns:
+        :filename: (str) data file of the new snapshot (None if no snapshot was saved)
+        :tweets_per_day: (float) tweet rate of the account
+    """
+
+    file_latest = find_latest_snapshot(username)
+    filename = download_history(username, pages, incremental=True, storage=storage, fetcher=fetcher, skip_unchanged=True)
+    tweets_per_day = estimate_tweet_rate(filename)
+    if file_latest is not None and os.path.abspath(filename) == os.path.abspath(file_latest):
+        return None, tweets_per_day
+
+    if previous is not None and file_latest is not None and os.path.abspath(previous) == os.path.abspath(file_latest):
+        logger.info(f"[{username}] Removing superseded snapshot {truncate_filepath(file_latest)}")
+        remove_snapshot(file_latest)
+    return filename, tweets_per_day
+
+
+def watch_accounts(usernames, pages, *, jobs=1, storage='json', state_file=FILE_WATCH_STATE,
+                   min_interval=WATCH_MIN_INTERVAL, max_interval=WATCH_MAX_INTERVAL, fetch_options=None,
+                   stop=None, max_polls=None):
+    """
+    Poll accounts for new tweets until stopped
+
+    Each account is polled with an interval based on its own tweet rate (see
+    'get_poll_interval()'), so active accounts are polled often and quiet
+    accounts rarely. At most 'jobs' polls run at the same time. Each poll is
+    an incremental download, a new snapshot is only saved if there are new
+    tweets. It replaces the snapshot of the previous poll (see '_watch_poll()'),
+    so the history of an account is stored only once. The schedule is saved after each poll and when the daemon stops.
+    Polls which are running when the daemon is stopped are completed.
+
+    Args:
+        :usernames: (list) target twitter accounts
+        :pages: (int) maximum number of pages per poll
+        :jobs: (int) maximum number of concurrent polls
+        :storage: (str) storage format of the data files (see 'STORAGE_FORMATS')
+        :state_file: (str) path of the schedule file
+        :min_interval: (float) minimum seconds between two polls of an account
+        :max_interval: (float) maximum seconds between two polls of an account
+        :fetch_options: (dict) keyword arguments for 'Fetcher()' (rate, retries, ...)
+        :stop: (obj) 'threading.Event', the daemon stops when it is set
+        :max_polls: (int) stop after this number of polls (no limit by default)
+
+    Returns:
+        :accounts: (dict) username as key and state (dict) as value (see 'WatchSchedule')
+    """
+
+    stop = stop if stop is not None else threading.Event()
+    schedule = WatchSchedule(state_file, usernames, min_interval=min_interval, max_interval=max_interval)
+    jobs = max(1, min(jobs, len(usernames)))
+    fetcher = Fetcher(pool_size=jobs, **(fetch_options or {}))
+    running = {}
+    num_polls = 0
+    logger.info(f"Watching {len(usernames)} account(s) with {jobs} job(s) (stop with Ctrl+C)...")
+
+    def finish(future):
+        username = running.pop(future)
+        try:
+            filename, tweets_per_day = future.result()
+        except Exception as e:
+            delay = schedule.reschedule(username, failed=True)
+            logger.error(f"[{username}] Poll failed: {e!r}, retry in {delay/60:.0f} min")
+        else:
+            if filename is not None:
+                schedule.accounts[username]['snapshot'] = filename
+            delay = schedule.reschedule(username, tweets_per_day)
+            logger.info(f"[{username}] {tweets_per_day:.1f} tweets per day, next poll in {delay/60:.0f} min")
+        schedule.save()
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        try:
+            while not stop.is_set():
+                polls_left = max_polls is None or num_polls < max_polls
+                while polls_left and len(running) < jobs:
+                    username = schedule.pop_due(time.time())
+                    if username is None:
+                        break
+                    previous = schedule.accounts[username]['snapshot']
+                    running[pool.submit(_watch_poll, username, pages, storage, fetcher, previous)] = username
+                    num_polls += 1
+                    polls_left = max_polls is None or num_polls < max_polls
+
+                if not polls_left and not running:
+                    break
+
+                # Wake up when the next account is due, a poll is done, or to check for shutdown
+                timeout = WATCH_TICK
+                next_due = schedule.next_due()
+                if polls_left and len(running) < jobs and next_due is not None:
+                    timeout = min(timeout, max(0.0, next_due - time.time()))
+                if running:
+                    done, _ = wait_futures(running, timeout=timeout, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        finish(future)
+                else:
+                    stop.wait(timeout)
+        except KeyboardInterrupt:
+            stop.set()
+        finally:
+            if running:
+                logger.info(f"Stopping, waiting for {len(running)} poll(s)...")
+            for future in as_completed(list(running)):
+                finish(future)
+            schedule.save()
+
+    fetcher.log_summary()
+    logger.info(f"Stopped after {num_polls} poll(s), schedule saved: {truncate_filepath(state_file)}")
+    return schedule.accounts
+
+
+def daterange(start_date, end_date):
+    """
+    Yield datetime objects (delta = 1 day) between start and end date
+
+    Args:
+        :start_date: (obj) start datetime object
+        :end_date: (obj) end datetime object
+
+    Note:
+        * https://stackoverflow.com/questions/1060279/iterating-through-a-range-of-dates-in-python
+    """
+
+    for n in range(int((end_date - start_date).days)):
+        yield start_date + datetime.timedelta(n)
+
+
+def get_tweets_per_day(twitter_data, count_zero_days=True, include_retweet=True):
+    """
+    Return the number of tweets posted per day
+
+    Args:
+        :twitter_data: (dict) dictionary with twitter data (or 'TweetTable')
+        :count_zero_days: (bool) if True, include days with zero tweets
+        :include_retweet: (bool) if True, include retweets
+
+    Returns:
+        :tweets_per_day: (dict) day (datetime object) as key and tweet count as value
+    """
+
+    logger.info(f"Counting tweets per day (including retweets: {include_retweet})...")
+    activity = aggregate_activity(as_tweet_table(twitter_data), 'day')
+    counts = activity['totTweets'] if include_retweet else activity['ownTweets']
+
+    (nonzero,) = np.nonzero(counts)
+    if count_zero_days and nonzero.size > 1:
+        logger.info("Looking for days with zero tweets...")
+        keep = slice(nonzero[0], nonzero[-1] + 1)
+        start_date, end_date = (_to_datetime(activity['bins'][i]) for i in (nonzero[0], nonzero[-1]))
+        logger.info(f"Date range is {start_date.strftime('%F')} to {end_date.strftime('%F')}")
+    else:
+        keep = nonzero
+
+    return OrderedDict(zip(map(_to_datetime, activity['bins'][keep]), counts[keep].tolist()))
+
+
+def _to_datetime(datetime64):
+    """Convert a NumPy 'datetime64' to a 'datetime' object"""
+
+    return datetime64.astype('datetime64[s]').astype(datetime.datetime)
+
+
+def _activity_bins(epochs, granularity):
+    """
+    Assign each timestamp to a bin of the given granularity
+
+    Args:
+        :epochs: (array) timestamps in seconds since 1970-01-01
+        :granularity: (str) one of 'ACTIVITY_GRANULARITIES'
+
+    Returns:
+        :index: (array) bin index for each timestamp
+        :bins: (array) labels of the bins ('datetime64', or hour of the week for 'heatmap')
+    """
+
+    days = epochs//SECONDS_PER_DAY
+
+    if granularity == 'heatmap':
+        # 1970-01-01 was a Thursday, shift by three days so that Monday is 0
+        index = ((days + 3) % 7)*24 + (epochs//3600) % 24
+        return index, np.arange(7*24)
+
+    if granularity == 'hour':
+        keys, unit = epochs//3600, 'h'
+    elif granularity == 'day':
+        keys, unit = days, 'D'
+    elif granularity == 'week':
+        keys, unit = (days + 3)//7, 'W'
+    elif granularity == 'month':
+        keys, unit = epochs.astype('datetime64[s]').astype('datetime64[M]').astype(np.int64), 'M'
+    else:
+        raise ValueError(f"Unknown granularity {granularity!r}")
+
+    if keys.size == 0:
+        return keys, np.array([], dtype=f'datetime64[{unit}]')
+
+    first = keys.min()
+    index = keys - first
+    bins = np.arange(first, keys.max() + 1)
+    if unit == 'W':
+        # Label weeks with the date of their Monday
+        return index, (bins*7 - 3).astype('datetime64[D]')
+    return index, bins.astype(f'datetime64[{unit}]')
+
+
+@instrument('activity.aggregate')
+def aggregate_activity(table, granularity='day', mask=None):
+    """
+    Count tweets and sum up engagement for each time interval
+
+    All numbers are computed in one pass over the columns of the table. For
+    all granularities except 'heatmap', intervals without tweets between the
+    first and the last tweet are included (with zeros).
+
+    Args:
+        :table: (obj) 'TweetTable'
+        :granularity: (str) 'hour', 'day', 'week', 'month' or 'heatmap' (hour of the week)
+        :mask: (array) optional boolean array, only tweets marked True are counted
+
+    Returns:
+        :activity: (dict) arrays 'bins' (labels), 'totTweets', 'ownTweets',
+                   'reTweets', 'sumLikes', 'sumRetweets' and 'sumReplies'
+    """
+
+    columns = {
+        'epochs': table.epochs,
+        'is_retweet': table.is_retweet,
+        'likes': table.likes,
+        'retweets': table.retweets,
+        'replies': table.replies,
+    }
+    if mask is not None:
+        columns = {key: column[mask] for key, column in columns.items()}
+
+    index, bins = _activity_bins(columns['epochs'], granularity)
+    count = partial(np.bincount, index, minlength=len(bins))
+
+    total = count()
+    retweets = count(weights=columns['is_retweet']).astype(np.int64)
+    return OrderedDict((
+        ('bins', bins),
+        ('totTweets', total),
+        ('ownTweets', total - retweets),
+        ('reTweets', retweets),
+        ('sumLikes', count(weights=columns['likes']).astype(np.int64)),
+        ('sumRetweets', count(weights=columns['retweets']).astype(np.int64)),
+        ('sumReplies', count(weights=columns['replies']).astype(np.int64)),
+    ))
+
+
+def _sort_date_dict(date_dict):
+    """
+    Sort a dictionary with dates as keys in chronological order
+
+    Args:
+        :date_dict: (dict) dictionary (key must be dates in sortable format)
+
+    Returns:
+        :sorted_dict: (dict) dictionary sorted by keys
+    """
+
+    # Note: OrderedDict() should not be necessary in 3.8
+    return OrderedDict({k: v for k, v in sorted(date_dict.items())})
+
+
+def _check_time_format(tweets):
+    """
+    Sanity check of the date format of tweets
+
+    Args:
+        :tweets: (list) Tweets from 'twitter_data'
+    """
+
+    # Date string in iso-format expected.
+    # We assume that if first tweet looks okay, all will.
+    time_first_tweet = tweets[0]['time']
+    if not isinstance(time_first_tweet, str):
+        raise TypeError(f"Date must be a string, not {type(time_first_tweet)}")
+
+    match_iso8601 = re.compile(
+       r'^(-?(?:[1-9][0-9]*)?[0-9]{4})-(1[0-2]|0[1-9])-' +
+       r'(3[01]|0[1-9]|[12][0-9])T(2[0-3]|[01][0-9])' +
+       r':([0-5][0-9]):([0-5][0-9])(\.[0-9]+)?' +
+       r'(Z|[+-](?:2[0-3]|[01][0-9]):[0-5][0-9])?$'
+    ).match
+
+    if match_iso8601(time_first_tweet) is None:
+        raise ValueError(f"Date does not look like valid iso-format ({time_first_tweet!r})")
+
+
+def parse_epoch(time):
+    """
+    Convert a timestamp in iso-format to seconds since 1970-01-01
+
+    Args:
+        :time: (str) timestamp in iso-format (timestamps without timezone are taken as UTC)
+
+    Returns:
+        :epoch: (int) seconds since 1970-01-01
+    """
+
+    time = datetime.datetime.fromisoformat(time)
+    if time.tzinfo is None:
+        time = time.replace(tzinfo=datetime.timezone.utc)
+    return int(time.timestamp())
+
+
+def _sort_tweets_by_date(tweets):
+    """
+    Ensure that tweets objects are are sorted by date
+
+    Args:
+        :tweets: (list) Tweets from 'twitter_data'
+
+    Returns:
+        :tweets_sorted: (list) sorted list of Tweets
+    """
+
+    return TweetTable.from_tweets(tweets).tweets
+
+
+class TweetTable:
+    """
+    Tweets of one twitter data file, sorted by date
+
+    Timestamps are parsed only once when the table is created. Tweets are
+    sorted with a stable sort, so tweets with the exact same timestamp keep
+    their original order. Sheets and filters work on views of the table
+    (see 'select()'), which share the tweet objects with the table.
+
+    Attributes:
+        :tweets: (list) Tweets sorted by date
+        :epochs: (array) timestamps in seconds since 1970-01-01
+        :is_retweet: (array) True if the tweet is a retweet
+        :likes: (array) number of likes
+        :retweets: (array) number of retweets
+        :replies: (array) number of replies
+    """
+
+    __slots__ = ('tweets', 'epochs', 'is_retweet', 'likes', 'retweets', 'replies')
+    COLUMNS = ('epochs', 'is_retweet', 'likes', 'retweets', 'replies')
+
+    def __init__(self, tweets, epochs, is_retweet, likes, retweets, replies):
+        self.tweets = tweets
+        self.epochs = epochs
+        self.is_retweet = is_retweet
+        self.likes = likes
+        self.retweets = retweets
+        self.replies = replies
+
+    @classmethod
+    @instrument('table.build')
+    def from_tweets(cls, tweets):
+        """
+        Create a table from a list of tweets (in any order)
+
+        Args:
+            :tweets: (iter) Tweets from 'twitter_data' (list or generator)
+
+        Returns:
+            :table: (obj) 'TweetTable'
+        """
+
+        if not isinstance(tweets, list):
+            tweets = list(tweets)
+        if tweets:
+            _check_time_format(tweets)
+
+        def column(values, dtype=np.int64):
+            return np.fromiter(values, dtype=dtype, count=len(tweets))
+
+        epochs = column(parse_epoch(tweet['time']) for tweet in tweets)
+        order = np.argsort(epochs, kind='stable')
+        tweets = [tweets[i] for i in order.tolist()]
+
+        return cls(
+            tweets=tweets,
+            epochs=epochs[order],
+            is_retweet=column((tweet['isRetweet'] for tweet in tweets), dtype=bool),
+            likes=column(tweet['likes'] for tweet in tweets),
+            retweets=column(tweet['retweets'] for tweet in tweets),
+            replies=column(tweet['replies'] for tweet in tweets),
+        )
+
+    @classmethod
+    def from_twitter_data(cls, twitter_data):
+        """
+        Create a table from a twitter data dictionary
+
+        Args:
+            :twitter_data: (dict) dictionary with twitter data
+
+        Returns:
+            :table: (obj) 'TweetTable'
+        """
+
+        return cls.from_tweets(get_tweets(twitter_data, sort=False))
+
+    def __len__(self):
+        return len(self.tweets)
+
+    def __iter__(self):
+        return iter(self.tweets)
+
+    def __getitem__(self, index):
+        return self.tweets[index]
+
+    def select(self, indices):
+        """
+        Return a view with the tweets at the given positions
+
+        Args:
+            :indices: (array) positions of the tweets (in ascending order) or boolean mask
+
+        Returns:
+            :table: (obj) 'TweetTable'
+        """
+
+        indices = np.asarray(indices)
+        if indices.dtype == bool:
+            (indices,) = np.nonzero(indices)
+        indices = indices.astype(np.intp, copy=False)
+
+        return TweetTable(
+            tweets=[self.tweets[i] for i in indices.tolist()],
+            **{key: getattr(self, key)[indices] for key in self.COLUMNS},
+        )
+
+
+def as_tweet_table(twitter_data):
+    """
+    Return a 'TweetTable' for twitter data (if it is not already a table)
+
+    Args:
+        :twitter_data: (dict) dictionary with twitter data (or 'TweetTable')
+
+    Returns:
+        :table: (obj) 'TweetTable'
+    """
+
+    if isinstance(twitter_data, (TweetTable, ExternalTweetTable, ColumnTable)):
+        return twitter_data
+    return TweetTable.from_twitter_data(twitter_data)
+
+
+# ----- External sort -----
+def _write_sort_run(records, dirname):
+    """
+    Write sorted records to a temporary file
+
+    Args:
+        :records: (iter) sorted tuples (epoch, tie-breaker, sequence number, JSON line)
+        :dirname: (str) directory for the file
+
+    Returns:
+        :filename: (str) path of the run
+    """
+
+    fd, filename = tempfile.mkstemp(prefix='run_', suffix='.tsv', dir=dirname)
+    with open(fd, 'w', encoding='utf-8') as fp:
+        for epoch, tie_breaker, seq, line in records:
+            # Compact JSON never contains a tab or a line break
+            fp.write(f'{epoch}\t{tie_breaker}\t{seq}\t{line}\n')
+    METRICS.count('bytes_written', os.path.getsize(filename), kind='sort')
+    return filename
+
+
+def _read_sort_run(filename):
+    """Yield the records of a run written by '_write_sort_run()'"""
+
+    with open(filename, 'r', encoding='utf-8') as fp:
+        for row in fp:
+            epoch, tie_breaker, seq, line = row.rstrip('\n').split('\t', 3)
+            yield int(epoch), int(tie_breaker), int(seq), line
+
+
+@instrument('sort.external')
+def _iter_sorted_records(sources, memory_budget, dedupe, dirname):
+    """
+    Yield tweets sorted by date as JSON lines (external merge sort)
+
+    Tweets are collected until their JSON lines take about 'memory_budget'
+    bytes, sorted and written to a run file. The runs are merged with
+    'heapq.merge()', at most 'SORT_MERGE_WIDTH' runs at once. Tweets with the
+    same timestamp keep their input order. If 'dedupe' is True, tweets with
+    the same timestamp are ordered by 'tweetId', so that duplicates are
+    adjacent and only the first occurrence is kept. If all tweets fit into
+    the budget, nothing is written to disk.
+
+    Args:
+        :sources: (list) iterables of tweets
+        :memory_budget: (int) bytes
+        :dedupe: (bool) if True, remove duplicates by 'tweetId'
+        :dirname: (str) directory for the run files
+
+    Yields:
+        :epoch: (int) timestamp in seconds since 1970-01-01
+        :line: (str) tweet as compact JSON
+    """
+
+    dump_compact_json = partial(json.dumps, cls=DateTimeEncoder, separators=(',', ':'))
+    runs = []
+    chunk = []
+    size = 0
+    seq = 0
+
+    for tweet in chain.from_iterable(sources):
+        line = dump_compact_json(tweet)
+        chunk.append((parse_epoch(tweet['time']), int(tweet['tweetId']) if dedupe else 0, seq, line))
+        seq += 1
+        size += len(line) + SORT_RECORD_SIZE
+        if size >= memory_budget:
+            chunk.sort()
+            runs.append(_write_sort_run(chunk, dirname))
+            chunk = []
+            size = 0
+
+    chunk.sort()
+    if runs:
+        if chunk:
+            runs.append(_write_sort_run(chunk, dirname))
+            chunk = []
+        # Merge in several passes if there are too many runs (open files)
+        while len(runs) > SORT_MERGE_WIDTH:
+            groups = [runs[i:i + SORT_MERGE_WIDTH] for i in range(0, len(runs), SORT_MERGE_WIDTH)]
+            runs = []
+            for group in groups:
+                runs.append(_write_sort_run(heapq.merge(*map(_read_sort_run, group)), dirname))
+                for filename in group:
+                    os.remove(filename)
+        records = heapq.merge(*map(_read_sort_run, runs))
+        logger.info(f"Sorted {seq} tweets on disk ({len(runs)} runs)...")
+    else:
+        records = iter(chunk)
+    METRICS.count('sort_runs', len(runs))
+
+    last = None
+    for epoch, tie_breaker, _, line in records:
+        if dedupe:
+            if (epoch, tie_breaker) == last:
+                continue
+            last = (epoch, tie_breaker)
+        yield epoch, line
+
+
+def iter_sorted_tweets(*tweet_sources, memory_budget=SORT_MEMORY_BUDGET, dedupe=True):
+    """
+    Yield tweets from one or more sources sorted by date, with bounded memory
+
+    Tweets which do not fit into the memory budget are sorted on disk (see
+    '_iter_sorted_records()'), the temporary files are removed when the
+    generator is exhausted or closed.
+
+    Args:
+        :tweet_sources: (iterables) sources of tweets, e.g. snapshots newest first
+        :memory_budget: (int) bytes of tweets sorted in memory at once
+        :dedupe: (bool) if True, skip duplicates by 'tweetId' (the first occurrence is kept)
+    """
+
+    with tempfile.TemporaryDirectory(prefix='tweets_') as dirname:
+        for _, line in _iter_sorted_records(tweet_sources, memory_budget, dedupe, dirname):
+            yield json.loads(line)
+
+
+class ExternalTweetTable:
+    """
+    Tweets of a large history, sorted by date and stored in a temporary file
+
+    Same interface as 'TweetTable' (except indexing), but only the numeric
+    columns are kept in memory. Iterating reads the tweets from the file, so
+    sheets and filters consume the tweets as a stream. Views (see 'select()')
+    share the file, which is removed when the table and all its views are
+    garbage collected.
+
+    Attributes:
+        :filename: (str) path of the sorted tweets (JSON Lines)
+        :positions: (array) line numbers of the tweets of a view (or None for all lines)
+        :epochs: (array) timestamps in seconds since 1970-01-01
+        :is_retweet: (array) True if the tweet is a retweet
+        :likes: (array) number of likes
+        :retweets: (array) number of retweets
+        :replies: (array) number of replies
+    """
+
+    COLUMNS = TweetTable.COLUMNS
+
+    def __init__(self, storage, epochs, is_retweet, likes, retweets, replies, positions=None):
+        self._storage = storage  # 'tempfile.TemporaryDirectory', removed by its finalizer
+        self.filename = os.path.join(storage.name, 'sorted.jsonl')
+        self.positions = positions
+        self.epochs = epochs
+        self.is_retweet = is_retweet
+        self.likes = likes
+        self.retweets = retweets
+        self.replies = replies
+
+    @classmethod
+    @instrument('table.build')
+    def from_tweets(cls, tweets, memory_budget=SORT_MEMORY_BUDGET, dedupe=False):
+        """
+        Sort tweets on disk and create a table
+
+        Args:
+            :tweets: (iter) Tweets from 'twitter_data' (in any order)
+            :memory_budget: (int) bytes of tweets sorted in memory at once
+            :dedupe: (bool) if True, skip duplicates by 'tweetId'
+
+        Returns:
+            :table: (obj) 'ExternalTweetTable'
+        """
+
+        storage = tempfile.TemporaryDirectory(prefix='tweets_')
+        columns = {key: array('q') for key in cls.COLUMNS}
+
+        with open(os.path.join(storage.name, 'sorted.jsonl'), 'w', encoding='utf-8') as fp:
+            for epoch, line in _iter_sorted_records([tweets], memory_budget, dedupe, storage.name):
+                tweet = json.loads(line)
+                columns['epochs'].append(epoch)
+                columns['is_retweet'].append(bool(tweet['isRetweet']))
+                columns['likes'].append(tweet['likes'])
+                columns['retweets'].append(tweet['retweets'])
+                columns['replies'].append(tweet['replies'])
+                fp.write(line + '\n')
+
+        for filename in os.listdir(storage.name):
+            if filename.startswith('run_'):
+                os.remove(os.path.join(storage.name, filename))
+
+        columns = {key: np.frombuffer(column, dtype=np.int64) for key, column in columns.items()}
+        columns['is_retweet'] = columns['is_retweet'].astype(bool)
+        return cls(storage, **columns)
+
+    def __len__(self):
+        return len(self.epochs)
+
+    def __iter__(self):
+        with open(self.filename, 'r', encoding='utf-8') as fp:
+            if self.positions is None:
+                for line in fp:
+                    yield json.loads(line)
+                return
+            positions = iter(self.positions.tolist())
+            position = next(positions, None)
+            for i, line in enumerate(fp):
+                if position is None:
+                    break
+                if i == position:
+                    yield json.loads(line)
+                    position = next(positions, None)
+
+    def select(self, indices):
+        """
+        Return a view with the tweets at the given positions
+
+        Args:
+            :indices: (array) positions of the tweets (in ascending order) or boolean mask
+
+        Returns:
+            :table: (obj) 'ExternalTweetTable'
+        """
+
+        indices = np.asarray(indices)
+        if indices.dtype == bool:
+            (indices,) = np.nonzero(indices)
+        indices = indices.astype(np.intp, copy=False)
+
+        return ExternalTweetTable(
+            self._storage,
+            positions=indices if self.positions is None else self.positions[indices],
+            **{key: getattr(self, key)[indices] for key in self.COLUMNS},
+        )
+
+
+def _drain(queue):
+    """Yield and remove the items of a deque (from the left)"""
+
+    while queue:
+        yield queue.popleft()
+
+
+def build_tweet_table(tweets, memory_budget=None):
+    """
+    Return a table of tweets, sorted on disk if the tweets do not fit into the memory budget
+
+    Args:
+        :tweets: (iter) Tweets from 'twitter_data' (list or generator)
+        :memory_budget: (int) approximate bytes of memory for the tweets (None for no limit)
+
+    Returns:
+        :table: (obj) 'TweetTable' or 'ExternalTweetTable' (or 'tweets' if it is already a table)
+    """
+
+    if isinstance(tweets, (TweetTable, ExternalTweetTable, ColumnTable)):
+        return tweets
+    if memory_budget is None:
+        return TweetTable.from_tweets(tweets)
+
+    tweets = iter(tweets)
+    buffer = deque()
+    size = 0
+    for tweet in tweets:
+        buffer.append(tweet)
+        size += SORT_TWEET_SIZE + len(tweet['text'])
+        if size > memory_budget:
+            logger.info(f"More than {memory_budget/2**20:,.0f} MB of tweets, sorting on disk...")
+            return ExternalTweetTable.from_tweets(chain(_drain(buffer), tweets), memory_budget)
+
+    return TweetTable.from_tweets(list(buffer))
+
+
+# ----- Column cache -----
+class ColumnTable:
+    """
+    Tweets of a data file, sorted by date and memory-mapped from the column cache
+
+    Same interface as 'TweetTable'. The numeric columns are NumPy arrays
+    mapped from '.npy' files, so opening a table reads almost nothing from
+    disk. Time, text, hashtags and media URLs of each tweet are stored in a
+    string blob (in the order of the data file), 'offsets' points to the
+    fields of each tweet. Iterating yields tweets with the fields used by
+    sheets and filters ('tweetId', 'time', 'isRetweet', 'replies',
+    'retweets', 'likes', 'text' and 'entries' with 'hashtags' and 'photos').
+    Note: 'photos' holds the URLs of all media (see 'get_media_urls()').
+
+    Attributes:
+        :dirname: (str) directory of the column cache
+        :order: (array) position of each tweet in the data file
+        :tweet_ids: (array) tweet IDs
+        :epochs: (array) timestamps in seconds since 1970-01-01
+        :is_retweet: (array) True if the tweet is a retweet
+        :likes: (array) number of likes
+        :retweets: (array) number of retweets
+        :replies: (array) number of replies
+    """
+
+    COLUMNS = TweetTable.COLUMNS + ('tweet_ids', 'order')
+
+    def __init__(self, dirname, blob, offsets, **columns):
+        self.dirname = dirname
+        self._blob = blob
+        self._offsets = offsets
+        for key in self.COLUMNS:
+            setattr(self, key, columns[key])
+
+    @classmethod
+    @instrument('columns.open')
+    def open(cls, dirname):
+        """
+        Map the files of a column cache
+
+        Args:
+            :dirname: (str) directory of the column cache
+
+        Returns:
+            :table: (obj) 'ColumnTable'
+        """
+
+        columns = {key: np.load(os.path.join(dirname, f'{key}.npy'), mmap_mode='r') for key in cls.COLUMNS}
+        offsets = np.load(os.path.join(dirname, 'offsets.npy'), mmap_mode='r')
+        blob = b''
+        with open(os.path.join(dirname, 'strings.bin'), 'rb') as fp:
+            if os.fstat(fp.fileno()).st_size:
+                blob = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(dirname, blob, offsets, **columns)
+
+    def __len__(self):
+        return len(self.epochs)
+
+    def __iter__(self):
+        num_fields = len(COLUMN_STRINGS)
+        for start in range(0, len(self), COLUMN_CHUNK_SIZE):
+            stop = min(start + COLUMN_CHUNK_SIZE, len(self))
+            first = self.order[start:stop]*num_fields
+            # Start and end of the time, text, hashtags and media URLs of each tweet in the blob
+            bounds = [self._offsets[first + i].tolist() for i in range(num_fields + 1)]
+            values = (getattr(self, key)[start:stop].tolist() for key in ('tweet_ids', 'is_retweet', 'replies', 'retweets', 'likes'))
+            for tweet_id, is_retweet, replies, retweets, likes, *offsets in zip(*values, *bounds):
+                time, text, hashtags, media_urls = (
+                    self._blob[offsets[i]:offsets[i + 1]].decode('utf-8') for i in range(num_fields)
+                )
+                yield {
+                    'tweetId': str(tweet_id),
+                    'isRetweet': is_retweet,
+                    'time': time,
+                    'text': text,
+                    'replies': replies,
+                    'retweets': retweets,
+                    'likes': likes,
+                    'entries': {
+                        'hashtags': hashtags.split('\n') if hashtags else [],
+                        'photos': media_urls.split('\n') if media_urls else [],
+                    },
+                }
+
+    def iter_strings(self, field):
+        """
+        Yield one string field of all tweets (without creating tweet objects)
+
+        Args:
+            :field: (str) one of 'COLUMN_STRINGS'
+
+        Yields:
+            :value: (str) time, text, hashtags or media URLs (separated by newlines)
+        """
+
+        index = COLUMN_STRINGS.index(field)
+        for start in range(0, len(self), COLUMN_CHUNK_SIZE):
+            first = self.order[start:start + COLUMN_CHUNK_SIZE]*len(COLUMN_STRINGS) + index
+            bounds = zip(self._offsets[first].tolist(), self._offsets[first + 1].tolist())
+            yield from (self._blob[begin:end].decode('utf-8') for begin, end in bounds)
+
+    def select(self, indices):
+        """
+        Return a view with the tweets at the given positions
+
+        Args:
+            :indices: (array) positions of the tweets (in ascending order) or boolean mask
+
+        Returns:
+            :table: (obj) 'ColumnTable'
+        """
+
+        indices = np.asarray(indices)
+        if indices.dtype == bool:
+            (indices,) = np.nonzero(indices)
+        indices = indices.astype(np.intp, copy=False)
+
+        return ColumnTable(
+            self.dirname,
+            self._blob,
+            self._offsets,
+            **{key: getattr(self, key)[indices] for key in self.COLUMNS},
+        )
+
+
+def get_column_cache_dir(filename):
+    """Return the directory of the column cache of a data file"""
+
+    return os.path.join(os.path.dirname(os.path.abspath(filename)), COLUMN_CACHE_DIRNAME)
+
+
+def _read_column_manifest(dirname):
+    try:
+        with open(os.path.join(dirname, 'manifest.json'), 'r') as fp:
+            manifest = json.load(fp)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring column cache {truncate_filepath(dirname)!r}: {e}")
+        return None
+    return manifest if isinstance(manifest, dict) else None
+
+
+def _write_column_manifest(dirname, manifest):
+    filename = os.path.join(dirname, 'manifest.json')
+    with open(filename + '.tmp', 'w') as fp:
+        json.dump(manifest, fp, indent=2, cls=DateTimeEncoder)
+    os.replace(filename + '.tmp', filename)
+
+
+def open_column_cache(filename):
+    """
+    Return the cached columns of a data file, if the cache is up to date
+
+    As in 'ConversionCache', the content hash of the data file is only
+    computed if its size is the same, but its modification time changed.
+
+    Args:
+        :filename: (str) path of the data file
+
+    Returns:
+        :manifest: (dict) 'profile', 'count', ... (or None if there is no valid cache)
+        :table: (obj) 'ColumnTable' (or None)
+    """
+
+    dirname = get_column_cache_dir(filename)
+    manifest = _read_column_manifest(dirname)
+    if manifest is None or manifest.get('version') != COLUMN_CACHE_VERSION:
+        return None, None
+
+    try:
+        entry = manifest['source']
+        if entry['name'] != os.path.basename(filename):
+            return None, None
+        source = file_fingerprint(filename, content=False)
+        if source['size'] != entry['size']:
+            return None, None
+        if source['mtime_ns'] != entry['mtime_ns']:
+            source = file_fingerprint(filename)
+            if source['sha256'] != entry['sha256']:
+                return None, None
+            manifest['source'] = dict(source, name=entry['name'])  # Same content, remember the new time stamp
+            _write_column_manifest(dirname, manifest)
+        table = ColumnTable.open(dirname)
+    except (OSError, KeyError, TypeError, ValueError) as e:
+        logger.debug(f"Column cache of {truncate_filepath(filename)!r} not usable: {e!r}")
+        return None, None
+
+    if len(table) != manifest.get('count'):
+        return None, None
+    return manifest, table
+
+
+@instrument('columns.build')
+def write_column_cache(filename):
+    """
+    Create the column cache of a data file
+
+    The data file is read as a stream, only the numeric columns are kept in
+    memory until they are sorted by date. Strings go to the blob at once.
+
+    Args:
+        :filename: (str) path of the data file
+
+    Returns:
+        :manifest: (dict) 'profile', 'count', ...
+        :table: (obj) 'ColumnTable'
+    """
+
+    # Fingerprint before reading, changes during the build are noticed next time
+    source = dict(file_fingerprint(filename), name=os.path.basename(filename))
+    dirname = get_column_cache_dir(filename)
+    dir_tmp = f'{dirname}.{os.getpid()}.tmp'
+    shutil.rmtree(dir_tmp, ignore_errors=True)
+    mkdir(dir_tmp)
+
+    profile, tweets = read_twitter_data(filename)
+    columns = {key: array('q') for key in ('epochs', 'tweet_ids', 'is_retweet', 'likes', 'retweets', 'replies')}
+    offsets = array('q', [0])
+    with open(os.path.join(dir_tmp, 'strings.bin'), 'wb') as fp:
+        size = 0
+        for tweet in tweets:
+            if len(offsets) == 1:
+                _check_time_format([tweet])
+            columns['epochs'].append(parse_epoch(tweet['time']))
+            columns['tweet_ids'].append(int(tweet['tweetId']))
+            columns['is_retweet'].append(bool(tweet['isRetweet']))
+            columns['likes'].append(tweet['likes'])
+            columns['retweets'].append(tweet['retweets'])
+            columns['replies'].append(tweet['replies'])
+            strings = (tweet['time'], tweet['text'], '\n'.join(tweet['entries']['hashtags']), '\n'.join(get_media_urls(tweet)))
+            for value in strings:
+                data = value.encode('utf-8')
+                fp.write(data)
+                size += len(data)
+                offsets.append(size)
+
+    columns = {key: np.frombuffer(column, dtype=np.int64) for key, column in columns.items()}
+    columns['is_retweet'] = columns['is_retweet'].astype(bool)
+    order = np.argsort(columns['epochs'], kind='stable')
+    for key, column in columns.items():
+        np.save(os.path.join(dir_tmp, f'{key}.npy'), column[order])
+    np.save(os.path.join(dir_tmp, 'order.npy'), order.astype(np.int64))
+    np.save(os.path.join(dir_tmp, 'offsets.npy'), np.frombuffer(offsets, dtype=np.int64))
+
+    num_tweets = len(order)
+    manifest = OrderedDict((
+        ('version', COLUMN_CACHE_VERSION),
+        ('source', source),
+        ('count', num_tweets),
+        # Tweets are saved newest first, the last one is the oldest downloaded tweet
+        ('last_epoch', int(columns['epochs'][-1]) if num_tweets else None),
+        ('profile', profile),
+    ))
+    _write_column_manifest(dir_tmp, manifest)
+
+    shutil.rmtree(dirname, ignore_errors=True)
+    try:
+        os.rename(dir_tmp, dirname)
+    except OSError:  # Created by another process in the meantime
+        shutil.rmtree(dir_tmp, ignore_errors=True)
+        return open_column_cache(filename)
+    METRICS.count('bytes_written', sum(entry.stat().st_size for entry in os.scandir(dirname)), kind='columns')
+    return manifest, ColumnTable.open(dirname)
+
+
+def read_column_table(filename):
+    """
+    Return profile and tweets of a data file, using (or creating) the column cache
+
+    If the cache cannot be written (e.g. read-only directory), the data file
+    is read as usual.
+
+    Args:
+        :filename: (str) path of the data file
+
+    Returns:
+        :profile: (dict) profile data
+        :tweets: (obj) 'ColumnTable' (or generator of tweets if there is no cache)
+    """
+
+    manifest, table = open_column_cache(filename)
+    if table is not None:
+        logger.info(f"Using column cache ({len(table):,} tweets)...")
+        METRICS.count('column_cache', result='hit')
+        return manifest['profile'], table
+
+    METRICS.count('column_cache', result='miss')
+    logger.info(f"Creating column cache of {truncate_filepath(filename)}...")
+    try:
+        manifest, table = write_column_cache(filename)
+    except OSError as e:
+        logger.warning(f"Could not create column cache of {truncate_filepath(filename)!r}: {e}")
+        return read_twitter_data(filename)
+    return manifest['profile'], table
+
+
+def get_tweets(twitter_data, sort=True):
+    """
+    Return tweets from twitter data or return error
+
+    Args:
+        :twitter_data: (dict) dictionary with twitter data
+        :sort: (bool) if true tweets will be sorted by date
+
+    Returns:
+        :tweets: (list) Tweets
+    """
+
+    tweets = twitter_data.get('history', None)
+    if tweets is None:
+        raise ValueError("Failed to retrieve tweets (no 'history' in twitter data)")
+
+    if sort and len(tweets) > 1:
+        tweets = _sort_tweets_by_date(tweets)
+
+    return tweets
+
+
+def filter_tweets(tweets, filter_kw):
+    """
+    Filter tweets by a #hashtag or keyword
+
+    Args:
+        :tweets: (list) Tweets from 'twitter_data' (or 'TweetTable')
+        :filter_kw: (str) filter keyword or filter expression (see 'parse_filter_expression()')
+
+    Returns:
+        :filtered_tweets: (list) Filtered tweets from 'twitter_data' (a view if 'tweets' is a 'TweetTable')
+
+    Note:
+        * If 'filter_kw' starts with '#' it is interpreted as a hashtag, and
+          only hashtags will be checked. If 'filter_kw' is not a hashtag, both
+          hashtags and the tweet text will be checked.
+    """
+
+    mask = FilterEngine(tweets).match([filter_kw])[filter_kw]
+
+    if isinstance(tweets, (TweetTable, ExternalTweetTable, ColumnTable)):
+        filtered_tweets = tweets.select(mask)
+    else:
+        filtered_tweets = [tweet for tweet, is_match in zip(tweets, mask) if is_match]
+
+    logger.info(f"Found {len(filtered_tweets)} tweets for filter {filter_kw!r}...")
+    return filtered_tweets
+
+
+# ----- Filter expressions -----
+def _tokenize_filter(filter_kw):
+    """
+    Split a filter into operators, parentheses and keywords
+
+    Args:
+        :filter_kw: (str) filter keyword or expression
+
+    Returns:
+        :tokens: (list) tokens, consecutive words are joined to one keyword
+    """
+
+    tokens = []
+    for token in re.findall(r'\(|\)|[^\s()]+', filter_kw):
+        if token in FILTER_OPERATORS or token in '()' or not tokens or tokens[-1] in FILTER_OPERATORS or tokens[-1] in '()':
+            tokens.append(token)
+        else:
+            tokens[-1] += ' ' + token
+    return tokens
+
+
+def parse_filter_expression(filter_kw):
+    """
+    Parse a filter into an expression tree
+
+    A filter is either a single keyword or #hashtag (e.g. 'tesla' or
+    '#tesla'), or a boolean expression of keywords and hashtags combined
+    with the (upper case) operators AND, OR and NOT and parentheses, e.g.
+    '#tesla AND NOT (spacex OR dragon)'. Without an operator, the filter is
+    a keyword, even if it contains parentheses (e.g. 'tesla (model 3)').
+
+    Args:
+        :filter_kw: (str) filter keyword or expression
+
+    Returns:
+        :tree: (tuple) ('term', keyword), ('not', tree), ('and', tree, tree) or ('or', tree, tree)
+
+    Raises:
+        :ValueError: if the expression is not valid
+    """
+
+    tokens = _tokenize_filter(filter_kw)
+    if not any(token in FILTER_OPERATORS for token in tokens):
+        return ('term', filter_kw)
+
+    pos = 0
+
+    def peek():
+        return tokens[pos] if pos < len(tokens) else None
+
+    def take(expected=None):
+        nonlocal pos
+        token = peek()
+        if token is None or (expected is not None and token != expected):
+            raise ValueError(f"Invalid filter {filter_kw!r}: expected {expected or 'keyword'!r}, got {token!r}")
+        pos += 1
+        return token
+
+    def parse_or():
+        tree = parse_and()
+        while peek() == 'OR':
+            take('OR')
+            tree = ('or', tree, parse_and())
+        return tree
+
+    def parse_and():
+        tree = parse_not()
+        while peek() == 'AND':
+            take('AND')
+            tree = ('and', tree, parse_not())
+        return tree
+
+    def parse_not():
+        if peek() == 'NOT':
+            take('NOT')
+            return ('not', parse_not())
+        if peek() == '(':
+            take('(')
+            tree = parse_or()
+            take(')')
+            return tree
+        token = take()
+        if token in FILTER_OPERATORS or token == ')':
+            raise ValueError(f"Invalid filter {filter_kw!r}: unexpected {token!r}")
+        return ('term', token)
+
+    tree = parse_or()
+    if peek() is not None:
+        raise ValueError(f"Invalid filter {filter_kw!r}: unexpected {peek()!r}")
+    return tree
+
+
+def _filter_terms(tree):
+    """Yield all keywords of a filter expression tree"""
+
+    if tree[0] == 'term':
+        yield tree[1]
+    else:
+        for subtree in tree[1:]:
+            yield from _filter_terms(subtree)
+
+
+def get_filter_label(filter_kw):
+    """
+    Return a short label for a filter, used for sheet titles
+
+    Args:
+        :filter_kw: (str) filter keyword or expression
+
+    Returns:
+        :kind: (str) 'HT' (hashtag), 'KW' (keyword) or 'EX' (expression)
+        :name: (str) parsed filter (lowercase, without '#', ...)
+    """
+
+    tree = parse_filter_expression(filter_kw)
+    if tree[0] == 'term':
+        is_hashtag, parsed_kw = parse_filter_kw(filter_kw)
+        return ('HT' if is_hashtag else 'KW', parsed_kw)
+    return ('EX', parse_filter_kw(' '.join(_tokenize_filter(filter_kw)))[1])
+
+
+class FilterEngine:
+    """
+    Match many filters against the same tweets at once
+
+    An inverted index from (parsed) hashtags to tweets is built only once.
+    The texts are converted to lowercase once per chunk of tweets, then each
+    distinct keyword of all filters is searched in the chunk with its own scan
+    (see '_keyword_masks()'), so the cost grows with tweets times keywords.
+    The results are boolean arrays ('bitmaps'), one entry per tweet.
+    """
+
+    def __init__(self, tweets):
+        """
+        Args:
+            :tweets: (list) Tweets from 'twitter_data' (or 'TweetTable')
+        """
+
+        self.tweets = tweets
+        self._hashtag_index = None
+
+    def _iter_hashtags(self):
+        if isinstance(self.tweets, ColumnTable):
+            return (hashtags.split('\n') if hashtags else [] for hashtags in self.tweets.iter_strings('hashtags'))
+        return (tweet['entries']['hashtags'] for tweet in self.tweets)
+
+    def _iter_texts(self):
+        if isinstance(self.tweets, ColumnTable):
+            return self.tweets.iter_strings('text')
+        return (tweet['text'] for tweet in self.tweets)
+
+    @property
+    def hashtag_index(self):
+        """Dictionary with parsed hashtags as keys and tweet positions as values"""
+
+        if self._hashtag_index is None:
+            parsed = {}
+            index = {}
+            for i, hashtags in enumerate(self._iter_hashtags()):
+                for hashtag in hashtags:
+                    if hashtag not in parsed:
+                        parsed[hashtag] = parse_filter_kw(hashtag)[1]
+                    positions = index.setdefault(parsed[hashtag], [])
+                    if not positions or positions[-1] != i:
+                        positions.append(i)
+            self._hashtag_index = {hashtag: np.array(positions, dtype=np.intp) for hashtag, positions in index.items()}
+        return self._hashtag_index
+
+    def _hashtag_mask(self, parsed_kw):
+        mask = np.zeros(len(self.tweets), dtype=bool)
+        mask[self.hashtag_index.get(parsed_kw, [])] = True
+        return mask
+
+    def _keyword_masks(self, keywords):
+        """
+        Return a mask for each keyword, which is True if the keyword appears in the text
+
+        The texts are read in chunks of 'FILTER_CHUNK_SIZE' tweets and each text
+        is converted to lowercase once. Then each keyword is tested against all
+        texts of the chunk with 'map()', so the loop over the texts runs in C.
+
+        Note: the work is proportional to tweets times keywords. A single scan
+        with a compiled alternation of all keywords ('re.findall()' per text)
+        is two to four times slower in CPython ('re' does not build an
+        automaton, and overlapping keywords would need a lookahead), and so is
+        a search in the joined texts of a chunk if a keyword is common.
+
+        Args:
+            :keywords: (set) parsed keywords (lowercase)
+
+        Returns:
+            :masks: (dict) keyword as key and boolean array as value
+        """
+
+        masks = {kw: np.zeros(len(self.tweets), dtype=bool) for kw in keywords}
+
+        texts = self._iter_texts()
+        offset = 0
+        while masks:
+            chunk = [text.lower() for text in islice(texts, FILTER_CHUNK_SIZE)]
+            if not chunk:
+                break
+            end = offset + len(chunk)
+            for kw, mask in masks.items():
+                mask[offset:end] = np.fromiter(map(contains, chunk, repeat(kw)), dtype=bool, count=len(chunk))
+            offset = end
+        return masks
+
+    @instrument('filter.match')
+    def match(self, filters):
+        """
+        Evaluate a list of filters
+
+        Args:
+            :filters: (list) filter keywords or expressions (see 'parse_filter_expression()')
+
+        Returns:
+            :masks: (dict) filter as key and boolean array (True if the tweet matches) as value
+        """
+
+        trees = OrderedDict((filter_kw, parse_filter_expression(filter_kw)) for filter_kw in filters)
+        terms = {term: parse_filter_kw(term) for tree in trees.values() for term in _filter_terms(tree)}
+        keyword_masks = self._keyword_masks({parsed_kw for is_hashtag, parsed_kw in terms.values() if not is_hashtag})
+
+        term_masks = {}
+        for term, (is_hashtag, parsed_kw) in terms.items():
+            mask = self._hashtag_mask(parsed_kw)
+            if not is_hashtag:
+                mask |= keyword_masks[parsed_kw]
+            term_masks[term] = mask
+
+        def evaluate(tree):
+            if tree[0] == 'term':
+                return term_masks[tree[1]]
+            if tree[0] == 'not':
+                return ~evaluate(tree[1])
+            if tree[0] == 'and':
+                return evaluate(tree[1]) & evaluate(tree[2])
+            return evaluate(tree[1]) | evaluate(tree[2])
+
+        return OrderedDict((filter_kw, evaluate(tree)) for filter_kw, tree in trees.items())
+
+
+# ----- Excel sheets -----
+class XlValue:
+    """
+    Value of an Excel cell with formatting
+
+    Sheets are created from rows (lists) of plain values or 'XlValue'
+    objects, so that the same rows can be written by every Excel engine.
+    """
+
+    __slots__ = ('value', 'fill', 'font', 'hyperlink')
+
+    def __init__(self, value, *, fill=None, font=None, hyperlink=None):
+        self.value = value
+        self.fill = fill
+        self.font = font
+        self.hyperlink = hyperlink
+
+
+def xl_header(value):
+    """Return a highlighted header cell value"""
+
+    return XlValue(value, fill=XL_FILL_GREEN, font=XL_FONT_BOLD)
+
+
+@lru_cache(maxsize=None)
+def get_xl_style(style):
+    """
+    Return the 'openpyxl' object of a style description
+
+    Args:
+        :style: (tuple) style description, e.g. 'XL_FILL_GREEN'
+
+    Returns:
+        :style_obj: (obj) 'PatternFill' or 'Font' (shared by all cells)
+    """
+
+    kind, value = style
+    if kind == 'fill':
+        return xl.styles.PatternFill(start_color=value, end_color=value, fill_type='solid')
+    if kind == 'font':
+        return xl.styles.Font(**{value: True})
+    raise ValueError(f"Unknown style {style!r}")
+
+
+def _format_xl_cell(cell, value):
+    """
+    Set value and formatting of an Excel cell
+
+    Args:
+        :cell: (obj) Excel cell reference
+        :value: (obj) plain value or 'XlValue'
+    """
+
+    if not isinstance(value, XlValue):
+        cell.value = value
+        return cell
+
+    cell.value = value.value
+    if value.fill is not None:
+        cell.fill = get_xl_style(value.fill)
+    if value.font is not None:
+        cell.font = get_xl_style(value.font)
+    if value.hyperlink is not None:
+        cell.hyperlink = value.hyperlink
+    return cell
+
+
+class XlWorkbookWriter:
+    """
+    Excel engine 'standard', all cells are kept in memory until the workbook is saved
+    """
+
+    def __init__(self):
+        self.workbook = xl.Workbook()
+        self._sheets = 0
+
+    @instrument('excel.sheet')
+    def add_sheet(self, title, rows):
+        """
+        Add a sheet to the workbook
+
+        Args:
+            :title: (str) sheet title
+            :rows: (iter) rows (lists of plain values or 'XlValue' objects)
+        """
+
+        if self._sheets == 0:
+            sheet = self.workbook.active
+            sheet.title = title
+        else:
+            sheet = self.workbook.create_sheet(title=title)
+        self._sheets += 1
+        write_xl_rows(sheet, _count_xl_cells(title, rows))
+
+    @instrument('excel.save')
+    def save(self, filename):
+        self.workbook.save(filename)
+
+
+class XlStreamWriter:
+    """
+    Excel engine 'stream', rows are written to disk as they are added
+
+    Uses the write-only mode of openpyxl. Memory usage does not grow with the
+    number of cells. Cells are formatted with 'WriteOnlyCell'.
+    """
+
+    def __init__(self):
+        self.workbook = xl.Workbook(write_only=True)
+
+    @instrument('excel.sheet')
+    def add_sheet(self, title, rows):
+        """
+        Add a sheet to the workbook
+
+        Args:
+            :title: (str) sheet title
+            :rows: (iter) rows (lists of plain values or 'XlValue' objects)
+        """
+
+        sheet = self.workbook.create_sheet(title=title)
+        WriteOnlyCell = xl.cell.WriteOnlyCell
+        for row in _count_xl_cells(title, rows):
+            sheet.append([
+                _format_xl_cell(WriteOnlyCell(sheet), value) if isinstance(value, XlValue) else value
+                for value in row
+            ])
+
+    @instrument('excel.save')
+    def save(self, filename):
+        self.workbook.save(filename)
+
+
+def _count_xl_cells(title, rows):
+    """Yield 'rows', the number of cells of the sheet is counted (see 'Metrics')"""
+
+    if not METRICS.enabled:
+        yield from rows
+        return
+    num_cells = 0
+    for row in rows:
+        num_cells += len(row)
+        yield row
+    METRICS.count('excel_cells', num_cells, sheet=title)
+
+
+XL_ENGINES = OrderedDict((
+    ('standard', XlWorkbookWriter),
+    ('stream', XlStreamWriter),
+))
+
+
+class CsvWriter:
+    """
+    Writer for CSV and TSV files with the same tables as the Excel file
+
+    Each sheet is written to its own file while the rows are generated. The
+    first sheet is written to 'filename', every other sheet to a file named
+    after the sheet title (e.g. 'data.csv' --> 'data_activity_all.csv').
+    Formatting is dropped, cells with a hyperlink contain the URL.
+
+    Attributes:
+        :filename: (str) path of the first file
+        :filenames: (list) paths of all written files
+    """
+
+    def __init__(self, filename):
+        self.filename = str(filename)
+        self.format = get_export_format(self.filename)
+        self.filenames = []
+
+    def get_sheet_filename(self, title):
+        """Return the path of the file of a sheet"""
+
+        if not self.filenames:
+            return self.filename
+        suffix = EXPORT_FORMATS[self.format]
+        return f"{self.filename[:-len(suffix)]}_{get_sheet_slug(title)}{suffix}"
+
+    @instrument('csv.sheet')
+    def add_sheet(self, title, rows):
+        """
+        Write a sheet to a new file
+
+        Args:
+            :title: (str) sheet title
+            :rows: (iter) rows (lists of plain values or 'XlValue' objects)
+        """
+
+        filename = self.get_sheet_filename(title)
+        file_tmp = filename + '.tmp'
+        if self.format.endswith('.gz'):
+            fp = gzip.open(file_tmp, 'wt', newline='', encoding='utf-8', compresslevel=GZIP_COMPRESSLEVEL)
+        else:
+            fp = open(file_tmp, 'w', newline='', encoding='utf-8')
+
+        with fp:
+            writer = csv.writer(fp, dialect='excel-tab' if self.format.startswith('tsv') else 'excel')
+            writer.writerows(
+                [(value.hyperlink or value.value) if isinstance(value, XlValue) else value for value in row]
+                for row in rows
+            )
+        os.replace(file_tmp, filename)
+        self.filenames.append(filename)
+        METRICS.count('bytes_written', os.path.getsize(filename), kind='csv')
+
+    def save(self, filename):
+        """Nothing to do, the files are written by 'add_sheet()'"""
+
+
+def get_sheet_slug(title):
+    """Return the sheet title in lowercase with '_' for other characters (CSV file names, unique titles)"""
+
+    return re.sub(r'[^a-z0-9]+', '_', title.lower()).strip('_')
+
+
+def get_sheet_title(prefix, label, titles):
+    """
+    Return a sheet title '<prefix> (<label>)' which is valid and not used yet
+
+    Excel allows at most 'XL_MAX_TITLE_LENGTH' characters and no []:*?/\\.
+    Longer labels are cut and numbered ('~1', '~2', ...), so titles which
+    would be the same after cutting stay apart. Titles are compared by their
+    slugs (Excel ignores the case, CSV file names are built from slugs).
+
+    Args:
+        :prefix: (str) start of the title (e.g. 'Raw')
+        :label: (str) text in parentheses (e.g. 'filter HT tesla')
+        :titles: (set) slugs of the titles in use (see 'get_sheet_slug()'), the new title is added
+
+    Returns:
+        :title: (str) sheet title
+    """
+
+    label = re.sub(r'[\[\]:*?/\\]', ' ', label)
+    title = f"{prefix} ({label})"
+    number = 0
+    while len(title) > XL_MAX_TITLE_LENGTH or get_sheet_slug(title) in titles:
+        number += 1
+        suffix = f"~{number}"
+        room = XL_MAX_TITLE_LENGTH - len(f"{prefix} ()") - len(suffix)
+        title = f"{prefix} ({label[:room].rstrip()}{suffix})"
+    titles.add(get_sheet_slug(title))
+    return title
+
+
+def get_export_format(filename):
+    """
+    Return the export format of an output file from its suffix
+
+    Args:
+        :filename: (str) path of the output file
+
+    Returns:
+        :output_format: (str) one of 'EXPORT_FORMATS' ('xlsx' for unknown suffixes)
+    """
+
+    filename = str(filename).lower()
+    for output_format, suffix in sorted(EXPORT_FORMATS.items(), key=lambda item: -len(item[1])):
+        if filename.endswith(suffix):
+            return output_format
+    return 'xlsx'
+
+
+def get_table_writer(filename, engine='standard'):
+    """
+    Return the writer for an output file (Excel engine, or 'CsvWriter' for CSV and TSV files)
+
+    Args:
+        :filename: (str) path of the output file
+        :engine: (str) Excel engine (see 'XL_ENGINES')
+
+    Returns:
+        :writer: (obj) object with the methods 'add_sheet()' and 'save()'
+    """
+
+    if get_export_format(filename) == 'xlsx':
+        return XL_ENGINES[engine]()
+    return CsvWriter(filename)
+
+
+def write_xl_rows(sheet, rows):
+    """
+    Write rows to an Excel sheet, starting in the first row
+
+    Args:
+        :sheet: (obj) Excel sheet reference
+        :rows: (iter) rows (lists of plain values or 'XlValue' objects)
+    """
+
+    for i, row in enumerate(rows, start=1):
+        for j, value in enumerate(row, start=1):
+            if value is not None:
+                _format_xl_cell(sheet.cell(row=i, column=j), value)
+
+
+def print_xl_sheet_header(sheet, headers, *, horizontal=True):
+    """
+    Add a highlighted header row or column to an Excel sheet
+
+    Args:
+        :sheet: (obj) Excel sheet reference
+        :headers: (list) headers to be printed
+        :horizontal: (bool) if True, row one will be filled, otherwise column 1
+    """
+
+    for i, header in enumerate(headers, start=1):
+        cell = sheet.cell(row=1, column=i) if horizontal else sheet.cell(row=i, column=1)
+        _format_xl_cell(cell, xl_header(header))
+
+
+def get_media_cell(paths):
+    """Return the cell with the media files of a tweet (a link if there is only one file)"""
+
+    if len(paths) == 1:
+        return XlValue(paths[0], hyperlink=paths[0])
+    return ' '.join(paths)
+
+
+def iter_tweet_rows(tweets, username, media=None):
+    """
+    Yield the rows of a sheet listing tweets (including the header)
+
+    Args:
+        :tweets: (list) Tweets from 'twitter_data' (or 'TweetTable')
+        :username: (str) twitter account (for links to tweets, unless tweets have a key 'username')
+        :media: (callable) if given, add a column with the downloaded media files,
+                'media(tweet)' returns the paths of the files of a tweet
+    """
+
+    headers = ["Time", "url", "isRetweet", "replies", "retweets", "likes", "hashtags", "text"]
+    if media is not None:
+        headers.append("media")
+    yield [xl_header(header) for header in headers]
+
+    for tweet in tweets:
+        row = [
+            tweet['time'],
+            XlValue("link", hyperlink=get_tweet_url(tweet.get('username', username), tweet['tweetId'])),
+            XlValue(str(tweet['isRetweet']), fill=XL_FILL_RED) if tweet['isRetweet'] else str(tweet['isRetweet']),
+            tweet['replies'],
+            tweet['retweets'],
+            tweet['likes'],
+            str(tweet['entries']['hashtags']),
+            tweet['text'],
+        ]
+        if media is not None:
+            row.append(get_media_cell(media(tweet)))
+        yield row
+
+
+def iter_activity_rows(table, granularity='day', mask=None):
+    """
+    Yield the rows of a sheet with tweet activity (including the header)
+
+    Args:
+        :table: (obj) 'TweetTable' (or dictionary with twitter data)
+        :granularity: (str) one of 'ACTIVITY_GRANULARITIES'
+        :mask: (array) optional boolean array, only tweets marked True are counted
+    """
+
+    activity = aggregate_activity(as_tweet_table(table), granularity, mask=mask)
+
+    # Tweets per hour of the week (rows: weekdays, columns: hours)
+    if granularity == 'heatmap':
+        yield [xl_header("Weekday")] + [xl_header(f"{hour:02d}:00") for hour in range(24)]
+        for weekday, counts in zip(WEEKDAYS, activity['totTweets'].reshape(7, 24).tolist()):
+            yield [xl_header(weekday), *counts]
+        return
+
+    label, fmt = {
+        'hour': ("Hour", '%F %H:00'),
+        'day': ("Day", '%F'),
+        'week': ("Week", '%F'),
+        'month': ("Month", '%Y-%m'),
+    }[granularity]
+
+    headers = [label, *list(activity)[1:]]
+    yield [xl_header(header) for header in headers]
+
+    labels = (_to_datetime(b).strftime(fmt) for b in activity['bins'])
+    yield from map(list, zip(labels, *(activity[key].tolist() for key in headers[1:])))
+
+
+def iter_profile_rows(profile):
+    """
+    Yield the rows of a sheet with profile data (headers in the first column)
+
+    Args:
+        :profile: (dict) profile data
+    """
+
+    headers = ["name", "username", "likes_count", "tweets_count", "followers_count", "following_count"]
+    for header in headers:
+        yield [xl_header(header), profile.get(header, 'NONE')]
+
+
+def print_tweets_to_xl_sheet(sheet, tweets, username):
+    """
+    List all tweets in an Excel sheet
+
+    Args:
+        :sheet: (obj) Excel sheet reference
+        :tweets: (list) Tweets from 'twitter_data'
+    """
+
+    write_xl_rows(sheet, iter_tweet_rows(tweets, username))
+
+
+def print_tweets_per_day_to_xl_sheet(sheet, table):
+    """
+    Create an Excel sheet with tweet activity per day
+
+    Args:
+        :sheet: (obj) Excel sheet reference
+        :table: (obj) 'TweetTable' (or dictionary with twitter data)
+    """
+
+    print_activity_to_xl_sheet(sheet, table, granularity='day')
+
+
+def print_activity_to_xl_sheet(sheet, table, granularity='day', mask=None):
+    """
+    Create an Excel sheet with tweet activity
+
+    Args:
+        :sheet: (obj) Excel sheet reference
+        :table: (obj) 'TweetTable' (or dictionary with twitter data)
+        :granularity: (str) one of 'ACTIVITY_GRANULARITIES'
+        :mask: (array) optional boolean array, only tweets marked True are counted
+    """
+
+    write_xl_rows(sheet, iter_activity_rows(table, granularity, mask=mask))
 
-    for tweet in tweets:
-        parsed_hashtags = list(parse_filter_kw(ht)[1] for ht in tweet['entries']['hashtags'])
-        if parsed_kw in parsed_hashtags:
-            filtered_tweets.append(tweet)
-            continue
-        if not is_hashtag and parsed_kw in tweet['text'].lower():
-            filtered_tweets.append(tweet)
 
-    logger.info(f"Found {len(filtered_tweets)} tweets for filter {filter_kw!r}...")
-    return filtered_tweets
+# ----- Conversion cache -----
+def file_fingerprint(filename, *, content=True):
+    """
+    Return size, modification time and (optionally) content hash of a file
 
+    Args:
+        :filename: (str) path of the file
+        :content: (bool) if True, add the SHA-256 hash of the file content
 
-def print_xl_sheet_header(sheet, headers, *, horizontal=True):
+    Returns:
+        :fingerprint: (dict) file fingerprint
     """
-    Add a highlighted header row or column to an Excel sheet
+
+    stat = os.stat(filename)
+    fingerprint = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+    if content:
+        sha256 = hashlib.sha256()
+        with open(filename, 'rb') as fp:
+            for chunk in iter(partial(fp.read, 1 << 20), b''):
+                sha256.update(chunk)
+        fingerprint['sha256'] = sha256.hexdigest()
+
+    return fingerprint
+
+
+def get_conversion_key(filters=None, activity=None, output_format='xlsx', media=False, summary=False, **options):
+    """
+    Return the part of the conversion options which affects the Excel content
+
+    Note: the Excel engine only changes how the file is written, not its content.
 
     Args:
-        :sheet: (obj) Excel sheet reference
-        :headers: (list) headers to be printed
-        :horizontal: (bool) if True, row one will be filled, otherwise column 1
+        :filters: (list) list of filters
+        :activity: (list) additional activity granularities
+        :output_format: (str) one of 'EXPORT_FORMATS'
+        :media: (bool) True if the sheets have a media column (the size of the media
+                index is part of the key, so new downloads are noticed)
+        :summary: (bool) True if there is a summary sheet
+
+    Returns:
+        :key: (dict) tool version and normalised options
     """
 
-    for i, header in enumerate(headers, start=1):
-        cell = sheet.cell(row=1, column=i) if horizontal else sheet.cell(row=i, column=1)
-        cell.value = header
-        cell.fill = XL_FILL_GREEN
-        cell.font = XL_FONT_BOLD
+    return {
+        'version': VERSION,
+        'filters': list(filters or ()),
+        'activity': [g for g in OrderedDict.fromkeys(activity or ()) if g != 'day'],
+        'format': output_format,
+        'media': bool(media),
+        'media_index': get_media_index_size() if media else None,
+        'summary': bool(summary),
+    }
 
 
-def print_tweets_to_xl_sheet(sheet, tweets, username):
+class ConversionCache:
     """
-    List all tweets in an Excel sheet
+    Manifest of converted files, used to skip conversions which are up to date
+
+    Each data directory gets a hidden manifest file ('XL_CACHE_FILENAME').
+    For every JSON file it records the fingerprint of the JSON file and the
+    Excel file as well as the conversion options and the tool version.
+    """
+
+    def __init__(self):
+        self._manifests = {}
+
+    def _manifest(self, dirname):
+        if dirname not in self._manifests:
+            manifest = {}
+            try:
+                with open(os.path.join(dirname, XL_CACHE_FILENAME), 'r') as fp:
+                    manifest = json.load(fp)
+            except FileNotFoundError:
+                pass
+            except (OSError, ValueError) as e:
+                logger.warning(f"Ignoring conversion cache in {truncate_filepath(dirname)!r}: {e}")
+            self._manifests[dirname] = manifest if isinstance(manifest, dict) else {}
+        return self._manifests[dirname]
+
+    def _entry(self, json_file):
+        dirname, basename = os.path.split(os.path.abspath(json_file))
+        return self._manifest(dirname), basename
+
+    def is_up_to_date(self, json_file, excel_file, options):
+        """
+        Check if the Excel file is up to date
+
+        The content hash is only computed if size or modification time of
+        the JSON file changed (e.g. after copying the data directory).
+
+        Args:
+            :json_file: (str) path of the twitter data file
+            :excel_file: (str) path of the Excel file
+            :options: (dict) conversion options
+
+        Returns:
+            :up_to_date: (bool) True, if the conversion can be skipped
+        """
+
+        manifest, basename = self._entry(json_file)
+        entry = manifest.get(basename)
+        if not entry or entry.get('key') != get_conversion_key(**options):
+            return False
+
+        try:
+            if file_fingerprint(excel_file, content=False) != entry['excel']:
+                return False
+            source = file_fingerprint(json_file, content=False)
+            if source['size'] != entry['source']['size']:
+                return False
+            if source['mtime_ns'] != entry['source']['mtime_ns']:
+                source = file_fingerprint(json_file)
+                if source['sha256'] != entry['source']['sha256']:
+                    return False
+                entry['source'] = source  # Same content, remember the new time stamp
+        except (OSError, KeyError, TypeError):
+            return False
+
+        return True
+
+    def record(self, json_file, excel_file, source, options):
+        """
+        Add a conversion to the manifest
+
+        Args:
+            :json_file: (str) path of the twitter data file
+            :excel_file: (str) path of the Excel file
+            :source: (dict) fingerprint of 'json_file' taken before the conversion
+            :options: (dict) conversion options
+        """
+
+        manifest, basename = self._entry(json_file)
+        manifest[basename] = {
+            'source': source,
+            'excel': file_fingerprint(excel_file, content=False),
+            'key': get_conversion_key(**options),
+        }
+
+    def rename(self, json_file, new_file, source):
+        """
+        Move the entry of a data file which was stored under a new name
+
+        The entry is only kept if it belongs to the old file as it was before
+        (same size and modification time). The content of the new file must
+        be the same (e.g. after a change of the storage format).
+
+        Args:
+            :json_file: (str) old path of the twitter data file
+            :new_file: (str) new path of the twitter data file
+            :source: (dict) fingerprint of 'json_file' before it was replaced
+        """
+
+        manifest, basename = self._entry(json_file)
+        entry = manifest.pop(basename, None)
+        if entry is None or {k: entry['source'].get(k) for k in source} != source:
+            return
+
+        new_manifest, new_basename = self._entry(new_file)
+        entry['source'] = file_fingerprint(new_file)
+        new_manifest[new_basename] = entry
+
+    def save(self):
+        """Write all loaded manifests to disk"""
+
+        for dirname, manifest in self._manifests.items():
+            filename = os.path.join(dirname, XL_CACHE_FILENAME)
+            try:
+                with open(filename + '.tmp', 'w') as fp:
+                    json.dump(manifest, fp, indent=2, sort_keys=True)
+                os.replace(filename + '.tmp', filename)
+            except OSError as e:
+                logger.warning(f"Could not save conversion cache {truncate_filepath(filename)!r}: {e}")
+
+
+def get_excel_filename(json_file, output_format='xlsx'):
+    """
+    Return the name of the Excel file for a twitter data file
 
     Args:
-        :sheet: (obj) Excel sheet reference
-        :tweets: (list) Tweets from 'twitter_data'
+        :json_file: (str) path of the twitter data file
+        :output_format: (str) one of 'EXPORT_FORMATS'
+
+    Returns:
+        :excel_file: (str) path of the Excel file (of the first CSV file for CSV and TSV)
     """
 
-    headers = ["Time", "url", "isRetweet", "replies", "retweets", "likes", "hashtags", "text"]
-    print_xl_sheet_header(sheet, headers)
+    json_file = str(json_file)
+    suffix_out = EXPORT_FORMATS[output_format]
+    for suffix in DATA_SUFFIXES:
+        if json_file.endswith(suffix):
+            return json_file[:-len(suffix)] + suffix_out
+    return json_file + suffix_out
+
+
+def convert_file_to_excel(json_file, output_format='xlsx', column_cache=True, **options):
+    """
+    Convert a twitter data file to an Excel file in the same directory
+
+    Args:
+        :json_file: (str) path of the twitter data file
+        :output_format: (str) one of 'EXPORT_FORMATS'
+        :column_cache: (bool) if True, read the tweets from the column cache (see 'read_column_table()')
+        :options: (dict) keyword arguments for 'convert_to_excel()' (filters, ...)
+
+    Returns:
+        :excel_file: (str) path of the created Excel file
+    """
 
-    for i, tweet in enumerate(tweets, start=2):
-        sheet.cell(row=i, column=1, value=tweet['time'])
-        sheet.cell(row=i, column=2, value="link").hyperlink = get_tweet_url(username, tweet['tweetId'])
-        cell = sheet.cell(row=i, column=3, value=str(tweet['isRetweet']))
-        if tweet['isRetweet']:
-                cell.fill = XL_FILL_RED
-        sheet.cell(row=i, column=4, value=tweet['replies'])
-        sheet.cell(row=i, column=5, value=tweet['retweets'])
-        sheet.cell(row=i, column=6, value=tweet['likes'])
-        sheet.cell(row=i, column=7, value=str(tweet['entries']['hashtags']))
-        sheet.cell(row=i, column=8, value=tweet['text'])
+    excel_file = get_excel_filename(json_file, output_format)
+    logger.info(f"Importing twitter data from file: {truncate_filepath(json_file)}")
+    profile, tweets = read_column_table(json_file) if column_cache else read_twitter_data(json_file)
+    convert_to_excel({'profile': profile, 'history': tweets}, excel_file, **options)
+    return excel_file
 
 
-def print_tweets_per_day_to_xl_sheet(sheet, twitter_data):
+def _convert_file_job(json_file, options, metrics=False):
     """
-    Create an Excel sheet with tweet activity
+    Convert one file (runs in a worker process)
 
     Args:
-        :sheet: (obj) Excel sheet reference
-        :twitter_data: (dict) dictionary with twitter data
+        :json_file: (str) path of the twitter data file
+        :options: (dict) keyword arguments for 'convert_to_excel()'
+        :metrics: (bool) if True, collect metrics in this process and return them
+
+    Returns:
+        :excel_file: (str) path of the created Excel file
+        :duration: (float) conversion time in seconds
+        :metrics_state: (dict) collected metrics (or None, see 'Metrics.state()')
+    """
+
+    if metrics:
+        METRICS.reset(enabled=True)
+
+    start = time.perf_counter()
+    excel_file = convert_file_to_excel(json_file, **options)
+    return excel_file, time.perf_counter() - start, (METRICS.state() if metrics else None)
+
+
+def convert_files_to_excel(filenames, *, jobs=1, force=False, **options):
+    """
+    Convert several twitter data files to Excel files
+
+    With 'jobs' > 1, the files are distributed to a pool of worker processes.
+    An error in one file is logged, but does not stop the other conversions.
+    Files which have not changed since their last conversion (with the same
+    options) are skipped, unless 'force' is True.
+
+    Args:
+        :filenames: (list) paths of the twitter data files
+        :jobs: (int) number of worker processes
+        :force: (bool) if True, convert all files
+        :options: (dict) keyword arguments for 'convert_to_excel()' (filters, ...)
+
+    Returns:
+        :results: (dict) filename as key and True (success) or False (failure) as value
     """
 
-    headers = ["Day", "totTweets", "ownTweets"]
-    print_xl_sheet_header(sheet, headers)
+    results = OrderedDict((filename, False) for filename in filenames)
+    cache = ConversionCache()
+
+    # Fingerprints are taken before converting, changes during the conversion are noticed next time
+    sources = OrderedDict()
+    num_skipped = 0
+    num_unreadable = 0
+    for filename in filenames:
+        excel_file = get_excel_filename(filename, options.get('output_format', 'xlsx'))
+        if not force and cache.is_up_to_date(filename, excel_file, options):
+            logger.info(f"Up to date: {truncate_filepath(filename)}")
+            results[filename] = True
+            num_skipped += 1
+            continue
+        try:
+            sources[filename] = file_fingerprint(filename)
+        except OSError as e:
+            logger.error(f"Failed to read {truncate_filepath(filename)}: {e}")
+            num_unreadable += 1
+
+    num_todo = len(sources)
+    jobs = max(1, min(jobs, num_todo))
+    logger.info(
+        f"Converting {num_todo} file(s) with {jobs} job(s) ({num_skipped} up to date, {num_unreadable} unreadable)..."
+    )
 
-    tweets_per_day = get_tweets_per_day(twitter_data)
-    # Only count tweets made by the own account (exclude retweets)
-    tweets_per_day_own = get_tweets_per_day(twitter_data, include_retweet=False)
+    start = time.perf_counter()
+    total_duration = 0
+    num_done = 0
+
+    def report(filename, get_result):
+        nonlocal total_duration, num_done
+        num_done += 1
+        progress = f"[{num_done}/{num_todo}]"
+        try:
+            excel_file, duration, metrics_state = get_result()
+        except Exception as e:
+            logger.error(f"{progress} Failed to convert {truncate_filepath(filename)}: {e}")
+            return
+        total_duration += duration
+        if metrics_state is not None:
+            METRICS.merge(metrics_state)
+        results[filename] = True
+        cache.record(filename, excel_file, sources[filename], options)
+        logger.info(f"{progress} Converted {truncate_filepath(excel_file)} ({duration:.1f} s)")
 
-    for i, (day, num_tweets) in enumerate(tweets_per_day.items(), start=2):
-        sheet.cell(row=i, column=1, value=day.strftime('%F'))
-        sheet.cell(row=i, column=2, value=num_tweets)
-        sheet.cell(row=i, column=3, value=tweets_per_day_own.get(day, 0))
+    try:
+        if jobs == 1:
+            for filename in sources:
+                report(filename, partial(_convert_file_job, filename, options))
+        else:
+            with ProcessPoolExecutor(max_workers=jobs) as pool:
+                futures = {
+                    pool.submit(_convert_file_job, filename, options, METRICS.enabled): filename
+                    for filename in sources
+                }
+                for future in as_completed(futures):
+                    report(futures[future], future.result)
+    finally:
+        cache.save()
+
+    failed = [filename for filename, success in results.items() if not success]
+    num_converted = sum(results[filename] for filename in sources)
+    logger.info(
+        f"Summary: {num_converted} converted, {num_skipped} up to date, {len(failed)} failed "
+        f"({num_unreadable} unreadable) | "
+        f"{time.perf_counter() - start:.1f} s wall time, {total_duration:.1f} s conversion time"
+    )
+    for filename in failed:
+        logger.error(f"Failed: {truncate_filepath(filename)}")
+    return results
 
 
-def convert_to_excel(twitter_data, excel_file, filters):
+@instrument('excel.convert')
+def convert_to_excel(twitter_data, excel_file, filters=None, activity=None, engine='standard', memory_budget=None,
+                     media=False, summary=False):
     """
     Convert a twitter data dictionary to a excel file
 
+    If 'excel_file' ends with '.csv' or '.tsv' (optionally '.gz'), the sheets
+    are written to CSV files instead (see 'CsvWriter').
+
     Args:
-        :twitter_data: (dict) dictionary with twitter data
+        :twitter_data: (dict) dictionary with twitter data ('history' can be a generator)
         :excel_file: (str) excel file name
         :filters: (list) list of filters
+        :activity: (list) additional activity granularities (see 'ACTIVITY_GRANULARITIES')
+        :engine: (str) Excel engine (see 'XL_ENGINES')
+        :memory_budget: (int) bytes, larger histories are sorted on disk (no limit by default)
+        :media: (bool) if True, the tweet sheets have a column with the downloaded media files
+                (looked up in the 'MediaStore', paths are relative to the Excel file)
+        :summary: (bool) if True, add a sheet with top hashtags, top tweets, ... (see 'TweetSummary')
     """
 
     title_tweets = "Raw"
     title_activity = "Activity"
     title_profile = "Profile"
 
-    logger.info("Creating excel file...")
+    output_format = get_export_format(excel_file)
+    if output_format == 'xlsx':
+        logger.info(f"Creating excel file (engine: {engine})...")
+    else:
+        logger.info(f"Creating {output_format} files...")
 
-    tweets = get_tweets(twitter_data)
+    # Tweets are parsed and sorted only once, all sheets use views of this table
+    table = build_tweet_table(get_tweets(twitter_data, sort=False), memory_budget)
+    logger.info(f"Found {len(table)} tweets...")
     username = twitter_data['profile'].get('username', None)
-    workbook = xl.Workbook()
+    workbook = get_table_writer(excel_file, engine)
+    titles = {get_sheet_slug(title) for title in (title_profile, "Summary", "Filters")}
+
+    get_media = None
+    if media:
+        store = MediaStore(DIR_MEDIA)
+        start = os.path.dirname(os.path.abspath(excel_file))
+
+        def get_media(tweet):
+            return store.get_paths(get_media_urls(tweet), start)
 
     # ----- Tweets (all) -----
-    sheet = workbook.active
-    sheet.title = f"{title_tweets} (all)"
-    print_tweets_to_xl_sheet(sheet, tweets, username)
+    workbook.add_sheet(get_sheet_title(title_tweets, "all", titles), iter_tweet_rows(table, username, get_media))
 
     # ----- Activity (all) -----
-    sheet = workbook.create_sheet(title=f"{title_activity} (all)")
-    print_tweets_per_day_to_xl_sheet(sheet, twitter_data)
+    workbook.add_sheet(get_sheet_title(title_activity, "all", titles), iter_activity_rows(table, 'day'))
+
+    # ----- Activity (other granularities) -----
+    for granularity in OrderedDict.fromkeys(activity or ()):
+        if granularity == 'day':
+            continue
+        workbook.add_sheet(get_sheet_title(title_activity, granularity, titles), iter_activity_rows(table, granularity))
 
     # ----- User data -----
-    sheet = workbook.create_sheet(title=f"{title_profile}")
-    profile = twitter_data['profile']
-    headers = ["name", "username", "likes_count", "tweets_count", "followers_count", "following_count"]
-    print_xl_sheet_header(sheet, headers, horizontal=False)
-    for i, header in enumerate(headers, start=1):
-        sheet.cell(row=i, column=2, value=profile.get(header, 'NONE'))
+    workbook.add_sheet(f"{title_profile}", iter_profile_rows(twitter_data['profile']))
+
+    # ----- Summary -----
+    if summary:
+        tweet_summary = TweetSummary()
+        tweet_summary.update(table, username)
+        workbook.add_sheet("Summary", iter_summary_rows(tweet_summary))
 
     # ----- Filter tweets by keywords or hashtags -----
     if filters is not None:
-        for filter_kw in filters:
-            is_hashtag, parsed_kw = parse_filter_kw(filter_kw)
-            logger.info(f"Applying filter {'#' if is_hashtag else ''}{filter_kw!r} (hashtag: {is_hashtag})...")
+        # All filters are evaluated together
+        filter_masks = FilterEngine(table).match(filters)
+
+        # Long filters (e.g. expressions) get shortened titles, the legend lists the full filters
+        filter_titles = OrderedDict()
+        for filter_kw in filter_masks:
+            kind, parsed_kw = get_filter_label(filter_kw)
+            filter_titles[filter_kw] = (
+                get_sheet_title(title_tweets, f"filter {kind} {parsed_kw}", titles),
+                get_sheet_title(title_activity, f"filter {kind} {parsed_kw}", titles),
+            )
+
+        # ----- Filters (legend) -----
+        headers = ["filter", "tweets", "tweets sheet", "activity sheet"]
+        workbook.add_sheet("Filters", [
+            [xl_header(header) for header in headers],
+            *([filter_kw, int(np.count_nonzero(mask)), *filter_titles[filter_kw]] for filter_kw, mask in filter_masks.items()),
+        ])
+
+        for filter_kw, mask in filter_masks.items():
+            title_filter_tweets, title_filter_activity = filter_titles[filter_kw]
+            logger.info(f"Applying filter {filter_kw!r} (sheets: {title_filter_tweets!r}, {title_filter_activity!r})...")
+            logger.info(f"Found {np.count_nonzero(mask)} tweets for filter {filter_kw!r}...")
 
             # ----- Tweets (filter) -----
-            # Note: sheet title cannot have special characters (e.g. ', or #), otherwise silent failure
-            sheet = workbook.create_sheet(f"{title_tweets} (filter {'HT' if is_hashtag else 'KW'} {parsed_kw})")
-            filtered_tweets = filter_tweets(tweets, filter_kw)
-            print_tweets_to_xl_sheet(sheet, filtered_tweets, username)
+            workbook.add_sheet(title_filter_tweets, iter_tweet_rows(table.select(mask), username, get_media))
 
             # ----- Activity (filter) -----
-            sheet = workbook.create_sheet(f"{title_activity} (filter {'HT' if is_hashtag else 'KW'} {parsed_kw})")
-            print_tweets_per_day_to_xl_sheet(sheet, twitter_data={'history': filtered_tweets})
+            workbook.add_sheet(title_filter_activity, iter_activity_rows(table, 'day', mask=mask))
 
     # ----- Save Excel file -----
     logger.info(f"Saving data: {truncate_filepath(excel_file)}")
     workbook.save(excel_file)
+    if output_format == 'xlsx':
+        METRICS.count('bytes_written', os.path.getsize(excel_file), kind='excel')
+
+
+# ----- Snapshot diff -----
+def find_snapshot_files(paths):
+    """
+    Return the data files of snapshots, grouped by account
+
+    Args:
+        :paths: (list) data files, snapshot directories or directories with snapshots
+
+    Returns:
+        :snapshots: (dict) account as key and list of tuples (time, data file) in chronological order as value
+    """
+
+    filenames = []
+    for path in paths:
+        if os.path.isfile(path):
+            filenames.append(path)
+        elif find_data_file(path) is not None:
+            filenames.append(find_data_file(path))
+        elif os.path.isdir(path):
+            filenames.extend(find_data_files(path))
+        else:
+            raise FileNotFoundError(f"{truncate_filepath(path)!r} is not a data file or directory")
+
+    snapshots = OrderedDict()
+    for filename in OrderedDict.fromkeys(os.path.abspath(filename) for filename in filenames):
+        snapshot = parse_snapshot_dirname(os.path.basename(os.path.dirname(filename)))
+        if snapshot is None:
+            raise ValueError(f"{truncate_filepath(filename)!r} is not in a snapshot directory (<username>_<YYYY-MM-DD>_<HHMM>)")
+        username, taken_at = snapshot
+        snapshots.setdefault(username, []).append((taken_at, filename))
+
+    for username in snapshots:
+        snapshots[username].sort()
+    return snapshots
+
+
+@instrument('diff.read')
+def read_engagement_columns(filename, column_cache=True):
+    """
+    Read tweet IDs, timestamps and engagement counts of a snapshot, sorted by tweet ID
+
+    Only these columns are kept, the file is read as a stream. If a tweet ID
+    appears more than once, the first record is used.
+
+    Args:
+        :filename: (str) path of the data file
+        :column_cache: (bool) if True, read the columns from the column cache (see 'read_column_table()')
+
+    Returns:
+        :columns: (dict) 'ids', 'epochs', 'likes', 'retweets', 'replies' (arrays),
+                  'times' (list) and 'oldest' (timestamp of the last downloaded tweet)
+    """
+
+    _, tweets = read_column_table(filename) if column_cache else read_twitter_data(filename)
+    if isinstance(tweets, ColumnTable):
+        # Back to the order of the data file
+        tweets = tweets.select(np.argsort(tweets.order, kind='stable'))
+        ids, epochs, times = tweets.tweet_ids, tweets.epochs, list(tweets.iter_strings('time'))
+        likes, retweets, replies = tweets.likes, tweets.retweets, tweets.replies
+    else:
+        ids, epochs, times, likes, retweets, replies = [], None, [], [], [], []
+        for tweet in tweets:
+            ids.append(int(tweet['tweetId']))
+            times.append(tweet['time'])
+            likes.append(tweet['likes'])
+            retweets.append(tweet['retweets'])
+            replies.append(tweet['replies'])
+
+    ids = np.array(ids, dtype=np.int64)
+    order = np.argsort(ids, kind='stable')
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = ids[order][1:] != ids[order][:-1]
+    order = order[first]
+
+    return OrderedDict((
+        ('ids', ids[order]),
+        ('epochs', epochs[order] if epochs is not None else np.array([parse_epoch(times[i]) for i in order.tolist()], dtype=np.int64)),
+        ('likes', np.array(likes, dtype=np.int64)[order]),
+        ('retweets', np.array(retweets, dtype=np.int64)[order]),
+        ('replies', np.array(replies, dtype=np.int64)[order]),
+        ('times', [times[i] for i in order.tolist()]),
+        # Tweets are saved newest first, but a pinned tweet can be older than all others
+        ('oldest', parse_epoch(times[-1]) if times else np.iinfo(np.int64).max),
+    ))
+
+
+def join_engagement_columns(old, new):
+    """
+    Match the tweets of two snapshots (merge-join on the sorted tweet IDs)
+
+    A tweet which is missing in the newer snapshot is only reported as
+    deleted if it is not older than the last downloaded tweet of the newer
+    snapshot. Older tweets were simply not downloaded again.
+
+    Args:
+        :old: (dict) columns of the older snapshot (see 'read_engagement_columns()')
+        :new: (dict) columns of the newer snapshot
+
+    Returns:
+        :kept_old: (array) positions in 'old' of tweets found in both snapshots
+        :kept_new: (array) positions in 'new' of the same tweets
+        :added: (array) positions in 'new' of tweets which are not in 'old'
+        :deleted: (array) positions in 'old' of tweets which are not in 'new'
+    """
+
+    # Both ID columns are sorted, so the stable sort (Timsort) of both columns
+    # finds two runs and merges them in a single linear pass. IDs are unique
+    # within a snapshot, and the old ID comes first, so a tweet of both
+    # snapshots is an old ID directly followed by the same new ID.
+    num_old = len(old['ids'])
+    merged = np.concatenate((old['ids'], new['ids']))
+    order = np.argsort(merged, kind='stable')
+    is_pair = merged[order[1:]] == merged[order[:-1]]
+
+    kept_old = order[:-1][is_pair]
+    kept_new = order[1:][is_pair] - num_old
+    found = np.zeros(num_old, dtype=bool)
+    found[kept_old] = True
+
+    is_added = np.ones(len(new['ids']), dtype=bool)
+    is_added[kept_new] = False
+    added = np.nonzero(is_added)[0]
+
+    deleted = np.nonzero(~found & (old['epochs'] >= new['oldest']))[0]
+
+    return kept_old, kept_new, added, deleted
+
+
+def iter_diff_rows(snapshots, summary=None, column_cache=True):
+    """
+    Yield the rows of a sheet with engagement changes between consecutive snapshots
+
+    Only two snapshots are held in memory at any time.
+
+    Args:
+        :snapshots: (dict) account as key and list of tuples (time, data file) as value (see 'find_snapshot_files()')
+        :summary: (list) optional list, one summary row per pair of snapshots is appended
+        :column_cache: (bool) if True, read the snapshots from their column caches
+    """
+
+    headers = [
+        "account", "url", "Time", "status", "from", "to", "hours",
+        "likes", "retweets", "replies",
+        "delta likes", "delta retweets", "delta replies",
+        "likes per hour", "retweets per hour", "replies per hour",
+    ]
+    yield [xl_header(header) for header in headers]
+    counts = ('likes', 'retweets', 'replies')
+
+    def link(username, tweet_id):
+        return XlValue("link", hyperlink=get_tweet_url(username, tweet_id))
+
+    for username, files in snapshots.items():
+        if len(files) < 2:
+            logger.warning(f"[{username}] Only one snapshot, nothing to compare")
+            continue
+
+        old_time, old_file = files[0]
+        old = read_engagement_columns(old_file, column_cache)
+        for new_time, new_file in files[1:]:
+            new = read_engagement_columns(new_file, column_cache)
+            hours = (new_time - old_time).total_seconds()/3600
+            span = (old_time.strftime('%F %H:%M'), new_time.strftime('%F %H:%M'), round(hours, 2))
+            kept_old, kept_new, added, deleted = join_engagement_columns(old, new)
+
+            deltas = [new[key][kept_new] - old[key][kept_old] for key in counts]
+            rates = [delta/hours if hours > 0 else np.zeros(len(delta)) for delta in deltas]
+            for j, (i_old, i_new) in enumerate(zip(kept_old.tolist(), kept_new.tolist())):
+                yield [
+                    username, link(username, int(new['ids'][i_new])), new['times'][i_new], "kept", *span,
+                    *(int(new[key][i_new]) for key in counts),
+                    *(int(delta[j]) for delta in deltas),
+                    *(round(float(rate[j]), 2) for rate in rates),
+                ]
+            for i in added.tolist():
+                yield [
+                    username, link(username, int(new['ids'][i])), new['times'][i], "added", *span,
+                    *(int(new[key][i]) for key in counts),
+                ]
+            for i in deleted.tolist():
+                yield [
+                    XlValue(username, fill=XL_FILL_RED), link(username, int(old['ids'][i])), old['times'][i], "deleted", *span,
+                    *(int(old[key][i]) for key in counts),
+                ]
+
+            if summary is not None:
+                summary.append([
+                    username, *span, len(kept_old), len(added), len(deleted),
+                    *(int(delta.sum()) for delta in deltas),
+                ])
+            logger.info(
+                f"[{username}] {span[0]} --> {span[1]}: {len(kept_old)} kept, {len(added)} added, {len(deleted)} deleted"
+            )
+            old_time, old = new_time, new
+
+
+def diff_snapshots(paths, output, engine='stream', column_cache=True):
+    """
+    Compare snapshots and write the engagement changes to an Excel or CSV file
+
+    Args:
+        :paths: (list) data files, snapshot directories or directories with snapshots
+        :output: (str) output file ('.csv' or '.tsv' for CSV, otherwise Excel, see 'get_table_writer()')
+        :engine: (str) Excel engine (see 'XL_ENGINES')
+        :column_cache: (bool) if True, read the snapshots from their column caches
+
+    Returns:
+        :snapshots: (dict) compared snapshots (see 'find_snapshot_files()')
+    """
+
+    snapshots = find_snapshot_files(paths)
+    logger.info(f"Comparing {sum(len(files) for files in snapshots.values())} snapshot(s) of {len(snapshots)} account(s)...")
+
+    summary = []
+    workbook = get_table_writer(output, engine)
+    workbook.add_sheet("Diff", iter_diff_rows(snapshots, summary, column_cache))
+    headers = [
+        "account", "from", "to", "hours", "kept", "added", "deleted",
+        "delta likes", "delta retweets", "delta replies",
+    ]
+    workbook.add_sheet("Summary", [[xl_header(header) for header in headers], *summary])
+    workbook.save(output)
+
+    logger.info(f"Saved diff: {truncate_filepath(output)}")
+    return snapshots
+
+
+# ----- Summary sketches -----
+def _sketch_hashes(items):
+    """
+    Return two 64-bit hashes of each string
+
+    Unlike 'hash()', the hashes are the same in every process, so that
+    sketches stored on disk can be merged.
+
+    Args:
+        :items: (list) strings
+
+    Returns:
+        :h1: (array) first hash of each item (uint64)
+        :h2: (array) second hash of each item (uint64)
+    """
+
+    digests = b''.join(hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest() for item in items)
+    hashes = np.frombuffer(digests, dtype='<u8').reshape(-1, 2)
+    return hashes[:, 0], hashes[:, 1]
+
+
+def _encode_array(array):
+    """Return an array as compressed base64 string (for JSON)"""
+
+    return base64.b64encode(zlib.compress(np.ascontiguousarray(array).tobytes())).decode('ascii')
+
+
+def _decode_array(string, dtype, shape):
+    """Return the array of a string from '_encode_array()'"""
+
+    return np.frombuffer(zlib.decompress(base64.b64decode(string)), dtype=dtype).reshape(shape).copy()
+
+
+class CountMinSketch:
+    """
+    Approximate counts of many items in a fixed table (Count-Min sketch)
+
+    An estimate is never smaller than the true count. Sketches with the same
+    width and depth are merged by adding the tables.
+
+    Attributes:
+        :width: (int) counters per row
+        :depth: (int) rows (one hash function each)
+        :table: (array) counters, shape (depth, width)
+    """
+
+    def __init__(self, width=SKETCH_WIDTH, depth=SKETCH_DEPTH):
+        self.width = width
+        self.depth = depth
+        self.table = np.zeros((depth, width), dtype=np.int64)
+
+    def _indices(self, items):
+        # Double hashing, row i uses h1 + i*h2 (h2 is odd, so all counters of a row can be reached)
+        h1, h2 = _sketch_hashes(items)
+        rows = np.arange(self.depth, dtype=np.uint64)[:, None]
+        return ((h1[None, :] + rows*(h2[None, :] | np.uint64(1))) % np.uint64(self.width)).astype(np.intp)
+
+    def update(self, counts):
+        """
+        Add counts
+
+        Args:
+            :counts: (dict) item (str) as key and count (int) as value
+        """
+
+        if not counts:
+            return
+        indices = self._indices(list(counts))
+        values = np.fromiter(counts.values(), dtype=np.int64, count=len(counts))
+        for row in range(self.depth):
+            np.add.at(self.table[row], indices[row], values)
+
+    def estimate(self, items):
+        """
+        Return the estimated counts of items
+
+        Args:
+            :items: (list) strings
+
+        Returns:
+            :counts: (array) estimated count of each item
+        """
+
+        if not items:
+            return np.zeros(0, dtype=np.int64)
+        return self.table[np.arange(self.depth)[:, None], self._indices(items)].min(axis=0)
+
+    def merge(self, other):
+        """Add the counts of another sketch (same width and depth)"""
+
+        if (self.width, self.depth) != (other.width, other.depth):
+            raise ValueError(f"Cannot merge Count-Min sketches of size {self.depth}x{self.width} and {other.depth}x{other.width}")
+        self.table += other.table
+
+    def to_dict(self):
+        return {'width': self.width, 'depth': self.depth, 'table': _encode_array(self.table)}
+
+    @classmethod
+    def from_dict(cls, state):
+        sketch = cls(state['width'], state['depth'])
+        sketch.table = _decode_array(state['table'], np.int64, (sketch.depth, sketch.width))
+        return sketch
+
+
+class SpaceSaving:
+    """
+    Candidates for the most frequent items with a fixed number of counters (Space-Saving)
+
+    If all counters are taken, a new item replaces the item with the
+    smallest count and inherits this count as error. So a count is never
+    smaller than the true count, and 'count - error' never larger. Merging
+    follows Agarwal et al. ("Mergeable summaries"): an item missing in one
+    summary gets the smallest count of that summary.
+
+    Attributes:
+        :capacity: (int) maximum number of counters
+        :counters: (dict) item as key and list [count, error] as value
+    """
+
+    def __init__(self, capacity=SKETCH_CAPACITY):
+        self.capacity = capacity
+        self.counters = {}
+        self._heap = []  # Tuples (count, item), entries with an old count are skipped
+
+    def _rebuild_heap(self):
+        self._heap = [(count, item) for item, (count, _) in self.counters.items()]
+        heapq.heapify(self._heap)
+
+    def _pop_min(self):
+        while True:
+            count, item = heapq.heappop(self._heap)
+            counter = self.counters.get(item)
+            if counter is not None and counter[0] == count:
+                return item, counter
+
+    def _min_count(self):
+        if len(self.counters) < self.capacity:
+            return 0
+        return min(count for count, _ in self.counters.values())
+
+    def update(self, counts):
+        """
+        Add counts
+
+        Args:
+            :counts: (dict) item (str) as key and count (int) as value
+        """
+
+        for item, count in counts.items():
+            counter = self.counters.get(item)
+            if counter is not None:
+                counter[0] += count
+            elif len(self.counters) < self.capacity:
+                counter = self.counters[item] = [count, 0]
+            else:
+                evicted, (minimum, _) = self._pop_min()
+                del self.counters[evicted]
+                counter = self.counters[item] = [minimum + count, minimum]
+            heapq.heappush(self._heap, (counter[0], item))
+            if len(self._heap) > 4*self.capacity:
+                self._rebuild_heap()
+
+    def top(self, n=None):
+        """
+        Return the items with the highest counts
+
+        Args:
+            :n: (int) number of items (all if None)
+
+        Returns:
+            :top: (list) tuples (item, count, error), highest count first
+        """
+
+        items = sorted(self.counters.items(), key=lambda item: (-item[1][0], item[0]))
+        return [(item, count, error) for item, (count, error) in items[:n]]
+
+    def merge(self, other):
+        """Add the counts of another summary"""
+
+        min_self, min_other = self._min_count(), other._min_count()
+        merged = {}
+        for item in self.counters.keys() | other.counters.keys():
+            count_self, error_self = self.counters.get(item, (min_self, min_self))
+            count_other, error_other = other.counters.get(item, (min_other, min_other))
+            merged[item] = [count_self + count_other, error_self + error_other]
+
+        capacity = max(self.capacity, other.capacity)
+        self.capacity = capacity
+        self.counters = dict(heapq.nlargest(capacity, merged.items(), key=lambda item: (item[1][0], item[0])))
+        self._rebuild_heap()
+
+    def to_dict(self):
+        return {'capacity': self.capacity, 'counters': [list(item) for item in self.top()]}
+
+    @classmethod
+    def from_dict(cls, state):
+        summary = cls(state['capacity'])
+        summary.counters = {item: [count, error] for item, count, error in state['counters']}
+        summary._rebuild_heap()
+        return summary
+
+
+class HyperLogLog:
+    """
+    Approximate number of distinct items (HyperLogLog)
+
+    Sketches with the same precision are merged with the register-wise
+    maximum, so items seen by both sketches are counted only once.
+
+    Attributes:
+        :precision: (int) the sketch has 2**precision registers
+        :registers: (array) largest rank seen per register (uint8)
+    """
+
+    def __init__(self, precision=SKETCH_PRECISION):
+        self.precision = precision
+        self.registers = np.zeros(1 << precision, dtype=np.uint8)
+
+    def update(self, items):
+        """
+        Add items
+
+        Args:
+            :items: (list) strings
+        """
+
+        if not items:
+            return
+        h1, _ = _sketch_hashes(items)
+        bits = 64 - self.precision
+        indices = (h1 >> np.uint64(bits)).astype(np.intp)
+        # Rank: position of the first 1-bit in the remaining bits
+        ranks = [bits + 1 - rest.bit_length() for rest in (h1 & np.uint64((1 << bits) - 1)).tolist()]
+        np.maximum.at(self.registers, indices, np.array(ranks, dtype=np.uint8))
+
+    def count(self):
+        """Return the estimated number of distinct items"""
+
+        m = len(self.registers)
+        alpha = 0.7213/(1 + 1.079/m)
+        estimate = alpha*m*m/np.sum(np.exp2(-self.registers.astype(np.float64)))
+        zeros = m - np.count_nonzero(self.registers)
+        if estimate <= 2.5*m and zeros:
+            estimate = m*np.log(m/zeros)  # Linear counting for small numbers
+        return int(round(estimate))
+
+    def merge(self, other):
+        """Add the items of another sketch (same precision)"""
+
+        if self.precision != other.precision:
+            raise ValueError(f"Cannot merge HyperLogLog sketches of precision {self.precision} and {other.precision}")
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    def to_dict(self):
+        return {'precision': self.precision, 'registers': _encode_array(self.registers)}
+
+    @classmethod
+    def from_dict(cls, state):
+        sketch = cls(state['precision'])
+        sketch.registers = _decode_array(state['registers'], np.uint8, (1 << sketch.precision,))
+        return sketch
+
+
+class TopTweets:
+    """
+    Tweets with the highest count of likes (or retweets), kept in a min-heap
+
+    A tweet which is added again (e.g. from another snapshot) is only kept
+    once, with its highest count.
+
+    Attributes:
+        :key: (str) 'likes' or 'retweets'
+        :size: (int) number of tweets
+    """
+
+    def __init__(self, key, size=SKETCH_TOP_TWEETS):
+        self.key = key
+        self.size = size
+        self._heap = []  # Tuples (count, tweet ID, tweet)
+        self._counts = {}  # Tweet ID as key and count as value
+
+    def add(self, tweet):
+        """
+        Add a tweet
+
+        Args:
+            :tweet: (dict) tweet record (see 'TweetSummary')
+        """
+
+        count, tweet_id = tweet[self.key], tweet['tweetId']
+        if tweet_id in self._counts:
+            if count <= self._counts[tweet_id]:
+                return
+            self._heap = [entry for entry in self._heap if entry[1] != tweet_id]
+            heapq.heapify(self._heap)
+            del self._counts[tweet_id]
+
+        if len(self._heap) < self.size:
+            heapq.heappush(self._heap, (count, tweet_id, tweet))
+        elif (count, tweet_id) > self._heap[0][:2]:
+            _, evicted, _ = heapq.heapreplace(self._heap, (count, tweet_id, tweet))
+            del self._counts[evicted]
+        else:
+            return
+        self._counts[tweet_id] = count
+
+    def tweets(self):
+        """Return the tweets, highest count first"""
+
+        return [tweet for _, _, tweet in sorted(self._heap, key=lambda entry: entry[:2], reverse=True)]
+
+    def merge(self, other):
+        """Add the tweets of another list"""
+
+        for tweet in other.tweets():
+            self.add(tweet)
+
+    def to_dict(self):
+        return {'key': self.key, 'size': self.size, 'tweets': self.tweets()}
+
+    @classmethod
+    def from_dict(cls, state):
+        top = cls(state['key'], state['size'])
+        for tweet in state['tweets']:
+            top.add(tweet)
+        return top
+
+
+class ReservoirSample:
+    """
+    Uniform random sample of a stream (reservoir sampling)
+
+    Two samples are merged by drawing each item from one of them with a
+    probability proportional to the remaining length of its stream, so the
+    merged sample is a uniform sample of both streams.
+
+    Attributes:
+        :size: (int) maximum number of items
+        :seen: (int) length of the stream
+        :items: (list) sample
+    """
+
+    def __init__(self, size=SKETCH_SAMPLE_SIZE, seed=SKETCH_SEED):
+        self.size = size
+        self.seen = 0
+        self.items = []
+        self._random = random.Random(seed)
+
+    def add(self, item):
+        """Add an item of the stream"""
+
+        self.seen += 1
+        if len(self.items) < self.size:
+            self.items.append(item)
+        else:
+            i = self._random.randrange(self.seen)
+            if i < self.size:
+                self.items[i] = item
+
+    def merge(self, other):
+        """Merge the sample of another stream"""
+
+        ours, theirs = list(self.items), list(other.items)
+        self._random.shuffle(ours)
+        self._random.shuffle(theirs)
+
+        size = max(self.size, other.size)
+        left_ours, left_theirs = self.seen, other.seen
+        items = []
+        while len(items) < size and (ours or theirs):
+            if theirs and (not ours or self._random.randrange(left_ours + left_theirs) >= left_ours):
+                items.append(theirs.pop())
+                left_theirs -= 1
+            else:
+                items.append(ours.pop())
+                left_ours -= 1
+
+        self.size = size
+        self.seen += other.seen
+        self.items = items
+
+    def to_dict(self):
+        return {'size': self.size, 'seen': self.seen, 'items': self.items}
+
+    @classmethod
+    def from_dict(cls, state):
+        sample = cls(state['size'])
+        sample.seen = state['seen']
+        sample.items = list(state['items'])
+        return sample
+
+
+def count_keywords(texts):
+    """
+    Count the keywords of tweet texts (lowercase words without links, hashtags, mentions and stop words)
+
+    Args:
+        :texts: (list) tweet texts
+
+    Returns:
+        :counts: (obj) 'Counter' with keywords as keys
+    """
+
+    # Texts are split and counted at once, words are only parsed once per distinct token
+    counts = Counter()
+    for token, count in Counter(' '.join(texts).lower().split()).items():
+        if token.startswith(SUMMARY_SKIP_PREFIXES):
+            continue
+        for word in SUMMARY_WORD_PATTERN.findall(token):
+            if word not in SUMMARY_STOPWORDS:
+                counts[word] += count
+    return counts
+
+
+class TweetSummary:
+    """
+    Approximate statistics of a stream of tweets in bounded memory
+
+    The tweets are read once. Top hashtags and keywords are found with
+    Space-Saving summaries, their counts are refined with Count-Min
+    sketches. Distinct hashtags and tweets are counted with HyperLogLog,
+    the most liked (retweeted) tweets are kept in heaps, and a random sample
+    of tweets is drawn. The memory does not grow with the number of tweets.
+
+    Summaries are mergeable: the summary of several snapshots (or accounts)
+    is the merge of their summaries, the tweets are not read again (see
+    'summarize_data_file()'). Tweets in more than one merged snapshot are
+    counted more than once, except for the distinct counts and top tweets.
+
+    Attributes:
+        :tweets: (int) number of tweets
+        :retweets: (int) number of retweets
+        :accounts: (list) twitter accounts
+        :first: (str) time of the oldest tweet
+        :last: (str) time of the newest tweet
+    """
+
+    def __init__(self):
+        self.tweets = 0
+        self.retweets = 0
+        self.accounts = []
+        self.first = self.last = None
+        self.hashtags = SpaceSaving()
+        self.hashtag_counts = CountMinSketch()
+        self.keywords = SpaceSaving()
+        self.keyword_counts = CountMinSketch()
+        self.distinct_hashtags = HyperLogLog()
+        self.distinct_tweets = HyperLogLog()
+        self.top_likes = TopTweets('likes')
+        self.top_retweets = TopTweets('retweets')
+        self.sample = ReservoirSample()
+
+    def _add_times(self, first, last):
+        if first is not None and (self.first is None or parse_epoch(first) < parse_epoch(self.first)):
+            self.first = first
+        if last is not None and (self.last is None or parse_epoch(last) > parse_epoch(self.last)):
+            self.last = last
+
+    @instrument('summary.update')
+    def update(self, tweets, username=None, batch_size=SKETCH_BATCH_SIZE):
+        """
+        Add tweets
+
+        Args:
+            :tweets: (iter) tweets (or 'TweetTable')
+            :username: (str) twitter account (unless tweets have a key 'username')
+            :batch_size: (int) number of tweets counted at once
+        """
+
+        if username is not None and username not in self.accounts:
+            self.accounts.append(username)
+
+        tweets = iter(tweets)
+        while True:
+            batch = list(islice(tweets, batch_size))
+            if not batch:
+                break
+
+            raw_hashtags, texts, tweet_ids = Counter(), [], []
+            first = last = None
+            for tweet in batch:
+                raw_hashtags.update(tweet['entries']['hashtags'])
+                texts.append(tweet['text'])
+                tweet_ids.append(str(tweet['tweetId']))
+
+                epoch = parse_epoch(tweet['time'])
+                if first is None or epoch < first[0]:
+                    first = (epoch, tweet['time'])
+                if last is None or epoch > last[0]:
+                    last = (epoch, tweet['time'])
+
+                record = OrderedDict((
+                    ('tweetId', str(tweet['tweetId'])),
+                    ('username', tweet.get('username', username)),
+                    ('time', tweet['time']),
+                    ('isRetweet', bool(tweet['isRetweet'])),
+                    ('replies', int(tweet['replies'])),
+                    ('retweets', int(tweet['retweets'])),
+                    ('likes', int(tweet['likes'])),
+                    ('text', tweet['text']),
+                ))
+                self.top_likes.add(record)
+                self.top_retweets.add(record)
+                self.sample.add(record)
+                self.retweets += record['isRetweet']
+
+            # Hashtags are normalised as in filters, each distinct hashtag only once
+            hashtags = Counter()
+            for hashtag, count in raw_hashtags.items():
+                hashtags[parse_filter_kw(hashtag)[1]] += count
+            hashtags.pop('', None)
+            keywords = count_keywords(texts)
+
+            self.tweets += len(batch)
+            self._add_times(first[1], last[1])
+            self.hashtags.update(hashtags)
+            self.hashtag_counts.update(hashtags)
+            self.keywords.update(keywords)
+            self.keyword_counts.update(keywords)
+            self.distinct_hashtags.update(list(hashtags))
+            self.distinct_tweets.update(tweet_ids)
+            METRICS.count('summary_tweets', len(batch))
+
+    def merge(self, other):
+        """Add the statistics of another summary"""
+
+        self.tweets += other.tweets
+        self.retweets += other.retweets
+        self.accounts.extend(username for username in other.accounts if username not in self.accounts)
+        self._add_times(other.first, other.last)
+        for name in ('hashtags', 'hashtag_counts', 'keywords', 'keyword_counts', 'distinct_hashtags',
+                     'distinct_tweets', 'top_likes', 'top_retweets', 'sample'):
+            getattr(self, name).merge(getattr(other, name))
+
+    def _top_items(self, candidates, counts, n):
+        top = candidates.top()
+        estimates = counts.estimate([item for item, _, _ in top]).tolist()
+        # Both counts are upper bounds, the smaller one is closer
+        top = [(item, min(count, estimate), count - error) for (item, count, error), estimate in zip(top, estimates)]
+        return sorted(top, key=lambda item: (-item[1], item[0]))[:n]
+
+    def top_hashtags(self, n=SUMMARY_TOP_ITEMS):
+        """
+        Return the most frequent hashtags
+
+        Args:
+            :n: (int) number of hashtags
+
+        Returns:
+            :top: (list) tuples (hashtag, estimated count, guaranteed count)
+        """
+
+        return self._top_items(self.hashtags, self.hashtag_counts, n)
+
+    def top_keywords(self, n=SUMMARY_TOP_ITEMS):
+        """Return the most frequent keywords (see 'top_hashtags()')"""
+
+        return self._top_items(self.keywords, self.keyword_counts, n)
+
+    def to_dict(self):
+        return OrderedDict((
+            ('version', SKETCH_VERSION),
+            ('tweets', self.tweets),
+            ('retweets', self.retweets),
+            ('accounts', self.accounts),
+            ('first', self.first),
+            ('last', self.last),
+            ('hashtags', self.hashtags.to_dict()),
+            ('hashtag_counts', self.hashtag_counts.to_dict()),
+            ('keywords', self.keywords.to_dict()),
+            ('keyword_counts', self.keyword_counts.to_dict()),
+            ('distinct_hashtags', self.distinct_hashtags.to_dict()),
+            ('distinct_tweets', self.distinct_tweets.to_dict()),
+            ('top_likes', self.top_likes.to_dict()),
+            ('top_retweets', self.top_retweets.to_dict()),
+            ('sample', self.sample.to_dict()),
+        ))
+
+    @classmethod
+    def from_dict(cls, state):
+        if state.get('version') != SKETCH_VERSION:
+            raise ValueError(f"Unsupported summary version {state.get('version')!r}")
+        summary = cls()
+        summary.tweets, summary.retweets = state['tweets'], state['retweets']
+        summary.accounts = list(state['accounts'])
+        summary.first, summary.last = state['first'], state['last']
+        summary.hashtags = SpaceSaving.from_dict(state['hashtags'])
+        summary.hashtag_counts = CountMinSketch.from_dict(state['hashtag_counts'])
+        summary.keywords = SpaceSaving.from_dict(state['keywords'])
+        summary.keyword_counts = CountMinSketch.from_dict(state['keyword_counts'])
+        summary.distinct_hashtags = HyperLogLog.from_dict(state['distinct_hashtags'])
+        summary.distinct_tweets = HyperLogLog.from_dict(state['distinct_tweets'])
+        summary.top_likes = TopTweets.from_dict(state['top_likes'])
+        summary.top_retweets = TopTweets.from_dict(state['top_retweets'])
+        summary.sample = ReservoirSample.from_dict(state['sample'])
+        return summary
+
+
+def iter_summary_rows(summary, top=SUMMARY_TOP_ITEMS):
+    """
+    Yield the rows of a sheet with the statistics of a 'TweetSummary'
+
+    Args:
+        :summary: (obj) 'TweetSummary'
+        :top: (int) number of hashtags and keywords
+    """
+
+    yield [xl_header("Overview")]
+    yield [xl_header("accounts"), ', '.join(summary.accounts)]
+    yield [xl_header("tweets"), summary.tweets]
+    yield [xl_header("retweets"), summary.retweets]
+    yield [xl_header("first tweet"), summary.first]
+    yield [xl_header("last tweet"), summary.last]
+    yield [xl_header("distinct tweets (approx.)"), summary.distinct_tweets.count()]
+    yield [xl_header("distinct hashtags (approx.)"), summary.distinct_hashtags.count()]
+
+    for title, items in (("Top hashtags", summary.top_hashtags(top)), ("Top keywords", summary.top_keywords(top))):
+        yield []
+        yield [xl_header(title), xl_header("count (approx.)"), xl_header("at least")]
+        for item, count, minimum in items:
+            yield [f'#{item}' if title == "Top hashtags" else item, count, minimum]
+
+    headers = ["account", "Time", "url", "isRetweet", "replies", "retweets", "likes", "text"]
+    for title, tweets in (
+        ("Most liked tweets", summary.top_likes.tweets()),
+        ("Most retweeted tweets", summary.top_retweets.tweets()),
+        (f"Random sample ({len(summary.sample.items)} of {summary.sample.seen} tweets)", summary.sample.items),
+    ):
+        yield []
+        yield [xl_header(title)]
+        yield [xl_header(header) for header in headers]
+        for tweet in tweets:
+            yield [
+                tweet['username'],
+                tweet['time'],
+                XlValue("link", hyperlink=get_tweet_url(tweet['username'], tweet['tweetId'])),
+                XlValue(str(tweet['isRetweet']), fill=XL_FILL_RED) if tweet['isRetweet'] else str(tweet['isRetweet']),
+                tweet['replies'],
+                tweet['retweets'],
+                tweet['likes'],
+                tweet['text'],
+            ]
+
+
+def summarize_data_file(filename, column_cache=True):
+    """
+    Return the summary of a snapshot
+
+    The sketches are stored next to the data file ('SUMMARY_CACHE_FILENAME')
+    and only computed again if the data file changed.
+
+    Args:
+        :filename: (str) path of the data file
+        :column_cache: (bool) if True, read the tweets from the column cache (see 'read_column_table()')
+
+    Returns:
+        :summary: (obj) 'TweetSummary'
+    """
+
+    cache_file = os.path.join(os.path.dirname(os.path.abspath(filename)), SUMMARY_CACHE_FILENAME)
+    try:
+        with open(cache_file, 'r') as fp:
+            cached = json.load(fp)
+        entry = cached['source']
+        source = file_fingerprint(filename, content=False)
+        if entry['name'] == os.path.basename(filename) and source['size'] == entry['size']:
+            if source['mtime_ns'] == entry['mtime_ns'] or file_fingerprint(filename)['sha256'] == entry['sha256']:
+                return TweetSummary.from_dict(cached['summary'])
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        logger.debug(f"Summary of {truncate_filepath(filename)!r} not usable: {e!r}")
+
+    logger.info(f"Summarizing {truncate_filepath(filename)}...")
+    source = dict(file_fingerprint(filename), name=os.path.basename(filename))
+    profile, tweets = read_column_table(filename) if column_cache else read_twitter_data(filename)
+    username = profile.get('username')
+    if username is None:
+        username = parse_snapshot_dirname(os.path.basename(os.path.dirname(os.path.abspath(filename))))[0]
+
+    summary = TweetSummary()
+    summary.update(tweets, username)
+
+    try:
+        file_tmp = f'{cache_file}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(file_tmp, 'w') as fp:
+            json.dump({'source': source, 'summary': summary.to_dict()}, fp)
+        os.replace(file_tmp, cache_file)
+    except OSError as e:
+        logger.warning(f"Could not save summary of {truncate_filepath(filename)!r}: {e}")
+    return summary
+
+
+def summarize_snapshots(paths, output, engine='stream', all_snapshots=False, column_cache=True):
+    """
+    Write the merged summary of snapshots to an Excel or CSV file
+
+    Args:
+        :paths: (list) data files, snapshot directories or directories with snapshots (snapshot catalog if empty)
+        :output: (str) output file ('.csv' or '.tsv' for CSV, otherwise Excel)
+        :engine: (str) Excel engine (see 'XL_ENGINES')
+        :all_snapshots: (bool) if True, merge all snapshots, otherwise only the latest snapshot of each account
+        :column_cache: (bool) if True, read the snapshots from their column caches
+
+    Returns:
+        :summary: (obj) merged 'TweetSummary'
+    """
+
+    if paths:
+        snapshots = find_snapshot_files(paths)
+    else:
+        snapshots = OrderedDict()
+        for entry in load_catalog().snapshots():
+            snapshots.setdefault(entry['username'], []).append((entry['taken_at'], entry['path']))
+    if not all_snapshots:
+        snapshots = OrderedDict((username, files[-1:]) for username, files in snapshots.items())
+    logger.info(f"Summarizing {sum(len(files) for files in snapshots.values())} snapshot(s) of {len(snapshots)} account(s)...")
+
+    summary = TweetSummary()
+    for files in snapshots.values():
+        for _, filename in files:
+            summary.merge(summarize_data_file(filename, column_cache))
+
+    workbook = get_table_writer(output, engine)
+    workbook.add_sheet("Summary", iter_summary_rows(summary))
+    workbook.save(output)
+    logger.info(f"Saved summary: {truncate_filepath(output)}")
+    return summary
 
 
 def parse_filter_kw(filter_kw):